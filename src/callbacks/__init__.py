@@ -4,6 +4,8 @@ from src.callbacks.logging import Logging
 from src.callbacks.regularizers import MaxNorm
 from src.callbacks.schedulers import WeightScheduler
 from src.callbacks.analyze import Analyze
+from src.callbacks.training_state import TrainingState
+from src.callbacks.profiler import Profiler
 
 __all__ = [
     'CallbackList',
@@ -12,5 +14,7 @@ __all__ = [
     'Logging',
     'MaxNorm',
     'WeightScheduler',
-    'Analyze'
+    'Analyze',
+    'TrainingState',
+    'Profiler'
 ]
\ No newline at end of file
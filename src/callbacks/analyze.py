@@ -1,16 +1,11 @@
 import torch
 import numpy as np
-import tensorflow as tf
-import tensorboard as tb
 
 from src.callbacks.base import Callback
-from torch.utils.tensorboard import SummaryWriter
 from src.viz.mpl_plots import plot_2d
 from src.processing import post_process
 import matplotlib.pyplot as plt
 
-tf.io.gfile = tb.compat.tensorflow_stub.io.gfile
-
 
 class Analyze(Callback):
     def __init__(self, n_samples=100):
@@ -1,14 +1,32 @@
 import os
+import time
 
 import torch
 
 from src.callbacks.base import Callback
-from src.models import PJPE
+from src.loggers import JsonlSink, MetricBuffer, TensorBoardSink
 from src.viz.mpl_plots import plot_all_proj, plot_3d
 
 
 class Logging(Callback):
-    """Logging and printing metrics"""
+    def __init__(self, every_n_steps: int = 50, every_n_seconds: float = 30, log_dir: str = None, tensorboard: bool = False):
+        """Logging and printing metrics. Training metrics are summed on the device and their means over
+        the window are printed and logged every_n_steps or every_n_seconds, whichever comes first,
+        and at the end of every epoch.
+
+        Args:
+            every_n_steps (int, optional): steps per flush, 1 logs every step, 0 only by time. Defaults to 50.
+            every_n_seconds (float, optional): longest time between flushes. Defaults to 30.
+            log_dir (str, optional): also log to [log_dir]/[exp_name]_metrics.jsonl. Defaults to None.
+            tensorboard (bool, optional): also log to tensorboard in [log_dir]/tensorboard/[exp_name]. Defaults to False.
+        """
+        self.every_n_steps = every_n_steps
+        self.every_n_seconds = every_n_seconds
+        self.log_dir = log_dir
+        self.tensorboard = tensorboard
+        self.buffer = MetricBuffer()
+        self.sinks = []
+        self.step = 0
 
     def setup(self, config, models, **kwargs):
         print(
@@ -17,56 +35,75 @@ class Logging(Callback):
         for model in models.values():
             config.logger.watch(model, log='all')
 
+        if self.log_dir:
+            self.sinks.append(JsonlSink(f'{self.log_dir}/{config.exp_name}_metrics.jsonl'))
+            if self.tensorboard:
+                try:
+                    self.sinks.append(TensorBoardSink(f'{self.log_dir}/tensorboard/{config.exp_name}'))
+                except ImportError:
+                    print('[WARNING]: tensorboard not installed, logging to jsonl only')
+        self.last_flush = time.perf_counter()
+
     def on_train_batch_end(self, config, vae_type, epoch, batch_idx, batch, dataloader, output, **kwargs):
+        metrics = {
+            'total_train': output['loss'],
+            'recon_loss': output['log']['recon_loss'],
+            'kld_loss': output['log']['kld_loss'],
+        }
+        # critic
+        if config.self_supervised:
+            for key in ['critic_loss', 'gen_loss', 'D_x', 'D_G_z1', 'D_G_z2']:
+                metrics[key] = output['log'][key]
+        self.buffer.add(metrics)
+        self.step += 1
+
+        is_last = batch_idx == len(dataloader) - 1
+        if is_last or (self.every_n_steps and self.step % self.every_n_steps == 0) or \
+                time.perf_counter() - self.last_flush >= self.every_n_seconds:
+            self.flush(config, vae_type, epoch, batch_idx, batch, dataloader)
+
+    def flush(self, config, vae_type, epoch, batch_idx, batch, dataloader):
+        """print and log the means of the buffered steps, the only device sync of the logs"""
+        n_steps = len(self.buffer)
+        means = self.buffer.means()
+        self.last_flush = time.perf_counter()
+
         # print to console
         batch_len = len(batch['pose2d'])
         dataset_len = len(dataloader.dataset)
-        n_batches = len(dataloader)
         print('{} Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.4f}\tReCon: {:.4f}\tKLD: {:4f}'.format(
             vae_type, epoch, (batch_idx+1) * batch_len,
             dataset_len, 100. * ((batch_idx+1)*batch_len) / dataset_len,
-            output['loss'], output['log']['recon_loss'],
-            output['log']['kld_loss']), end='')
+            means['total_train'], means['recon_loss'],
+            means['kld_loss']), end='')
 
-        # critic
         if config.self_supervised:
             print('\tcritic_loss: {:.4f}\tgen_loss: {:.4f}\tD_x: {:.4f}\tD_G_z1: {:.4f}\tD_G_z2: {:.4f}'.format(
-                output['log']['critic_loss'],
-                output['log']['gen_loss'],
-                output['log']['D_x'],
-                output['log']['D_G_z1'],
-                output['log']['D_G_z2']
+                means['critic_loss'],
+                means['gen_loss'],
+                means['D_x'],
+                means['D_G_z1'],
+                means['D_G_z2']
             ), end='')
+        print(f'\t({n_steps} steps)')
 
-            config.logger.log({
-                f"{vae_type}": {
-                    "train": {
-                        'critic_loss': output['log']['critic_loss'],
-                        'gen_loss': output['log']['gen_loss'],
-                        'D_x': output['log']['D_x'],
-                        'D_G_z1': output['log']['D_G_z1'],
-                        'D_G_z2': output['log']['D_G_z2']
-                    }
-                }
-            }, commit=True)
+        # if int(100*(batch_idx/n_batches)) % 1000 == 0 and batch_len == config.batch_size:
+        #     i = 0
+        #     plot_all_proj(config, output["log"]["recon_2d"][i], output["log"]["novel_2d"][i], output["log"]["target_2d"][i],
+        #                   output["log"]["recon_3d"][i], output["log"]["target_3d"][i])
 
-            # if int(100*(batch_idx/n_batches)) % 1000 == 0 and batch_len == config.batch_size:
-            #     i = 0
-            #     plot_all_proj(config, output["log"]["recon_2d"][i], output["log"]["novel_2d"][i], output["log"]["target_2d"][i],
-            #                   output["log"]["recon_3d"][i], output["log"]["target_3d"][i])
+        # one log per window to wandb
+        config.logger.log({f"{vae_type}": {"train": means}}, commit=True)
+        self.write({f'{vae_type}/train/{key}': val for key, val in means.items()})
 
-        # other logs to wandb
-        config.logger.log({
-            f"{vae_type}": {
-                "train": {
-                    "kld_loss": output['log']['kld_loss'],
-                    "recon_loss": output['log']['recon_loss'],
-                    "total_train": output['loss']
-                }
-            }
-        }, commit=True)
+    def write(self, metrics):
+        for sink in self.sinks:
+            sink.write(self.step, metrics)
 
-        print('')
+    def teardown(self, **kwargs):
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
 
     def on_validation_start(self):
         print("Start validation epoch")
@@ -146,6 +183,8 @@ class Logging(Callback):
         print(f'{vae_type} - * MPJPE * : {round(mpjpe,4)} \n per joint \n {avg_pjpe} \n per action \n {list(mpjpe_pa.values())}')
         config.logger.log({f'{vae_type}_mpjpe': mpjpe})
         config.mpjpe = mpjpe
+        self.write({f'{vae_type}/val/{key}': val for key, val in avg_output['log'].items()})
+        self.write({f'{vae_type}/val/total_val': avg_output['loss'], f'{vae_type}/val/mpjpe': mpjpe})
 
         # For Images
         # TODO can have this in eval instead and skip logging val
@@ -1,11 +1,104 @@
+from collections import deque
+import queue
+import threading
+from typing import Any, Callable, Optional
+
 from src.callbacks.base import Callback
+from src.distributed import unwrap
 import torch
 import os
 
 
-class ModelCheckpoint(Callback):
+def to_cpu(obj: Any) -> Any:
+    """copy of the tensors in a (nested) state dict on cpu, safe to keep while training continues"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copy = type(obj)((key, to_cpu(val)) for key, val in obj.items())
+        if hasattr(obj, "_metadata"):
+            # module versions, used by load_state_dict
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(val) for val in obj)
+    return obj
+
+
+def atomic_save(state: Any, path: str) -> None:
+    """write to a temp file and rename, an interrupted save never leaves a partial checkpoint"""
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointWriter:
+    """Saves checkpoints in a background thread, in the order they are submitted.
+    Errors of the thread are raised on the next submit or flush."""
+
     def __init__(self):
+        self.jobs = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, state: Any, path: str, on_saved: Optional[Callable[[str], Any]] = None) -> None:
+        """state should not change after submitting, pass a to_cpu copy"""
+        def job():
+            atomic_save(state, path)
+            print(f'[INFO] Saved pt: {path}')
+            if on_saved is not None:
+                on_saved(path)
+
+        self.call(job)
+
+    def call(self, fn: Callable[[], Any]) -> None:
+        self._raise()
+        self.jobs.put(fn)
+
+    def flush(self) -> None:
+        """block until all submitted checkpoints are written"""
+        self.jobs.join()
+        self._raise()
+
+    def close(self) -> None:
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("[ERROR]: Checkpoint writer failed") from error
+
+
+def remove(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ModelCheckpoint(Callback):
+    def __init__(self, keep_last: int = 2):
+        """Checkpoints of every validation epoch, the last keep_last of them are kept
+        along with the best MPJPE checkpoint [run_name]_[model].pt used to resume.
+        Only copying the states to cpu blocks training, they are written in the background.
+        """
         self.val_loss_min = float("inf")
+        self.keep_last = keep_last
+        self.recent = deque()
+        self.writer = AsyncCheckpointWriter()
 
     def setup(self, config, models, optimizers, variant, **kwargs):
         # Save model code to wandb
@@ -29,45 +122,51 @@ class ModelCheckpoint(Callback):
                 optimizers[n_pair].load_state_dict(optimizer_state_dic)
 
     def on_epoch_end(self, config, val_loss, model, optimizers, epoch, n_pair, **kwargs):
-        if config.mpjpe < config.mpjpe_min and config.device.type != 'cpu':
+        if config.device.type == 'cpu':
+            return
+
+        is_best = config.mpjpe < config.mpjpe_min
+        if is_best:
             print(
                 f"[INFO]: MPJPE decreased from {config.mpjpe_min} -> {config.mpjpe}")
-            config.mpjpe_min = config.mpjpe  
+            config.mpjpe_min = config.mpjpe
 
             # just update val_loss for record
-            if val_loss < self.val_loss_min and config.device.type != 'cpu':
+            if val_loss < self.val_loss_min:
                 self.val_loss_min = val_loss
 
-            # Models
-            for model_ in model:
-                try:
-                    state_dict = model_.module.state_dict()
-                except AttributeError:
-                    state_dict = model_.state_dict()
-
-                state = {
-                    'epoch': epoch,
-                    'val_loss': val_loss,
-                    'model_state_dict': state_dict,
-                }
-
-                torch.save(
-                    state, f'{config.save_dir}/{config.logger.run.name}_{model_.name}.pt')
-                config.logger.save(
-                    f'{config.save_dir}/{config.logger.run.name}_{model_.name}.pt')
-                print(
-                    f'[INFO] Saved pt: {config.save_dir}/{config.logger.run.name}_{model_.name}.pt')
+        states = {}
+        # Models
+        for model_ in model:
+            model_ = unwrap(model_)
+            states[model_.name] = {
+                'epoch': epoch,
+                'val_loss': val_loss,
+                'model_state_dict': model_.state_dict(),
+            }
+        # Optimizer
+        states[f'optimizer_{n_pair}'] = optimizers[n_pair].state_dict()
 
-                del state
+        # the only blocking part
+        states = to_cpu(states)
 
-            # Optimizer
-            torch.save(
-                optimizers[n_pair].state_dict(),
-                f'{config.save_dir}/{config.logger.run.name}_optimizer_{n_pair}.pt')
-            config.logger.save(
-                f'{config.save_dir}/{config.logger.run.name}_optimizer_{n_pair}.pt')
-            print(
-                f'[INFO] Saved pt: {config.save_dir}/{config.logger.run.name}_optimizer_{n_pair}.pt')
-            
+        prefix = f'{config.save_dir}/{config.logger.run.name}'
+        paths = []
+        for name, state in states.items():
+            if self.keep_last:
+                paths.append(f'{prefix}_{name}_epoch_{epoch}.pt')
+                self.writer.submit(state, paths[-1])
+            if is_best:
+                self.writer.submit(state, f'{prefix}_{name}.pt', on_saved=config.logger.save)
+
+        self.recent.append(paths)
+        while len(self.recent) > self.keep_last:
+            self.writer.call(lambda paths=self.recent.popleft(): remove(paths))
+
+        if is_best:
             # mpjpe_min corresponds to this model hence reproducible
-            config.logger.config.update({"mpjpe_min": config.mpjpe_min}, allow_val_change=True)
+            config.logger.update_config(config)
+
+    def teardown(self, **kwargs):
+        # pending checkpoints are written before exiting
+        self.writer.close()
@@ -0,0 +1,149 @@
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Iterable
+
+import torch
+
+from src.callbacks.base import Callback
+from src.distributed import get_rank
+
+
+def mark_phase(config, name: str) -> None:
+    """End the current phase of the training step and start the next one, no-op without a Profiler.
+    A phase runs until the next mark or the end of the step.
+    """
+    profiler = getattr(config, "profiler", None)
+    if profiler is not None:
+        profiler.mark(name)
+
+
+def reset_data_timer(config) -> None:
+    """Start timing the data loader stall of the next step from now, no-op without a Profiler"""
+    profiler = getattr(config, "profiler", None)
+    if profiler is not None:
+        profiler.last_step_end = time.perf_counter()
+
+
+class Profiler(Callback):
+    def __init__(self, trace_dir: str, trace_steps: Iterable[int] = (), sync: bool = True, max_events: int = 100000):
+        """Wall and CPU time of each phase of the training step and the data loader stall between steps.
+        Phases are marked in the training step with mark_phase. Events are written to
+        [trace_dir]/[exp_name]_profile[_rankN].json in the Chrome trace format (chrome://tracing, Perfetto)
+        with the totals per phase in otherData.
+
+        Args:
+            trace_dir (str): directory of the traces
+            trace_steps (Iterable[int], optional): global steps also traced with torch.profiler. Defaults to ().
+            sync (bool, optional): synchronize cuda at phase boundaries so kernels are timed in their phase. Defaults to True.
+            max_events (int, optional): events kept for the trace, totals include all. Defaults to 100000.
+        """
+        self.trace_dir = trace_dir
+        self.trace_steps = set(trace_steps)
+        self.sync = sync
+        self.max_events = max_events
+        self.events = []
+        self.totals = defaultdict(lambda: {"wall": 0.0, "cpu": 0.0, "count": 0})
+        self.step = 0
+        self.current = None  # name, wall start, cpu start
+        self.record = None
+        self.torch_profiler = None
+        self.last_step_end = None
+
+    def path(self, config, suffix=""):
+        rank = get_rank()
+        rank = f"_rank{rank}" if rank else ""
+        return f"{self.trace_dir}/{config.exp_name}_profile{suffix}{rank}.json"
+
+    def setup(self, config, **kwargs):
+        os.makedirs(self.trace_dir, exist_ok=True)
+        self.cuda = self.sync and torch.device(config.device).type == "cuda"
+        self.start = time.perf_counter()
+        config.profiler = self
+
+    def _synchronize(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def _add(self, name, wall_start, wall_end, cpu):
+        total = self.totals[name]
+        total["wall"] += wall_end - wall_start
+        total["cpu"] += cpu
+        total["count"] += 1
+        if len(self.events) < self.max_events:
+            self.events.append({
+                "name": name, "ph": "X", "pid": get_rank(), "tid": 0,
+                "ts": (wall_start - self.start) * 1e6, "dur": (wall_end - wall_start) * 1e6,
+                "args": {"step": self.step, "cpu_ms": cpu * 1e3},
+            })
+
+    def mark(self, name):
+        self.end_phase()
+        if self.torch_profiler is not None:
+            # phases are also named in the torch.profiler trace
+            self.record = torch.profiler.record_function(name)
+            self.record.__enter__()
+        self.current = (name, time.perf_counter(), time.process_time())
+
+    def end_phase(self):
+        if self.current is None:
+            return
+        self._synchronize()
+        name, wall_start, cpu_start = self.current
+        self._add(name, wall_start, time.perf_counter(), time.process_time() - cpu_start)
+        if self.record is not None:
+            self.record.__exit__(None, None, None)
+            self.record = None
+        self.current = None
+
+    def on_epoch_start(self, **kwargs):
+        self.last_step_end = time.perf_counter()
+
+    def on_train_batch_start(self, **kwargs):
+        now = time.perf_counter()
+        if self.last_step_end is not None:
+            # waiting for the data loader
+            self._add("data", self.last_step_end, now, 0.0)
+
+        if self.step in self.trace_steps:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities)
+            self.torch_profiler.__enter__()
+
+        self.mark("to_device")
+
+    def on_train_batch_end(self, config, **kwargs):
+        self.end_phase()
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+            self.torch_profiler.export_chrome_trace(self.path(config, f"_torch_step{self.step}"))
+            self.torch_profiler = None
+        self.step += 1
+        self.last_step_end = time.perf_counter()
+
+    def on_train_end(self, config, epoch, **kwargs):
+        self.last_step_end = None
+        self.summary(epoch)
+        self.save(config)
+
+    def summary(self, epoch):
+        wall = sum(total["wall"] for total in self.totals.values())
+        print(f"[INFO]: Profile @ epoch {epoch}, {self.step} steps")
+        for name, total in sorted(self.totals.items(), key=lambda item: -item[1]["wall"]):
+            print(f"\t{name:<20} wall: {total['wall']:.3f}s ({100 * total['wall'] / max(wall, 1e-12):.1f}%)"
+                  f"\tcpu: {total['cpu']:.3f}s\tcalls: {total['count']}")
+
+    def save(self, config):
+        with open(self.path(config), "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms", "otherData": dict(self.totals)}, f)
+
+    def teardown(self, config, **kwargs):
+        self.end_phase()
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+            self.torch_profiler = None
+        self.save(config)
+        config.profiler = None
@@ -0,0 +1,93 @@
+import os
+
+import torch
+
+from src.callbacks.base import Callback
+from src.callbacks.model_checkpoint import AsyncCheckpointWriter, to_cpu
+from src.distributed import get_rank, unwrap
+from src.utils import get_rng_state, set_rng_state
+
+# config values changed by the WeightScheduler and ModelCheckpoint during training
+SCHEDULED = ("beta", "critic_weight", "noise_level", "mpjpe_min")
+
+
+class TrainingState(Callback):
+    def __init__(self, every_n_steps: int = 500):
+        """Saves everything needed to continue an interrupted run as if it never stopped:
+        models, optimizers, lr schedulers, scheduled weights, position in the epoch and the RNG states.
+        Saved every_n_steps and at the end of every epoch to [state_dir]/[exp_name]_state.pt
+
+        A run resumed mid epoch replays the data loader from the RNG state at the start of the epoch,
+        skips the batches already trained on and then restores the RNG state of the last saved step.
+        """
+        self.every_n_steps = every_n_steps
+        self.writer = AsyncCheckpointWriter()
+        self.epoch_rng = None
+        self.resume_epoch_rng = None
+
+    @staticmethod
+    def path(config):
+        # a state per process, other processes have their own RNG
+        rank = get_rank()
+        suffix = f"_rank{rank}" if rank else ""
+        return f"{config.state_dir}/{config.exp_name}_state{suffix}.pt"
+
+    def setup(self, config, models, optimizers, schedulers, **kwargs):
+        self.models = models
+        self.optimizers = optimizers
+        self.schedulers = schedulers
+
+        config.start_epoch = 1
+        config.start_pair = 0
+        config.skip_batches = 0
+        os.makedirs(config.state_dir, exist_ok=True)
+
+        if not (config.resume_state and os.path.exists(self.path(config))):
+            return
+
+        # the RNG states are python and numpy objects, not only tensors
+        state = torch.load(self.path(config), map_location=config.device, weights_only=False)
+        for key, model in self.models.items():
+            unwrap(model).load_state_dict(state["models"][key])
+        for optimizer, optimizer_state in zip(self.optimizers, state["optimizers"]):
+            optimizer.load_state_dict(optimizer_state)
+        for scheduler, scheduler_state in zip(self.schedulers, state["schedulers"]):
+            scheduler.load_state_dict(scheduler_state)
+        for key, val in state["config"].items():
+            setattr(config, key, val)
+
+        config.start_epoch = state["epoch"]
+        config.start_pair = state["n_pair"]
+        config.skip_batches = state["batch_idx"] + 1
+        config.resume_rng = state["rng"]
+        self.resume_epoch_rng = state["epoch_rng"]
+        print(f"[INFO]: Resumed training state @ epoch {state['epoch']} pair {state['n_pair']} batch {state['batch_idx']}")
+
+    def on_epoch_start(self, config, **kwargs):
+        if self.resume_epoch_rng is not None:
+            # same shuffling and worker seeds as the interrupted epoch
+            set_rng_state(self.resume_epoch_rng)
+            self.resume_epoch_rng = None
+        self.epoch_rng = get_rng_state()
+
+    def on_train_batch_end(self, config, epoch, n_pair, batch_idx, dataloader, **kwargs):
+        is_last = batch_idx == len(dataloader) - 1
+        if is_last or (self.every_n_steps and (batch_idx + 1) % self.every_n_steps == 0):
+            self.save(config, epoch, n_pair, batch_idx)
+
+    def save(self, config, epoch, n_pair, batch_idx):
+        state = {
+            "models": {key: unwrap(model).state_dict() for key, model in self.models.items()},
+            "optimizers": [optimizer.state_dict() for optimizer in self.optimizers],
+            "schedulers": [scheduler.state_dict() for scheduler in self.schedulers],
+            "config": {key: getattr(config, key) for key in SCHEDULED if hasattr(config, key)},
+            "epoch": epoch,
+            "n_pair": n_pair,
+            "batch_idx": batch_idx,
+            "rng": get_rng_state(),
+            "epoch_rng": self.epoch_rng,
+        }
+        self.writer.submit(to_cpu(state), self.path(config))
+
+    def teardown(self, **kwargs):
+        self.writer.close()
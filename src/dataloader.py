@@ -0,0 +1,31 @@
+import torch
+
+from src.dataset import H36M
+
+
+def train_dataloader(config):
+    print(f'[INFO]: Training data loader called')
+    dataset = H36M(config.train_file, config.self_supervised, is_train=True, debug=config.fast_dev_run)
+    loader = torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=config.batch_size,
+        num_workers=config.num_workers,
+        pin_memory=config.pin_memory,
+        shuffle=True,
+    )
+    print("samples -", len(loader.dataset))
+    return loader
+
+
+def val_dataloader(config, shuffle=False):
+    print(f'[INFO]: Validation data loader called')
+    dataset = H36M(config.test_file, config.self_supervised, is_train=False, debug=config.fast_dev_run)
+    loader = torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=config.batch_size,
+        num_workers=config.num_workers,
+        pin_memory=config.pin_memory,
+        shuffle=shuffle,
+    )
+    print("samples -", len(loader.dataset))
+    return loader
@@ -6,10 +6,19 @@ import h5py
 import numpy as np
 import torch
 from torch._C import dtype
-from torch.utils.data import Dataset, dataset
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    SequentialSampler,
+    dataset,
+)
+from torch.utils.data.dataloader import default_collate
 
 from processing import preprocess, translate_and_project
 from datasets.h36m_utils import H36M_NAMES, ACTION_NAMES
+from datasets.cache import NpyCache
 from datasets.skeleton import Skeleton
 
 
@@ -93,6 +102,97 @@ class Occlude(object):
         return val, miss_idx
 
 
+class BatchCompose(object):
+    """Composes batch transforms, the batched counterpart of Compose.
+    Works on collated batches [b, j, 2/3] on any device, so it can run at collate time or after the batch is moved to the device.
+    """
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, batch: Dict[str, torch.Tensor]):
+        for t in self.transforms:
+            batch = t(batch)
+        return batch
+
+
+class BatchFlip(object):
+    def __init__(
+        self,
+        flipped_indices: List[int],
+        p: float = 0.5,
+        generator: Optional[torch.Generator] = None,
+    ) -> None:
+        self.flipped_indices = flipped_indices
+        self.p = p
+        self.generator = generator
+
+    def __call__(self, batch: Dict[str, torch.Tensor]):
+        pose2d = batch["pose2d"]
+        do_flip = torch.rand(len(pose2d), generator=self.generator) < self.p
+        do_flip = do_flip.to(pose2d.device).view(-1, 1, 1)
+
+        batch["pose2d"] = torch.where(do_flip, self.flip(pose2d, self.flipped_indices), pose2d)
+        if "pose3d" in batch.keys():
+            pose3d = batch["pose3d"]
+            batch["pose3d"] = torch.where(do_flip, self.flip(pose3d, self.flipped_indices), pose3d)
+        return batch
+
+    @staticmethod
+    def flip(val: torch.Tensor, flipped_indices):
+        # switch magnitude and direction
+        val = val[:, flipped_indices]
+        val[..., 0] *= -1
+        return val
+
+
+class BatchOcclude(object):
+    def __init__(
+        self,
+        joints: List[str],
+        p: float = 0.0,
+        n_occlude: int = -1,
+        generator: Optional[torch.Generator] = None,
+    ):
+        self.p = p
+        self.n_occlude = n_occlude
+        self.generator = generator
+        self.can_occlude = torch.Tensor(
+            Occlude.get_joints_to_occlude(joints, select_all=False)
+        )
+
+    def __call__(self, batch: Dict[str, torch.Tensor]):
+        pose2d = batch["pose2d"]
+        n_poses, device = len(pose2d), pose2d.device
+        mask = torch.ones_like(pose2d)
+
+        if self.p > 0:
+            do_occlude = torch.rand(n_poses, generator=self.generator) < self.p
+
+            n_occlude = self.n_occlude if self.n_occlude != -1 else 2
+            miss_idx = torch.multinomial(
+                self.can_occlude.expand(n_poses, -1), n_occlude, replacement=False, generator=self.generator
+            )
+            if self.n_occlude == -1:
+                # 1 or 2 joints as in Occlude, occluding the first joint twice is occluding one joint
+                only_one = torch.rand(n_poses, generator=self.generator) < 0.5
+                miss_idx[:, 1] = torch.where(only_one, miss_idx[:, 0], miss_idx[:, 1])
+
+            joint_mask = torch.ones(n_poses, len(self.can_occlude))
+            joint_mask.scatter_(1, miss_idx, 0)
+            joint_mask[~do_occlude] = 1
+
+            mask = mask * joint_mask.to(device).unsqueeze(-1)
+            batch["pose2d"] = pose2d * mask
+
+        batch["mask"] = mask
+        return batch
+
+
+# ids of every pose in the validation data, for the errors per action, subject and camera
+METADATA_KEYS = ["subject", "camera", "subaction", "action"]
+
+
 class H36M(Dataset):
     def __init__(
         self,
@@ -101,7 +201,11 @@ class H36M(Dataset):
         is_train: bool = False,
         all_keys: bool = False,
         p_occlude: float = 0.0,
-        debug: bool = False
+        debug: bool = False,
+        project_dist: float = 10,
+        cache_dir: Optional[str] = None,
+        batch_transforms: bool = False,
+        generator: Optional[torch.Generator] = None,
     ):
         """H36M dataset
 
@@ -111,6 +215,13 @@ class H36M(Dataset):
             is_train (bool, optional): [description]. Defaults to False.
             all_keys (bool, optional): include all keys. Defaults to False.
             p_occlude (float, optional): emulate missed detection due to occlusion (x,y set to 0). Defaults to 0.0.
+            project_dist (float, optional): distance of the image plane used to scale 2D poses. Defaults to 10.
+            cache_dir (str, optional): dir to cache the preprocessed data as memory mapped .npy files,
+                keyed by the h5 content and preprocessing params. Repeated runs and dataloader workers
+                then map the cache instead of preprocessing and copying the data. Defaults to None.
+            batch_transforms (bool, optional): skip the per sample transforms and apply batched ones in collate,
+                self.batch_transform can also be applied on device. Defaults to False.
+            generator (torch.Generator, optional): rng shared by the batch transforms. Defaults to None, the global rng.
         """
 
         self.is_train = is_train
@@ -119,24 +230,42 @@ class H36M(Dataset):
         h5 = h5py.File(h5_filepath, "r")
 
         if all_keys:
-            self.keys = h5.keys()
+            self.keys = list(h5.keys())
         elif is_train and is_ss:
             self.keys = ["pose2d", "idx"]
-        else:
+        elif is_train:
             self.keys = ["pose2d", "pose3d", "idx"]
+        else:
+            self.keys = ["pose2d", "pose3d", "idx", *METADATA_KEYS]
+
+        missing = [key for key in self.keys if key not in h5]
+        if missing:
+            h5.close()
+            raise KeyError(f"[ERROR]: {h5_filepath} has no {missing}, create it with datasets/h36m_create_dataset.py")
 
         print(f"[INFO]: processing data samples:", end=" ")
 
-        self.data: Dict[str, torch.Tensor] = {}
-        for key in self.keys:
-            val = h5.get(key) if not debug else h5.get(key)[:10]
-            if key in ["pose2d", "pose3d"]:
-                # preprocessing in numpy is easy
-                val = np.array(val) 
-                val = preprocess(val, self.skel.joints, self.skel.root_idx, is_ss=is_ss)
-            self.data[key] = torch.tensor(val, dtype=torch.float32)
+        if cache_dir:
+            params = {
+                "is_ss": is_ss,
+                "project_dist": project_dist,
+                "joints": self.skel.joints,
+                "root_idx": self.skel.root_idx,
+                "debug": debug,
+            }
+            cache = NpyCache(cache_dir, h5_filepath, params)
+            data = cache.get(self.keys, lambda: self.read_h5(h5, self.keys, is_ss, project_dist, debug))
+            # after loading, the maps stay valid even if the files are removed
+            cache.evict_stale()
+        else:
+            data = self.read_h5(h5, self.keys, is_ss, project_dist, debug)
         h5.close()
 
+        # from_numpy shares the memory of the (mapped) arrays, no extra copy
+        self.data: Dict[str, torch.Tensor] = {
+            key: torch.from_numpy(val) for key, val in data.items()
+        }
+
         print(len(self.data['idx']))
 
         if self.is_train:
@@ -146,25 +275,104 @@ class H36M(Dataset):
                     Occlude(self.skel.joints_15, p=0, n_occlude=-1),
                 ]
             )
+            self.batch_transform = BatchCompose(
+                [
+                    BatchFlip(self.skel.flipped_indices, p=0.5, generator=generator),
+                    BatchOcclude(self.skel.joints_15, p=0, n_occlude=-1, generator=generator),
+                ]
+            )
         else:
             self.transform = Compose(
                 [
                     Occlude(self.skel.joints_15, p=p_occlude, n_occlude=-1),
                 ]
             )
+            self.batch_transform = BatchCompose(
+                [
+                    BatchOcclude(self.skel.joints_15, p=p_occlude, n_occlude=-1, generator=generator),
+                ]
+            )
+
+        self.batch_transforms = batch_transforms
         
         assert(is_ss or not p_occlude) # no occlusion for supervised
 
+    def read_h5(
+        self, h5: h5py.File, keys: List[str], is_ss: bool, project_dist: float, debug: bool
+    ) -> Dict[str, np.ndarray]:
+        data = {}
+        for key in keys:
+            val = h5.get(key)[:] if not debug else h5.get(key)[:10]
+            if key in ["pose2d", "pose3d"]:
+                # preprocessing in numpy is easy
+                val = preprocess(
+                    val, self.skel.joints, self.skel.root_idx, is_ss=is_ss,
+                    project_dist=project_dist, inplace=True,
+                )
+            data[key] = np.ascontiguousarray(val, dtype=np.float32)
+        return data
+
     def __len__(self):
         return len(self.data["idx"])
 
     def __getitem__(self, idx):
+        if isinstance(idx, (list, torch.Tensor)):
+            return self.get_batch(idx)
+
         sample = {}
         for key in self.keys:
             sample[key] = self.data[key][idx]
-        sample.update(self.transform(sample["pose2d"], sample.get("pose3d")))
+        if not self.batch_transforms:
+            sample.update(self.transform(sample["pose2d"], sample.get("pose3d")))
         return sample
 
+    def get_batch(self, idx: Union[List[int], torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """gather a whole batch with one index per key and transform it at once"""
+        idx = torch.as_tensor(idx)
+        batch = {key: self.data[key][idx] for key in self.keys}
+        return self.batch_transform(batch)
+
+    def collate(self, samples: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        """collate_fn for batch_transforms, transforms the whole batch at once"""
+        return self.batch_transform(default_collate(samples))
+
+
+def fast_loader(
+    dataset: H36M,
+    batch_size: int,
+    shuffle: bool = False,
+    drop_last: bool = False,
+    generator: Optional[torch.Generator] = None,
+    **kwargs,
+) -> DataLoader:
+    """DataLoader that samples batches of indices instead of single samples.
+    Each batch is a single gather from the in memory tensors (H36M.get_batch) followed by the batch transforms,
+    no per sample __getitem__ or default_collate.
+
+    Args:
+        dataset (H36M): dataset to load from
+        batch_size (int): number of samples per batch
+        shuffle (bool, optional): draw a new random permutation every epoch. Defaults to False.
+        drop_last (bool, optional): drop the last incomplete batch. Defaults to False.
+        generator (torch.Generator, optional): rng for the permutation. Defaults to None.
+        kwargs: passed on to DataLoader, e.g num_workers, pin_memory
+
+    Returns:
+        DataLoader: yields dict batches as the default loader
+    """
+    if shuffle:
+        sampler = RandomSampler(dataset, generator=generator)
+    else:
+        sampler = SequentialSampler(dataset)
+
+    # batch_size=None disables auto collation, the dataset gets the list of indices
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last),
+        batch_size=None,
+        **kwargs,
+    )
+
 
 if __name__ == "__main__":
     """
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from typing import Any, Callable, Dict, Iterable
+
+import numpy as np
+
+
+def file_hash(filepath: str, chunk_size: int = 1 << 20) -> str:
+    """sha1 of the file content"""
+    sha = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_hash(filepath: str, cache_dir: str) -> str:
+    """sha1 of the file content, remembered in [cache_dir]/hashes.json by path, size and mtime
+    so that large files are only read again after they change"""
+    stat = os.stat(filepath)
+    stamp = f"{os.path.abspath(filepath)}:{stat.st_size}:{stat.st_mtime_ns}"
+    index_path = os.path.join(cache_dir, "hashes.json")
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = {}
+
+    if stamp not in index:
+        index[stamp] = file_hash(filepath)
+        # other processes may write the index too, replace it atomically
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, index_path)
+    return index[stamp]
+
+
+def params_hash(params: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class NpyCache:
+    """Contiguous on disk copy of the preprocessed dataset arrays, one .npy file per key.
+
+    Arrays are memory mapped when loaded, so the dataset and every dataloader worker
+    share the same page cache instead of holding their own copy of the data.
+    Entries are stored as [cache_dir]/[source name]_[params hash]_[data hash]/[key].npy.
+    Entries with other params (eg. debug, is_ss) are kept, an entry with the same params
+    but older data of the source is stale and removed by evict_stale.
+    """
+
+    def __init__(self, cache_dir: str, source: str, params: Dict[str, Any]) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.name = os.path.splitext(os.path.basename(source))[0]
+        self.params = params
+        self.params_key = params_hash(params)[:8]
+        self.data_key = source_hash(source, cache_dir)[:8]
+        self.path = os.path.join(cache_dir, f"{self.name}_{self.params_key}_{self.data_key}")
+
+    def filepath(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.npy")
+
+    def exists(self, keys: Iterable[str]) -> bool:
+        return all(os.path.exists(self.filepath(key)) for key in keys)
+
+    def save(self, data: Dict[str, np.ndarray]) -> None:
+        """write arrays as float32, through a temp file so a crash never leaves a partial cache"""
+        os.makedirs(self.path, exist_ok=True)
+        for key, val in data.items():
+            tmp_path = self.filepath(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(val, dtype=np.float32))
+            os.replace(tmp_path, self.filepath(key))
+
+        # only for reference, the key already covers the params
+        with open(os.path.join(self.path, "params.json"), "w") as f:
+            json.dump(self.params, f, indent=2)
+
+    def load(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        # copy-on-write maps are writable, so torch can wrap them without a copy
+        return {key: np.load(self.filepath(key), mmap_mode="c") for key in keys}
+
+    def get(self, keys: Iterable[str], build: Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """cached arrays of keys, built with build() and saved on a miss.
+        An entry removed by another process while in use is built again.
+        """
+        keys = list(keys)
+        for attempt in range(2):
+            try:
+                if not self.exists(keys):
+                    self.save(build())
+                return self.load(keys)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                print(f"[WARNING]: cache {self.path} removed while in use, rebuilding")
+
+    def evict_stale(self) -> None:
+        """remove cached entries of the same source file and params made from older data"""
+        pattern = re.compile(re.escape(f"{self.name}_{self.params_key}") + r"_[0-9a-f]{8}")
+        for entry in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, entry)
+            if pattern.fullmatch(entry) and path != self.path and os.path.isdir(path):
+                print(f"[INFO]: removing stale cache {path}")
+                shutil.rmtree(path, ignore_errors=True)
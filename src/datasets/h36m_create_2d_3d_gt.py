@@ -1,90 +1,144 @@
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Tuple
 import h5py
 import glob
 import os
-import shutil
 import numpy as np
+import torch
 from src.datasets import h36m_utils as utils
 from src.datasets.common import COMMON_JOINTS
 
 DATA_PATH: str = f"{os.getenv('HOME')}/lab/HPE_datasets/h36m/"
 SUBJECTS: List[int] = [1, 5, 6, 7, 8, 9, 11]
 NUM_CAMS: int = 4
+NUM_WORKERS: int = os.cpu_count() or 1
+OVERWRITE: bool = False  # regenerate outputs even if they are up to date
 
 
 """
 Save all poses as ../h36m/S[subject]/[GT_2D, SH, GT_3D]/[action]_[subaction].[camera_id].h5
-subaction is the suffix for actions 1,2,3 or "" (replaced as 0) 
+subaction is the suffix for actions 1,2,3 or "" (replaced as 0)
 """
 
-print("Using h5s from ", DATA_PATH)
-
-# Convert all subjects from 3D to 2D
-for subject in SUBJECTS:
-    print(f"Creating subject {subject} ...")
-    paths_3d: List[str] = glob.glob(
-        DATA_PATH + f"S{subject}/MyPoses/3D_positions/*.h5")
-
-    # create GT_2D and GT_3D folders in each subject
-    save_dir = DATA_PATH+f"S{subject}/GT_2D/"
-    if os.path.exists(save_dir):
-        print("2D dir already exists, overwriting")
-        shutil.rmtree(save_dir)
-    os.mkdir(save_dir)
-
-    save_dir = save_dir.replace("GT_2D", "GT_3D")
-    if os.path.exists(save_dir):
-        print("3D dir already exists, overwriting")
-        shutil.rmtree(save_dir)
-    os.mkdir(save_dir)
-
-    for path in paths_3d:
-        h5 = h5py.File(path, 'r')
+
+def output_paths(path: str, camera: int) -> Tuple[str, str]:
+    # save 2D GTs in separate folder
+    path_2d = path.replace("MyPoses/3D_positions", "GT_2D")
+    # h5s consistent with SH filenames ../Direction 1.h5 -> ../Directions_1.h5
+    path_2d = path_2d.replace(" ", '_')
+    # append camera id ../Direction_1.h5 -> ../Directions_1.58860488.h5
+    path_2d = path_2d.replace('.h5', f".{utils.camera_num_to_id(camera)}.h5")
+    # 3D poses in camera coordinates instead of world
+    path_3d = path_2d.replace("GT_2D", "GT_3D")
+    return path_2d, path_3d
+
+
+def is_up_to_date(path: str, outputs: List[str]) -> bool:
+    """outputs exist and are newer than the source 3D h5"""
+    mtime = os.path.getmtime(path)
+    return all(os.path.exists(out) and os.path.getmtime(out) >= mtime for out in outputs)
+
+
+def save_poses(path: str, poses: np.ndarray) -> None:
+    # write to a temp file so an interrupted run is redone on resume
+    tmp_path = path + ".tmp"
+    with h5py.File(tmp_path, 'w') as h5:
+        h5['poses'] = poses
+    os.replace(tmp_path, path)
+
+
+def project_cameras(subject: int, poses_3d: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Transform world coordinates to all camera coordinates and project to the image planes in one batched call
+
+    Args:
+        subject (int): subject id for the camera extrinsics
+        poses_3d (np.ndarray): poses in world coordinates [n, j, 3]
+
+    Returns:
+        Tuple: 2D poses [cams, n, j, 2] and 3D poses in camera coordinates [cams, n, j, 3]
+    """
+    cameras = range(1, NUM_CAMS+1)
+    R = np.stack([utils.get_extrinsic(subject, camera, param='orientation') for camera in cameras])
+    t = np.stack([utils.get_extrinsic(subject, camera, param='translation') for camera in cameras])
+    R = torch.from_numpy(R.astype('float32'))
+    t = torch.from_numpy(t.astype('float32'))
+    # t = t/1000 # to meters
+    projection_params = torch.from_numpy(
+        np.stack([utils.get_projection_params(camera) for camera in cameras]))
+
+    X = torch.from_numpy(poses_3d)
+
+    # world_to_camera for all cameras [cams, n, j, 3]
+    Rt = utils.qinverse(R)  # Invert rotation
+    Rt = Rt.view(NUM_CAMS, 1, 1, 4).expand(NUM_CAMS, *X.shape[:-1], 4)
+    poses_3d_cam = utils.qrot(Rt, X.unsqueeze(0) - t.view(NUM_CAMS, 1, 1, 3))
+
+    # Project to image plane
+    poses_2d = utils.project_to_2d(poses_3d_cam, projection_params)
+
+    # Transform to pixel/image coordinates
+    # res_w = utils.get_intrinsic(camera, param='res_w')
+    # res_h = utils.get_intrinsic(camera, param='res_h')
+    # poses_2d = utils.image_coordinates(
+    #     poses_2d, w=res_w, h=res_h)
+
+    return poses_2d.numpy(), poses_3d_cam.numpy()
+
+
+def process_file(subject: int, path: str) -> List[str]:
+    """For a 3D h5 create 2D and camera 3D h5s from all 4 cameras"""
+    outputs = [p for camera in range(1, NUM_CAMS+1) for p in output_paths(path, camera)]
+    if not OVERWRITE and is_up_to_date(path, outputs):
+        return []
+
+    with h5py.File(path, 'r') as h5:
         poses_3d = np.array(h5['3D_positions'])
-        poses_3d = poses_3d.reshape(32, 3, -1).transpose(2, 0, 1)
-        # poses_3d /= 1000  # to meters
-        poses_3d = poses_3d.astype('float32')
-        
-        poses_3d = utils.extract_joints(poses_3d, COMMON_JOINTS, h36m_config=True)
-
-        # For each 3D h5 create 2D h5 from all 4 cameras
-        for camera in range(1, NUM_CAMS+1):
-            # Transform world coordinates to camera coordinates
-            R = utils.get_extrinsic(subject, camera, param='orientation')
-            t = utils.get_extrinsic(subject, camera, param='translation')
-            R = np.array(R, dtype='float32')
-            t = np.array(t, dtype='float32')  
-            # t = t/1000 # to meters
-
-            poses_3d_cam = utils.world_to_camera(poses_3d, R, t)
-            # Project to image plane
-            projection_params = utils.get_projection_params(camera)
-            poses_2d = utils.wrap(utils.project_to_2d, poses_3d_cam,
-                                  projection_params, unsqueeze=True)
-
-            # Transform to pixel/image coordinates 
-            # res_w = utils.get_intrinsic(camera, param='res_w')
-            # res_h = utils.get_intrinsic(camera, param='res_h')
-            # poses_2d = utils.image_coordinates(
-            #     poses_2d, w=res_w, h=res_h)
-
-            # save 2D GTs in separate folder
-            path_2d = path.replace("MyPoses/3D_positions", "GT_2D")
-            # h5s consistent with SH filenames ../Direction 1.h5 -> ../Directions_1.h5
-            path_2d = path_2d.replace(" ", '_')
-            # append camera id ../Direction_1.h5 -> ../Directions_1.58860488.h5
-            path_2d = path_2d.replace('.h5',
-                                      f".{utils.camera_num_to_id(camera)}.h5")
-
-            # Saving as ../S[subject]/[GT_2D, SH, GT_3D]/[action]_[subaction].[camera_id].h5
-            h5 = h5py.File(path_2d, 'w')
-            h5['poses'] = poses_2d
-            h5.close()
-            print(f"saved! {path_2d}")
-
-            # save 3D poses in camera coordinates instead of world
-            path_3d = path_2d.replace("GT_2D", "GT_3D")
-            h5 = h5py.File(path_3d, 'w')
-            h5['poses'] = poses_3d_cam
-            h5.close()
-            print(f"saved! {path_3d}")
+    poses_3d = poses_3d.reshape(32, 3, -1).transpose(2, 0, 1)
+    # poses_3d /= 1000  # to meters
+    poses_3d = poses_3d.astype('float32')
+
+    poses_3d = utils.extract_joints(poses_3d, COMMON_JOINTS, h36m_config=True)
+    poses_3d = np.ascontiguousarray(poses_3d)
+
+    poses_2d, poses_3d_cam = project_cameras(subject, poses_3d)
+
+    # Saving as ../S[subject]/[GT_2D, SH, GT_3D]/[action]_[subaction].[camera_id].h5
+    for camera in range(1, NUM_CAMS+1):
+        path_2d, path_3d = output_paths(path, camera)
+        save_poses(path_2d, poses_2d[camera-1])
+        save_poses(path_3d, poses_3d_cam[camera-1])
+
+    return outputs
+
+
+def init_worker():
+    # parallelism comes from the processes
+    torch.set_num_threads(1)
+
+
+def main():
+    print("Using h5s from ", DATA_PATH)
+
+    tasks = []
+    for subject in SUBJECTS:
+        # create GT_2D and GT_3D folders in each subject, existing outputs are kept to resume
+        os.makedirs(DATA_PATH+f"S{subject}/GT_2D/", exist_ok=True)
+        os.makedirs(DATA_PATH+f"S{subject}/GT_3D/", exist_ok=True)
+
+        paths_3d: List[str] = glob.glob(
+            DATA_PATH + f"S{subject}/MyPoses/3D_positions/*.h5")
+        tasks += [(subject, path) for path in paths_3d]
+
+    # Convert all subjects from 3D to 2D
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=init_worker) as pool:
+        futures = {pool.submit(process_file, subject, path): path for subject, path in tasks}
+        for future in as_completed(futures):
+            outputs = future.result()
+            if outputs:
+                print(f"saved! {futures[future]} -> {len(outputs)} h5s")
+            else:
+                print(f"up to date, skipped {futures[future]}")
+
+
+if __name__ == "__main__":
+    main()
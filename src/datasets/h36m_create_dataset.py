@@ -1,7 +1,6 @@
 # %%
-from collections import defaultdict
+from typing import Dict, List
 
-from numpy.lib import utils
 from src.datasets.h36m_utils import action_to_id, camera_id_to_num, extract_joints
 from src.datasets.common import COMMON_JOINTS
 import os
@@ -14,6 +13,9 @@ data_path: str = f'{os.getenv("HOME")}/lab/HPE_datasets/h36m/'
 train: bool = True
 type_2d = ["GT_2D", "SH", "SH_FT"][2]
 
+# rows per h5 chunk, datasets grow by appending chunks as the source h5s are read
+chunk_rows: int = 4096
+
 if train:
     subject_list = [1, 5, 6, 7, 8]
     skip_frames = 5
@@ -24,12 +26,37 @@ else:
     skip_frames = 64
     dataset_name = f"h36m_test_{type_2d.lower()}"
 
-dataset = defaultdict(list)
-print(f"Loading {type_2d} h5s from {data_path}")
-
-for subject in subject_list:
-    print(f"Preparing subject {subject} ...")
 
+def create_datasets(h5: h5py.File, n_joints: int) -> Dict[str, h5py.Dataset]:
+    """empty resizable, chunked datasets with the final dtypes"""
+    shapes = {
+        "pose2d": ((n_joints, 2), "float32"),
+        "pose3d": ((n_joints, 3), "float32"),
+        "subject": ((), "int64"),
+        "action": ((), "int64"),
+        "subaction": ((), "int64"),
+        "camera": ((), "int64"),
+        "idx": ((), "int64"),
+    }
+    datasets = {}
+    for key, (shape, dtype) in shapes.items():
+        datasets[key] = h5.create_dataset(
+            key,
+            shape=(0, *shape),
+            maxshape=(None, *shape),
+            chunks=(chunk_rows, *shape),
+            dtype=dtype,
+        )
+    return datasets
+
+
+def append(dataset: h5py.Dataset, values: np.ndarray) -> None:
+    n = dataset.shape[0]
+    dataset.resize(n + len(values), axis=0)
+    dataset[n:] = values
+
+
+def stream_subject(subject: int, datasets: Dict[str, h5py.Dataset]) -> None:
     # ../h36m/S[subject]/[GT_2D, SH, GT_3D]/[action]_[subaction].[camera_id].h5
     paths = glob.glob(data_path + f"S{subject}/{type_2d}/*.h5")
 
@@ -45,44 +72,54 @@ for subject in subject_list:
         if subject == 11 and action == 'Directions' and subaction == 0:
             continue  # corrupt recording
 
-        pose2d_ = np.array(h5py.File(path, 'r')['poses'])
+        # only the frames that are kept are read
+        with h5py.File(path, 'r') as f:
+            pose2d_ = f['poses'][::skip_frames]
 
         if type_2d != 'GT_2D': # GT_2D already in common config
             pose2d_ = extract_joints(pose2d_, COMMON_JOINTS, h36m_config=False)
 
-        pose2d_ = pose2d_.tolist()[::skip_frames]
-        dataset['pose2d'].extend(pose2d_)
-
         # get identical 3D data
         # 3Ds corresponding to available 2Ds are only loaded
         path_3d = path.replace(type_2d, "GT_3D")
-        pose3d_ = np.array(h5py.File(path_3d, 'r')['poses'])
-        pose3d_ = pose3d_.tolist()[::skip_frames]
-        dataset['pose3d'].extend(pose3d_)
+        with h5py.File(path_3d, 'r') as f:
+            pose3d_ = f['poses'][::skip_frames]
+
+        assert len(pose2d_) == len(pose3d_), f"2D and 3D frames differ for {path}"
+        n = len(pose2d_)
+
+        # continue the running index to keep track of order
+        start = datasets['idx'].shape[0]
+        append(datasets['pose2d'], pose2d_)
+        append(datasets['pose3d'], pose3d_)
+        append(datasets['idx'], np.arange(start, start + n))
 
         # metadata - data imp. for analysis and reading images
         # can be used to id the source h5 file
-        dataset['subject'].extend(
-            len(pose2d_)*[subject])
-        dataset['action'].extend(
-            len(pose2d_)*[action_to_id(action)])
-        dataset['subaction'].extend(
-            len(pose2d_)*[subaction])
-        dataset['camera'].extend(
-            len(pose2d_)*[camera_id_to_num(int(camera_id))])
-
-# keep track of order
-dataset['idx'] = [*range(len(dataset['pose2d']))]
-
-print("Total samples ", len(dataset['pose2d']))
-print("Keys ", dataset.keys())
-
-save_path = f"{os.getenv('HOME')}/lab/HPE3D/src/data/{dataset_name}.h5"
-
-h5 = h5py.File(save_path, 'w')
-for key, value in dataset.items():
-    print(key, len(value))
-    h5[key] = value
-h5.close()
-
-print("Saved! ", save_path)
+        append(datasets['subject'], np.full(n, subject))
+        append(datasets['action'], np.full(n, action_to_id(action)))
+        append(datasets['subaction'], np.full(n, subaction))
+        append(datasets['camera'], np.full(n, camera_id_to_num(int(camera_id))))
+
+
+def main(save_path: str) -> None:
+    print(f"Loading {type_2d} h5s from {data_path}")
+
+    # write to a temp file so that a failed run doesnt leave a partial dataset
+    tmp_path = save_path + ".tmp"
+    with h5py.File(tmp_path, 'w') as h5:
+        datasets = create_datasets(h5, len(COMMON_JOINTS))
+
+        for subject in subject_list:
+            print(f"Preparing subject {subject} ...")
+            stream_subject(subject, datasets)
+
+        print("Total samples ", datasets['idx'].shape[0])
+        print("Keys ", list(datasets.keys()))
+
+    os.replace(tmp_path, save_path)
+    print("Saved! ", save_path)
+
+
+if __name__ == "__main__":
+    main(f"{os.getenv('HOME')}/lab/HPE3D/src/data/{dataset_name}.h5")
@@ -0,0 +1,139 @@
+"""
+Helpers for multi process training with DistributedDataParallel, one process per device.
+Every helper falls back to the single process behaviour when no process group is initialized.
+"""
+import os
+from typing import Any, Dict, List
+
+import torch
+import torch.distributed as dist
+from torch import nn
+from torch.nn.parallel import DataParallel, DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
+
+
+def setup(rank: int, world_size: int, backend: str = "gloo", port: int = 29500) -> None:
+    """join the process group of world_size processes on this machine"""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def cleanup() -> None:
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def get_device(rank: int, cuda: bool) -> torch.device:
+    """one gpu per process, or cpu for all of them"""
+    if cuda and torch.cuda.is_available():
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+        return torch.device("cuda", rank % torch.cuda.device_count())
+    return torch.device("cpu")
+
+
+def wrap(model: nn.Module, device: torch.device, sync_bn: bool = False) -> nn.Module:
+    """DistributedDataParallel model, the weights of rank 0 are broadcast to all processes
+
+    Args:
+        model (nn.Module): model already on the device
+        device (torch.device): device of this process
+        sync_bn (bool, optional): BatchNorm statistics over the global batch, cuda only. Defaults to False.
+
+    Returns:
+        nn.Module: wrapped model, or the model itself without a process group
+    """
+    if not is_distributed():
+        return model
+
+    if sync_bn:
+        if device.type == "cuda":
+            model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        else:
+            print("[WARNING]: SyncBatchNorm needs cuda, using per process BatchNorm")
+
+    device_ids = [device.index] if device.type == "cuda" else None
+    return DistributedDataParallel(model, device_ids=device_ids)
+
+
+def unwrap(model: nn.Module) -> nn.Module:
+    """the model inside (Distributed)DataParallel, for its attributes and state dict"""
+    if isinstance(model, (DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def data_loader(dataset: Dataset, batch_size: int, shuffle: bool, **kwargs) -> DataLoader:
+    """DataLoader over this process's shard of the dataset, batch_size is per process"""
+    if not is_distributed():
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+    sampler = DistributedSampler(dataset, shuffle=shuffle)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **kwargs)
+
+
+def set_epoch(loader: DataLoader, epoch: int) -> None:
+    """reshuffle the shards every epoch"""
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def broadcast(obj: Any, src: int = 0) -> Any:
+    """picklable object from the src process to all processes"""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def broadcast_optimizers(optimizers: List[torch.optim.Optimizer]) -> None:
+    """optimizer states of rank 0 to all processes, eg. after resuming on rank 0"""
+    if not is_distributed():
+        return
+    states: List[Dict] = broadcast([optimizer.state_dict() for optimizer in optimizers])
+    for optimizer, state in zip(optimizers, states):
+        optimizer.load_state_dict(state)
+
+
+class NullLogger:
+    """stands in for the logger on the processes other than rank 0"""
+
+    class run:
+        name = None
+
+    @staticmethod
+    def log(*args, **kwargs):
+        pass
+
+    @staticmethod
+    def watch(*args, **kwargs):
+        pass
+
+    @staticmethod
+    def save(*args, **kwargs):
+        pass
+
+    @staticmethod
+    def update_config(*args, **kwargs):
+        pass
+
+    @staticmethod
+    def finish(*args, **kwargs):
+        pass
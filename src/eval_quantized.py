@@ -0,0 +1,88 @@
+import os
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from dataset import H36M
+from inference import Lifter, load_lifter, quantize
+from processing import post_process
+from utils import PJPE
+
+
+def evaluate(lifter: Lifter, pose2d: torch.Tensor, pose3d: torch.Tensor, batch_size: int):
+    """MPJPE (protocol 1) and PA-MPJPE (protocol 2) of the lifter on the given poses"""
+    recon = lifter.predict(pose2d, batch_size)
+
+    recon_p1, target_p1 = post_process(recon, pose3d, procrustes=False)
+    recon_p2, target_p2 = post_process(recon, pose3d, procrustes=True)
+
+    mpjpe = torch.mean(PJPE(recon_p1, target_p1)).item()
+    pa_mpjpe = torch.mean(PJPE(recon_p2, target_p2)).item()
+    return mpjpe, pa_mpjpe
+
+
+def throughput(lifter: Lifter, pose2d: torch.Tensor, batch_size: int, n_iters: int) -> float:
+    """poses per second of forward passes with full batches"""
+    batch = pose2d[:batch_size]
+
+    with torch.inference_mode():
+        lifter(batch)  # warm up
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            lifter(batch)
+        elapsed = time.perf_counter() - start
+
+    return n_iters * len(batch) / elapsed
+
+
+def main():
+    parser = get_argparser()
+    opt = parser.parse_args()
+    if opt.num_threads:
+        torch.set_num_threads(opt.num_threads)
+
+    fp32 = load_lifter(opt.ckpt, opt.latent_dim, device="cpu")
+    int8 = quantize(fp32)
+
+    val_data = H36M(opt.test_file, is_train=False, debug=False, cache_dir=opt.cache_dir)
+    pose2d, pose3d = val_data.data["pose2d"], val_data.data["pose3d"]
+
+    results = {}
+    for name, lifter in (("fp32", fp32), ("int8", int8)):
+        mpjpe, pa_mpjpe = evaluate(lifter, pose2d, pose3d, opt.batch_size)
+        poses_per_sec = throughput(lifter, pose2d, opt.batch_size, opt.n_iters)
+        results[name] = (mpjpe, pa_mpjpe, poses_per_sec)
+        print(f"{name}: \tMPJPE: {mpjpe:.2f} \tPA-MPJPE: {pa_mpjpe:.2f} \tposes/s: {poses_per_sec:.0f}")
+
+    print(
+        f"int8 - fp32: \tMPJPE: {results['int8'][0] - results['fp32'][0]:+.2f}",
+        f"\tPA-MPJPE: {results['int8'][1] - results['fp32'][1]:+.2f}",
+        f"\tspeedup: {results['int8'][2] / results['fp32'][2]:.2f}x",
+    )
+
+
+def get_argparser():
+    parser = ArgumentParser()
+
+    # fmt: off
+    parser.add_argument('--ckpt', required=True, type=str,
+                        help='path to the VAEGAN checkpoint')
+    parser.add_argument('--latent_dim', default=51, type=int,
+                        help='dimensions of the latent space of the checkpoint')
+    parser.add_argument('--test_file', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/h36m_test_sh.h5', type=str,
+                        help='abs path to validation data file')
+    parser.add_argument('--cache_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/cache', type=str,
+                        help='dir to cache preprocessed data as memory mapped .npy files, "" to disable')
+    parser.add_argument('--batch_size', default=256, type=int,
+                        help='serving batch size for the throughput')
+    parser.add_argument('--n_iters', default=100, type=int,
+                        help='forward passes to measure the throughput')
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help='cpu threads, 0 to keep the torch default')
+    # fmt: on
+    return parser
+
+
+if __name__ == "__main__":
+    main()
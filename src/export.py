@@ -0,0 +1,100 @@
+import copy
+import os
+from argparse import ArgumentParser
+
+import torch
+
+from dataset import H36M
+from inference import Lifter, load_lifter
+from models import fuse_for_inference
+
+
+def export_torchscript(lifter: Lifter, example: torch.Tensor, path: str) -> torch.jit.ScriptModule:
+    traced = torch.jit.trace(lifter, example)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+    print(f"[INFO]: Saved TorchScript {path}")
+    return traced
+
+
+def export_onnx(lifter: Lifter, example: torch.Tensor, path: str, opset: int) -> None:
+    torch.onnx.export(
+        lifter,
+        example,
+        path,
+        input_names=["pose2d"],
+        output_names=["pose3d"],
+        dynamic_axes={"pose2d": {0: "n"}, "pose3d": {0: "n"}},
+        opset_version=opset,
+    )
+    print(f"[INFO]: Saved ONNX {path}")
+
+
+def check_parity(eager: Lifter, traced: torch.jit.ScriptModule, onnx_path: str, pose2d: torch.Tensor, atol: float) -> bool:
+    """compare the exported models against the eager model on the same 2D poses"""
+    with torch.no_grad():
+        expected = eager(pose2d)
+        outputs = {"torchscript": traced(pose2d)}
+
+    try:
+        import onnxruntime as ort
+
+        session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+        outputs["onnx"] = torch.from_numpy(session.run(None, {"pose2d": pose2d.numpy()})[0])
+    except ImportError:
+        print("[WARNING]: onnxruntime not installed, skip ONNX parity check")
+
+    passed = True
+    for name, output in outputs.items():
+        max_diff = (output - expected).abs().max().item()
+        print(f"[INFO]: {name} vs eager on {len(pose2d)} poses - max abs diff: {max_diff:.2e}")
+        passed = passed and max_diff <= atol
+
+    return passed
+
+
+def main():
+    parser = get_argparser()
+    opt = parser.parse_args()
+    os.makedirs(opt.out_dir, exist_ok=True)
+
+    # export runs on cpu, the serving target
+    eager = load_lifter(opt.ckpt, opt.latent_dim, device="cpu")
+    fused = fuse_for_inference(copy.deepcopy(eager)).eval()
+    example = torch.zeros(2, eager.n_joints, 2)
+
+    name = os.path.splitext(os.path.basename(opt.ckpt))[0]
+    onnx_path = f"{opt.out_dir}/{name}.onnx"
+    traced = export_torchscript(fused, example, f"{opt.out_dir}/{name}.ts.pt")
+    export_onnx(fused, example, onnx_path, opt.opset)
+
+    val_data = H36M(opt.test_file, is_train=False, debug=False)
+    pose2d = val_data.data["pose2d"][: opt.n_samples]
+    if not check_parity(eager, traced, onnx_path, pose2d, opt.atol):
+        print(f"[WARNING]: exported models differ from the eager model by more than {opt.atol}")
+
+
+def get_argparser():
+    parser = ArgumentParser()
+
+    # fmt: off
+    parser.add_argument('--ckpt', required=True, type=str,
+                        help='path to the VAEGAN checkpoint to export')
+    parser.add_argument('--latent_dim', default=51, type=int,
+                        help='dimensions of the latent space of the checkpoint')
+    parser.add_argument('--out_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/exports', type=str,
+                        help='dir to save the TorchScript and ONNX models')
+    parser.add_argument('--opset', default=12, type=int,
+                        help='ONNX opset version')
+    parser.add_argument('--test_file', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/h36m_test_sh.h5', type=str,
+                        help='abs path to validation data file for the parity check')
+    parser.add_argument('--n_samples', default=10000, type=int,
+                        help='number of validation poses to check parity on')
+    parser.add_argument('--atol', default=1e-4, type=float,
+                        help='max abs difference allowed between exported and eager outputs')
+    # fmt: on
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import copy
+from argparse import ArgumentParser
+from typing import Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from datasets.skeleton import Skeleton
+from models import LBAD, FusedLBAD, Generator, fuse_for_inference
+from processing import preprocess
+
+
+class Lifter(nn.Module):
+    """Deterministic 2D to 3D path of the Generator, Encoder2D -> mean latent -> Decoder3D.
+    No sampling, losses or discriminator - for evaluation and serving.
+    """
+
+    def __init__(self, generator: Generator, project_dist: float = 10):
+        super().__init__()
+        self.encoder = generator.encoder
+        self.decoder = generator.decoder
+        self.n_joints = generator.n_joints
+        self.project_dist = project_dist
+        self.skel = Skeleton()
+        self.eval()
+
+    def forward(self, pose2d: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            pose2d (torch.Tensor): preprocessed 2D poses w/o root [n, 15, 2]
+
+        Returns:
+            torch.Tensor: root relative 3D poses w/o root [n, 15, 3]
+        """
+        mean, logvar = self.encoder(pose2d)
+        z = Generator.reparameterize(mean, logvar, is_eval=True)
+        recon = self.decoder(z)
+        return recon.view(-1, self.n_joints, 3)
+
+    def predict(self, pose2d: torch.Tensor, batch_size: int = 8192) -> torch.Tensor:
+        """forward preprocessed 2D poses [n, 15, 2] of any length in fixed size chunks"""
+        self.eval()
+        with torch.inference_mode():
+            return torch.cat(
+                [self(chunk) for chunk in torch.split(pose2d, batch_size)], dim=0
+            )
+
+    def lift(
+        self,
+        poses2d: Union[np.ndarray, torch.Tensor],
+        batch_size: int = 8192,
+        add_root: bool = True,
+    ) -> Union[np.ndarray, torch.Tensor]:
+        """Lift 2D poses of any length to 3D in fixed size chunks
+
+        Args:
+            poses2d (np.ndarray or torch.Tensor): 2D poses in the dataset joint order [n, 16, 2],
+                each pose is scaled by its own torso length, so its 3D pose does not depend on the rest of the input.
+            batch_size (int, optional): poses per forward pass. Defaults to 8192.
+            add_root (bool, optional): add the root joint at origin, [n, 16, 3] instead of [n, 15, 3]. Defaults to True.
+
+        Returns:
+            np.ndarray or torch.Tensor: root relative 3D poses, same type as the input
+        """
+        is_numpy = isinstance(poses2d, np.ndarray)
+        # quantized lifters have no float parameters left and are cpu only
+        param = next(self.parameters(), None)
+        device = param.device if param is not None else torch.device("cpu")
+
+        poses2d = torch.as_tensor(poses2d, dtype=torch.float32).to(device)
+        poses2d = preprocess(
+            poses2d, self.skel.joints, self.skel.root_idx,
+            is_ss=True, project_dist=self.project_dist, per_pose=True,
+        )
+
+        recon = self.predict(poses2d, batch_size)
+
+        if add_root:
+            recon = torch.cat(
+                (recon[:, : self.skel.root_idx], recon.new_zeros(len(recon), 1, 3), recon[:, self.skel.root_idx :]),
+                dim=1,
+            )
+
+        return recon.cpu().numpy() if is_numpy else recon
+
+
+def quantize(lifter: Lifter) -> Lifter:
+    """Dynamic int8 quantization of all the Linear layers, for CPU inference.
+    BatchNorm is folded into the Linear layers first so that the whole block is quantized.
+
+    Args:
+        lifter (Lifter): fp32 lifter, left unchanged
+
+    Returns:
+        Lifter: quantized copy on cpu
+    """
+    lifter = fuse_for_inference(copy.deepcopy(lifter).cpu()).eval()
+    return torch.quantization.quantize_dynamic(lifter, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_lifter(
+    ckpt_path: str,
+    latent_dim: int = 51,
+    project_dist: float = 10,
+    device: Union[str, torch.device] = "cpu",
+    quantized: bool = False,
+    fused_blocks: bool = False,
+) -> Lifter:
+    """Lifter from a VAEGAN (train_pl.py) checkpoint, only the generator weights are loaded
+
+    Args:
+        ckpt_path (str): path to the lightning checkpoint
+        latent_dim (int, optional): latent dim the model was trained with. Defaults to 51.
+        project_dist (float, optional): distance of the image plane used in training. Defaults to 10.
+        device (str, optional): Defaults to "cpu".
+        quantized (bool, optional): dynamic int8 quantized model, cpu only. Defaults to False.
+        fused_blocks (bool, optional): build the generator with FusedLBAD blocks. Defaults to False.
+
+    Returns:
+        Lifter: in eval mode on the device
+    """
+    assert not quantized or str(device) == "cpu", "quantized inference is cpu only"
+
+    state = torch.load(ckpt_path, map_location=device)
+    state_dict = state.get("state_dict", state)
+    state_dict = {
+        key[len("generator."):]: val
+        for key, val in state_dict.items()
+        if key.startswith("generator.")
+    }
+
+    generator = Generator(latent_dim, block=FusedLBAD if fused_blocks else LBAD)
+    generator.load_state_dict(state_dict)
+    print(f"[INFO]: Loaded generator from {ckpt_path}")
+
+    lifter = Lifter(generator, project_dist).to(device)
+    return quantize(lifter) if quantized else lifter
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--ckpt', required=True, type=str,
+                        help='path to the VAEGAN checkpoint')
+    parser.add_argument('--input', required=True, type=str,
+                        help='.npy file with 2D poses [n, 16, 2]')
+    parser.add_argument('--output', required=True, type=str,
+                        help='.npy file to save the 3D poses [n, 16, 3]')
+    parser.add_argument('--latent_dim', default=51, type=int,
+                        help='dimensions of the latent space of the checkpoint')
+    parser.add_argument('--batch_size', default=8192, type=int,
+                        help='number of poses per forward pass')
+    parser.add_argument('--gpu', default=True, type=lambda x: (str(x).lower() == 'true'),
+                        help='enable gpu if available')
+    parser.add_argument('--quantized', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='dynamic int8 quantized inference on cpu')
+    parser.add_argument('--fused_blocks', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='use FusedLBAD blocks, same weights with fewer kernels')
+    args = parser.parse_args()
+
+    device = "cuda" if args.gpu and torch.cuda.is_available() and not args.quantized else "cpu"
+    lifter = load_lifter(
+        args.ckpt, args.latent_dim, device=device, quantized=args.quantized, fused_blocks=args.fused_blocks
+    )
+    poses3d = lifter.lift(np.load(args.input), batch_size=args.batch_size)
+    np.save(args.output, poses3d)
+    print(f"[INFO]: Saved {len(poses3d)} 3D poses to {args.output}")
@@ -0,0 +1,210 @@
+"""
+Experiment loggers with the wandb calls used in the repo - log, watch, save, Image and run.name,
+a local file based one for offline runs and a wandb adapter. Metric buffering and local sinks.
+"""
+import glob
+import json
+import os
+import time
+from typing import Any, Dict, Union
+
+import torch
+
+
+class MetricBuffer:
+    """Sums of scalar metrics kept on their device, read with a single sync when the means are taken"""
+
+    def __init__(self):
+        self.sums: Dict[str, Union[torch.Tensor, float]] = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, metrics: Dict[str, Union[torch.Tensor, float]]) -> None:
+        for key, val in metrics.items():
+            if isinstance(val, torch.Tensor):
+                val = val.detach().float()
+            self.sums[key] = self.sums[key] + val if key in self.sums else val
+        self.count += 1
+
+    def means(self) -> Dict[str, float]:
+        """means since the last call, the buffer is emptied"""
+        tensors = {key: val for key, val in self.sums.items() if isinstance(val, torch.Tensor)}
+        means = {key: val / self.count for key, val in self.sums.items() if key not in tensors}
+        if tensors:
+            # one device to host copy for all the metrics
+            values = torch.stack([val.reshape(()) for val in tensors.values()]).cpu() / self.count
+            means.update(zip(tensors.keys(), values.tolist()))
+        self.sums = {}
+        self.count = 0
+        return means
+
+
+class JsonlSink:
+    def __init__(self, path: str):
+        """a json line per flush with the step, time and metrics"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+
+    def write(self, step: int, metrics: Dict[str, float]) -> None:
+        self.file.write(json.dumps({"step": step, "time": time.time(), **metrics}) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class TensorBoardSink:
+    def __init__(self, log_dir: str):
+        """scalars for tensorboard, needs the tensorboard package"""
+        from torch.utils.tensorboard import SummaryWriter
+
+        self.writer = SummaryWriter(log_dir)
+
+    def write(self, step: int, metrics: Dict[str, float]) -> None:
+        for key, val in metrics.items():
+            self.writer.add_scalar(key, val, step)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def config_snapshot(config) -> Dict[str, Any]:
+    """argparse config as json values, objects added at runtime (logger, profiler) are left out"""
+    snapshot = {}
+    for key, val in vars(config).items():
+        if key in ("logger", "profiler"):
+            continue
+        if not isinstance(val, (bool, int, float, str, list, tuple, type(None))):
+            val = str(val)
+        snapshot[key] = val
+    return snapshot
+
+
+class Image:
+    """image to log, a tensor [(1), c, h, w] in [0, 1] or a PIL image"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def save(self, path: str) -> None:
+        if isinstance(self.data, torch.Tensor):
+            from torchvision.utils import save_image
+
+            save_image(self.data.detach().cpu().float(), path)
+        else:
+            self.data.save(path)
+
+
+class Run:
+    def __init__(self, name: str, dir: str):
+        self.name = name
+        self.dir = dir
+
+
+class LocalLogger:
+    Image = Image
+
+    def __init__(self, root: str, config=None, name: str = None):
+        """Run in [root]/[name] with metrics.jsonl, images in media/, config.json and files.txt with the
+        paths of the saved files. Works offline and starts instantly.
+
+        Args:
+            root (str): directory of all the local runs
+            config (Namespace, optional): config snapshot saved with the run. Defaults to None.
+            name (str, optional): run name, used to id checkpoints. Defaults to local_[date]_[time].
+        """
+        name = name or time.strftime("local_%Y%m%d_%H%M%S")
+        self.run = Run(name, f"{root}/{name}")
+        os.makedirs(f"{self.run.dir}/media", exist_ok=True)
+        self.file = open(f"{self.run.dir}/metrics.jsonl", "a")
+        self.step = 0
+        self.pending = {}
+        if config is not None:
+            self.update_config(config)
+        print(f"[INFO]: Logging locally to {self.run.dir}")
+
+    def log(self, data: Dict, commit: bool = True) -> None:
+        """nested dicts are flattened to keys joined by /, steps are committed as json lines"""
+        self.pending.update(self._flatten(data))
+        if commit:
+            self.file.write(json.dumps({"step": self.step, "time": time.time(), **self.pending}) + "\n")
+            self.file.flush()
+            self.pending = {}
+            self.step += 1
+
+    def _flatten(self, data: Dict, prefix: str = "") -> Dict:
+        flat = {}
+        for key, val in data.items():
+            key = f"{prefix}{key}"
+            if isinstance(val, dict):
+                flat.update(self._flatten(val, f"{key}/"))
+            elif isinstance(val, Image):
+                path = f"{self.run.dir}/media/{key.replace('/', '_')}_{self.step}.png"
+                val.save(path)
+                flat[key] = os.path.relpath(path, self.run.dir)
+            elif isinstance(val, torch.Tensor):
+                val = val.detach().cpu()
+                flat[key] = val.item() if val.numel() == 1 else val.tolist()
+            else:
+                flat[key] = val
+        return flat
+
+    def watch(self, *args, **kwargs) -> None:
+        """weights and gradients are not tracked locally"""
+        pass
+
+    def save(self, pattern: str) -> None:
+        """files are already on disk, their paths are kept with the run"""
+        with open(f"{self.run.dir}/files.txt", "a") as f:
+            for path in glob.glob(pattern):
+                f.write(os.path.abspath(path) + "\n")
+
+    def update_config(self, config) -> None:
+        with open(f"{self.run.dir}/config.json", "w") as f:
+            json.dump(config_snapshot(config), f, indent=2)
+
+    def finish(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+
+class WandbLogger:
+    def __init__(self, config, project: str = "hpe3d", tags: str = None, dryrun: bool = False):
+        """wandb with the LocalLogger interface, wandb is only imported when used"""
+        import wandb
+
+        if tags:
+            os.environ["WANDB_TAGS"] = tags
+        if dryrun:
+            os.environ["WANDB_MODE"] = "dryrun"  # Doesnt auto sync to project
+        wandb.init(anonymous="allow", project=project, config=config_snapshot(config))
+        wandb.run.save()
+
+        self.wandb = wandb
+        self.run = wandb.run
+        self.Image = wandb.Image
+
+    def log(self, *args, **kwargs) -> None:
+        self.wandb.log(*args, **kwargs)
+
+    def watch(self, *args, **kwargs) -> None:
+        self.wandb.watch(*args, **kwargs)
+
+    def save(self, *args, **kwargs) -> None:
+        self.wandb.save(*args, **kwargs)
+
+    def update_config(self, config) -> None:
+        # sync config with wandb for easy experiment comparision
+        self.wandb.config.update(config_snapshot(config), allow_val_change=True)
+
+    def finish(self) -> None:
+        self.wandb.finish()
+
+
+def get_logger(config, tags: str = None, dryrun: bool = False):
+    """logger of config.tracker, local by default"""
+    if config.tracker == "wandb":
+        return WandbLogger(config, tags=tags, dryrun=dryrun)
+    return LocalLogger(config.runs_dir, config)
@@ -0,0 +1,220 @@
+import csv
+import json
+from typing import Dict, List, Optional
+
+import torch
+
+
+class StreamingMetrics:
+    def __init__(self, n_samples: int = 1024, n_worst: int = 2, n_actions: int = 17, keep_pjpe: bool = False):
+        """Pose errors accumulated batch by batch on the device, memory independent of the dataset size.
+
+        Args:
+            n_samples (int, optional): size of the uniform reservoir of samples kept for plots. Defaults to 1024.
+            n_worst (int, optional): samples with the highest error kept for plots. Defaults to 2.
+            n_actions (int, optional): action ids are in [0, n_actions), 2-16 for H36M. Defaults to 17.
+            keep_pjpe (bool, optional): also keep the mean error of every sample [n]. Defaults to False.
+        """
+        self.n_samples = n_samples
+        self.n_worst = n_worst
+        self.n_actions = n_actions
+        self.keep_pjpe = keep_pjpe
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.joint_sum = None  # [j]
+        self.action_sum = None  # [n_actions]
+        self.action_count = None  # [n_actions]
+        self.reservoir: Dict[str, torch.Tensor] = {}
+        self.reservoir_pjpe = None
+        self.reservoir_index = None
+        self.worst: Dict[str, torch.Tensor] = {}
+        self.worst_pjpe = None
+        self.worst_index = None
+        self.pjpe = []
+
+    @torch.no_grad()
+    def update(self, pjpe: torch.Tensor, action: torch.Tensor, samples: Optional[Dict[str, torch.Tensor]] = None):
+        """
+        Args:
+            pjpe (torch.Tensor): per sample per joint error of the batch [b, j]
+            action (torch.Tensor): action id of each sample [b]
+            samples (Dict[str, torch.Tensor], optional): tensors [b, ...] to keep in the reservoir and worst samples
+        """
+        pjpe = pjpe.detach()
+        samples = {key: val.detach() for key, val in (samples or {}).items()}
+        per_sample = pjpe.mean(dim=1)  # [b]
+        action = action.view(-1).long()
+        # position of each sample in the order of the updates, indexes pjpe
+        index = torch.arange(self.count, self.count + len(per_sample), device=per_sample.device)
+
+        if self.joint_sum is None:
+            self.joint_sum = pjpe.new_zeros(pjpe.shape[1], dtype=torch.float64)
+            self.action_sum = pjpe.new_zeros(self.n_actions, dtype=torch.float64)
+            self.action_count = pjpe.new_zeros(self.n_actions, dtype=torch.float64)
+
+        # sums in float64, no precision loss over millions of poses
+        self.joint_sum += pjpe.sum(dim=0, dtype=torch.float64)
+        self.action_sum.index_add_(0, action, per_sample.double())
+        self.action_count.index_add_(0, action, torch.ones_like(per_sample, dtype=torch.float64))
+
+        if self.n_samples:
+            self._update_reservoir(per_sample, index, samples)
+        if self.n_worst:
+            self._update_worst(per_sample, index, samples)
+        if self.keep_pjpe:
+            self.pjpe.append(per_sample)
+
+        self.count += len(per_sample)
+
+    def _update_reservoir(self, per_sample: torch.Tensor, idx: torch.Tensor, samples: Dict[str, torch.Tensor]):
+        """Algorithm R - the i-th sample replaces a random slot with probability n_samples/(i+1).
+        Samples that are not kept go to an extra trash row so that no device sync is needed.
+        """
+        k = self.n_samples
+        if self.reservoir_pjpe is None:
+            self.reservoir_pjpe = per_sample.new_zeros(k + 1)
+            self.reservoir_index = idx.new_zeros(k + 1)
+            for key, val in samples.items():
+                self.reservoir[key] = val.new_zeros(k + 1, *val.shape[1:])
+
+        slots = (torch.rand(len(idx), device=idx.device) * (idx + 1)).long()
+        slots = torch.where(idx < k, idx, slots).clamp(max=k)
+        # the last sample of the batch wins a slot, as when updated one by one
+        pos = torch.arange(len(idx), device=idx.device)
+        winner = torch.full((k + 1,), -1, device=idx.device).scatter_reduce(0, slots, pos, "amax")
+        slots = torch.where(winner[slots] == pos, slots, torch.full_like(slots, k))
+
+        self.reservoir_pjpe[slots] = per_sample
+        self.reservoir_index[slots] = idx
+        for key, val in samples.items():
+            self.reservoir[key][slots] = val
+
+    def _update_worst(self, per_sample: torch.Tensor, idx: torch.Tensor, samples: Dict[str, torch.Tensor]):
+        if self.worst_pjpe is not None:
+            per_sample = torch.cat((self.worst_pjpe, per_sample))
+            idx = torch.cat((self.worst_index, idx))
+            samples = {key: torch.cat((self.worst[key], val)) for key, val in samples.items()}
+
+        top = torch.topk(per_sample, k=min(self.n_worst, len(per_sample))).indices
+        self.worst_pjpe = per_sample[top]
+        self.worst_index = idx[top]
+        self.worst = {key: val[top] for key, val in samples.items()}
+
+    def compute(self) -> Dict:
+        """
+        Returns:
+            Dict: mpjpe (float), per_joint [j], per_action {action: float}, reservoir and worst samples
+                with their errors reservoir_pjpe [<=n_samples] and worst_pjpe [<=n_worst], pjpe [n] if kept.
+                reservoir_index and worst_index are the positions of the kept samples in pjpe.
+        """
+        assert self.count, "no batches to compute the metrics on"
+        per_joint = (self.joint_sum / self.count).float()
+        per_action = self.action_sum / self.action_count.clamp(min=1)
+        present = torch.nonzero(self.action_count).view(-1).tolist()
+
+        n = min(self.count, self.n_samples)
+        return {
+            "mpjpe": per_joint.mean().item(),
+            "per_joint": per_joint,
+            "per_action": {action: per_action[action].item() for action in present},
+            "reservoir": {key: val[:n] for key, val in self.reservoir.items()},
+            "reservoir_pjpe": self.reservoir_pjpe[:n] if self.reservoir_pjpe is not None else None,
+            "reservoir_index": self.reservoir_index[:n] if self.reservoir_index is not None else None,
+            "worst": self.worst,
+            "worst_pjpe": self.worst_pjpe,
+            "worst_index": self.worst_index,
+            "pjpe": torch.cat(self.pjpe) if self.keep_pjpe else None,
+        }
+
+
+class ErrorBreakdown:
+    def __init__(
+        self,
+        n_joints: int,
+        n_actions: int = 17,
+        n_subjects: int = 12,
+        n_cameras: int = 5,
+        joint_names: Optional[List[str]] = None,
+        action_names: Optional[Dict[int, str]] = None,
+    ):
+        """Per joint error of every action x subject x camera cell, accumulated in one index_add_ per batch.
+        Ids are in [0, n_ids), H36M actions are 2-16, subjects 1-11 and cameras 1-4.
+        Coarser tables (per action, subject, camera or joint) are sums over the cells.
+        """
+        self.shape = (n_actions, n_subjects, n_cameras)
+        self.n_joints = n_joints
+        self.joint_names = joint_names or [str(j) for j in range(n_joints)]
+        self.action_names = action_names or {}
+        self.sums = None  # [actions * subjects * cameras, j]
+        self.counts = None  # [actions * subjects * cameras]
+
+    @torch.no_grad()
+    def update(self, pjpe: torch.Tensor, action: torch.Tensor, subject: torch.Tensor, camera: torch.Tensor):
+        """
+        Args:
+            pjpe (torch.Tensor): per sample per joint error [b, j]
+            action, subject, camera (torch.Tensor): ids of each sample [b]
+        """
+        n_actions, n_subjects, n_cameras = self.shape
+        if self.sums is None:
+            self.sums = pjpe.new_zeros(n_actions * n_subjects * n_cameras, self.n_joints, dtype=torch.float64)
+            self.counts = pjpe.new_zeros(n_actions * n_subjects * n_cameras, dtype=torch.float64)
+
+        cell = (action.view(-1).long() * n_subjects + subject.view(-1).long()) * n_cameras + camera.view(-1).long()
+        self.sums.index_add_(0, cell, pjpe.detach().double())
+        self.counts.index_add_(0, cell, cell.new_ones(len(cell), dtype=torch.float64))
+
+    def grid(self):
+        """sums [actions, subjects, cameras, j] and counts [actions, subjects, cameras]"""
+        return self.sums.view(*self.shape, self.n_joints), self.counts.view(self.shape)
+
+    def rows(self) -> List[Dict]:
+        """a row per non empty action, subject, camera cell with the mean error of each joint"""
+        sums, counts = self.grid()
+        means = (sums / counts.clamp(min=1).unsqueeze(-1)).cpu()
+        counts = counts.cpu()
+
+        rows = []
+        for action, subject, camera in torch.nonzero(counts).tolist():
+            per_joint = means[action, subject, camera]
+            row = {
+                "action": self.action_names.get(action, action),
+                "subject": subject,
+                "camera": camera,
+                "count": int(counts[action, subject, camera]),
+                "mpjpe": per_joint.mean().item(),
+            }
+            row.update(zip(self.joint_names, per_joint.tolist()))
+            rows.append(row)
+        return rows
+
+    def summary(self) -> Dict:
+        """overall MPJPE and the errors per action, subject, camera and joint"""
+        sums, counts = self.grid()
+
+        def mean_over(dims):
+            # mean of the per sample error over all the cells with the same index along the kept dim
+            s, c = sums.sum(dim=dims).mean(dim=-1), counts.sum(dim=dims)
+            return {i: (s[i] / c[i]).item() for i in torch.nonzero(c).view(-1).tolist()}
+
+        per_joint = sums.sum(dim=(0, 1, 2)) / counts.sum()
+        return {
+            "count": int(counts.sum()),
+            "mpjpe": per_joint.mean().item(),
+            "per_action": {self.action_names.get(a, a): val for a, val in mean_over((1, 2)).items()},
+            "per_subject": mean_over((0, 2)),
+            "per_camera": mean_over((0, 1)),
+            "per_joint": dict(zip(self.joint_names, per_joint.tolist())),
+        }
+
+    def save(self, path: str) -> None:
+        """[path].csv with the cells and [path].json with the summary"""
+        rows = self.rows()
+        with open(f"{path}.csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["action", "subject", "camera", "count", "mpjpe", *self.joint_names])
+            writer.writeheader()
+            writer.writerows(rows)
+        with open(f"{path}.json", "w") as f:
+            json.dump(self.summary(), f, indent=2)
@@ -2,6 +2,7 @@ from processing import scale_3d
 from typing import Type
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from utils import Mish
 
 class LBAD(nn.Module):
@@ -19,6 +20,7 @@ class LBAD(nn.Module):
         self.dropout = nn.Dropout(p=drop_out_p)
         self.bn1 = nn.BatchNorm1d(neurons)
         self.use_bn = use_bn
+        self.fused = False
         
     def forward(self, x):
         x = self.w1(x)
@@ -28,6 +30,63 @@ class LBAD(nn.Module):
         x = self.dropout(x)
         return x
 
+    def fuse(self):
+        """fold bn1 into w1 and drop dropout, only valid in eval"""
+        if self.use_bn:
+            self.w1 = fuse_linear_bn(self.w1, self.bn1)
+            self.bn1 = nn.Identity()
+            self.use_bn = False
+        self.dropout = nn.Identity()
+        self.fused = True
+
+
+class FusedLBAD(LBAD):
+    """LBAD with the same parameters and state dict, numerically equivalent.
+    Mish runs as a single kernel when torch has it. In eval without grad, bn1 is
+    folded into w1 and cached until its weights change, so Linear+BN+Dropout is a single addmm.
+    Once fused for inference, w1 may be a quantized Linear and is always called as a module.
+    The forward has no data dependent branching and can be traced by torch.compile.
+    """
+
+    def __init__(
+        self,
+        neurons: int,
+        activation: Type[torch.nn.Module],
+        drop_out_p: float,
+        use_bn: bool,
+    ):
+        super(FusedLBAD, self).__init__(neurons, activation, drop_out_p, use_bn)
+        self.name = "FusedLBAD"
+        if activation is Mish and hasattr(nn, "Mish"):
+            self.activ = nn.Mish()
+        self._fused = None
+
+    def forward(self, x):
+        if self.training or torch.is_grad_enabled() or self.fused:
+            return super().forward(x)
+        weight, bias = self.fused_params()
+        return self.activ(F.linear(x, weight, bias))
+
+    def fused_params(self):
+        """weight and bias of w1 with bn1 folded in, recomputed when any of their tensors is replaced or
+        changed in place (optimizer step, load_state_dict, copy_, EMA, broadcast)"""
+        tensors = [self.w1.weight, self.w1.bias]
+        if self.use_bn:
+            bn = self.bn1
+            tensors += [bn.weight, bn.bias, bn.running_mean, bn.running_var]
+        # every in place op bumps the version counter of a tensor
+        key = (self.use_bn, tuple((t.data_ptr(), t._version) for t in tensors if t is not None))
+        if self._fused is None or self._fused[0] != key:
+            linear = fuse_linear_bn(self.w1, self.bn1) if self.use_bn else self.w1
+            bias = linear.bias.detach() if linear.bias is not None else None
+            self._fused = (key, (linear.weight.detach(), bias))
+        return self._fused[1]
+
+    def _apply(self, fn):
+        # .to() swaps the tensors, new storage could reuse an old address
+        self._fused = None
+        return super()._apply(fn)
+
 
 class ResBlock(nn.Module):
     def __init__(
@@ -66,6 +125,7 @@ class Encoder2D(nn.Module):
         activation: Type[torch.nn.Module],
         neurons: int,
         drop_out_p: float,
+        block: Type[LBAD] = LBAD,
     ):
         super(Encoder2D, self).__init__()
         self.name = "Encoder2D"
@@ -78,7 +138,7 @@ class Encoder2D(nn.Module):
             nn.Dropout(p=drop_out_p),
         )
 
-        self.features = ResBlock(LBAD, neurons, activation, drop_out_p)
+        self.features = ResBlock(block, neurons, activation, drop_out_p)
         self.fc_mean = nn.Linear(neurons, latent_dim)
         self.fc_logvar = nn.Linear(neurons, latent_dim)
         # self.enc_out_block = nn.Sequential(
@@ -105,6 +165,7 @@ class Decoder3D(nn.Module):
         activation: Type[torch.nn.Module],
         neurons: int,
         drop_out_p: float,
+        block: Type[LBAD] = LBAD,
     ):
         super(Decoder3D, self).__init__()
         self.name = "Decoder3D"
@@ -116,7 +177,7 @@ class Decoder3D(nn.Module):
             activation(),
             nn.Dropout(p=drop_out_p),
         )
-        self.features = ResBlock(LBAD, neurons, activation, drop_out_p)
+        self.features = ResBlock(block, neurons, activation, drop_out_p)
         self.dec_out_block = nn.Sequential(
             nn.Linear(neurons, 3 * n_joints),
             nn.Tanh()
@@ -139,6 +200,7 @@ class Discriminator(nn.Module):
         activation: Type[torch.nn.Module] = nn.LeakyReLU,
         neurons: int = 1024,
         drop_out_p: float = 0.5,
+        block: Type[LBAD] = LBAD,
     ):
         super(Discriminator, self).__init__()
         self.name = "Discriminator"
@@ -149,8 +211,9 @@ class Discriminator(nn.Module):
             activation(),
             # Shouldnt use BN for Critic input
         )
-        self.features = ResBlock(LBAD, neurons, activation, drop_out_p, use_bn=False)
-        self.out_block = nn.Sequential(nn.Linear(neurons, 1), nn.Sigmoid())
+        self.features = ResBlock(block, neurons, activation, drop_out_p, use_bn=False)
+        # logits, the sigmoid is fused into the loss. same state dict keys as with the sigmoid
+        self.out_block = nn.Sequential(nn.Linear(neurons, 1))
 
     def forward(self, x):
         if not x.is_contiguous():
@@ -170,11 +233,12 @@ class Generator(nn.Module):
         activation: Type[torch.nn.Module] = Mish,
         neurons: int = 1024,
         drop_out_p: float = 0.2,
+        block: Type[LBAD] = LBAD,
     ):
         super(Generator, self).__init__()
         self.n_joints = n_joints
-        self.encoder = Encoder2D(latent_dim, n_joints, activation, neurons, drop_out_p)
-        self.decoder = Decoder3D(latent_dim, n_joints, activation, neurons, drop_out_p)
+        self.encoder = Encoder2D(latent_dim, n_joints, activation, neurons, drop_out_p, block)
+        self.decoder = Decoder3D(latent_dim, n_joints, activation, neurons, drop_out_p, block)
 
     @staticmethod
     def reparameterize(mean, logvar, is_eval=False):
@@ -191,3 +255,51 @@ class Generator(nn.Module):
         z = self.reparameterize(mean, logvar, is_eval=not self.encoder.training)
         recon = self.decoder(z)
         return recon.view(-1, self.n_joints, 3), mean, logvar
+
+
+def fuse_linear_bn(linear: nn.Linear, bn: nn.BatchNorm1d) -> nn.Linear:
+    """Linear followed by BatchNorm1d (with running stats) as a single Linear
+
+    Args:
+        linear (nn.Linear): linear layer, with or without bias
+        bn (nn.BatchNorm1d): batch norm following the linear layer
+
+    Returns:
+        nn.Linear: linear layer with bias, equal to bn(linear(x)) in eval
+    """
+    fused = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    fused = fused.to(linear.weight)
+
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = linear.bias if linear.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(linear.weight * scale.unsqueeze(1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+
+    return fused
+
+
+def fuse_for_inference(module: nn.Module) -> nn.Module:
+    """Fold every BatchNorm1d into the preceding Linear and drop Dropout layers, in place.
+    The result is only equivalent to the module in eval mode.
+
+    Args:
+        module (nn.Module): Generator, Encoder2D, Decoder3D or any module built from them
+
+    Returns:
+        nn.Module: the same module, fused
+    """
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential):
+            layers = []
+            for layer in child:
+                if isinstance(layer, nn.BatchNorm1d) and layers and isinstance(layers[-1], nn.Linear):
+                    layers[-1] = fuse_linear_bn(layers[-1], layer)
+                elif not isinstance(layer, nn.Dropout):
+                    layers.append(fuse_for_inference(layer))
+            setattr(module, name, nn.Sequential(*layers))
+        elif isinstance(child, LBAD):
+            child.fuse()
+        else:
+            fuse_for_inference(child)
+    return module
@@ -4,6 +4,7 @@ Reference code/procedure - https://github.com/una-dinosauria/3d-pose-baseline
 import gc
 import math
 import os
+from functools import lru_cache
 from typing import Dict, List, Tuple, Union
 
 import h5py
@@ -12,25 +13,43 @@ import torch
 from scipy.spatial import procrustes as proc
 
 
-def zero_the_root(poses: np.ndarray, root_idx: int) -> np.ndarray:
+def zero_the_root(
+    poses: Union[np.ndarray, torch.Tensor], root_idx: int, inplace: bool = False
+) -> Union[np.ndarray, torch.Tensor]:
     """move pose such that root/pelvis is at origin
 
     Args:
-        poses (np.ndarray): n poses
+        poses (np.ndarray or torch.Tensor): n poses [n, j, 2/3]
         root_idx (int): index of root(pelvis)
+        inplace (bool, optional): center the given poses in place instead of a copy. Defaults to False.
 
     Returns:
-        poses (np.ndarray) -- poses with root shifted to origin,
+        poses (np.ndarray or torch.Tensor) -- poses with root shifted to origin,
                         w/o root as always 0
     """
     # center at root
-    for i in range(poses.shape[0]):
-        poses[i, :, :] = poses[i, :, :] - poses[i, root_idx, :]
+    root = poses[:, root_idx : root_idx + 1]
+    if inplace:
+        # the root is a view of poses, copy it before it is zeroed
+        root = root.clone() if isinstance(poses, torch.Tensor) else root.copy()
+        poses -= root
+    else:
+        poses = poses - root
 
-    # remove root
-    poses = np.delete(poses, root_idx, 1)  # axis -> [n, j, 2(x,y)]
+    # remove root, only a view if the root is the first joint
+    if root_idx == 0:
+        return poses[:, 1:]
+    keep = [i for i in range(poses.shape[1]) if i != root_idx]
+    return poses[:, keep]  # axis -> [n, j, 2(x,y)]
+
+
+@lru_cache(maxsize=8)
+def _torso_indices(joint_names: Tuple[str, ...]) -> Tuple[List[int], List[int]]:
+    """start and end joints of head-neck, neck-torso, torso-root segments"""
+    start = [joint_names.index(j) for j in ("Head", "Neck", "Torso")]
+    end = [joint_names.index(j) for j in ("Neck", "Torso", "Pelvis")]
+    return start, end
 
-    return poses
 
 def scale_3d(poses):
     # TODO scale such that each poses upper half is of scale 1
@@ -40,22 +59,28 @@ def scale_3d(poses):
     return poses*1.3
 
 def preprocess(
-    poses: np.ndarray,
+    poses: Union[np.ndarray, torch.Tensor],
     joint_names: List[str],
     root_idx: int,
     normalize_pose: bool = True,
     is_ss: bool = True,
     project_dist: float = 10,
-) -> np.ndarray:
+    inplace: bool = False,
+    per_pose: bool = False,
+) -> Union[np.ndarray, torch.Tensor]:
     """Normalize 2D, 3D for supervised or scale 2D for self supervised. Zero poses at root and remove roots.
+    Works with numpy arrays and torch tensors on any device.
 
     Args:
-        poses (np.ndarray): 2D/3D poses 
+        poses (np.ndarray or torch.Tensor): 2D/3D poses 
         joint_names (List[str]): joint names in the order of the points in the dataset - taken care in dataset creation code
         root_idx (int): index of root
         normalize_pose (bool, optional): If supervised. Defaults to True.
         is_ss (bool, optional): True if self supervised training. Defaults to True.
         project_dist (float, optional): Distance of the image plane from camera. A unit 3D pose projected to 2D will be the inverse of this value. Defaults to 10.
+        inplace (bool, optional): scale and center the given poses in place, saves copies of large arrays. Defaults to False.
+        per_pose (bool, optional): scale each 2D pose by its own torso length instead of the mean over all the poses,
+            the result of a pose then does not depend on the others. Defaults to False.
 
     Returns:
         Dict: The dictionary with process pose values
@@ -70,25 +95,9 @@ def preprocess(
 
         # calculate the total distance between the head and the root
         # 2D poses stil have 17 joints
-        head2neck = np.linalg.norm(
-            poses[:, joint_names.index("Head"), :]
-            - poses[:, joint_names.index("Neck"), :],
-            axis=1,
-            keepdims=True,
-        )
-        neck2torso = np.linalg.norm(
-            poses[:, joint_names.index("Neck"), :]
-            - poses[:, joint_names.index("Torso"), :],
-            axis=1,
-            keepdims=True,
-        )
-        torso2root = np.linalg.norm(
-            poses[:, joint_names.index("Torso"), :]
-            - poses[:, joint_names.index("Pelvis"), :],
-            axis=1,
-            keepdims=True,
-        )
-        dist = head2neck + neck2torso + torso2root
+        start, end = _torso_indices(tuple(joint_names))
+        segments = poses[:, start] - poses[:, end]
+        dist = ((segments ** 2).sum(-1) ** 0.5).sum(-1)
 
         # Google's poem scales using lower half
         # head2neck = np.linalg.norm(
@@ -97,11 +106,17 @@ def preprocess(
         #     poses[:,js.index('R_Knee'),:] - poses[:,js.index('R_Ankle'),:], axis=1, keepdims=True)
         # dist = head2neck+neck2torso
 
-        scale_2d = c * np.mean(dist)  # 1/c units
-        poses = np.divide(poses.T, scale_2d.T).T  # type: ignore
+        # 1/c units
+        scale_2d = c * dist[:, None, None] if per_pose else c * dist.mean()
+        if inplace:
+            poses /= scale_2d
+        else:
+            # a new array, safe to modify from here on
+            poses = poses / scale_2d
+            inplace = True
 
     # center the 2d/3d pose at the root and remove the root
-    poses = zero_the_root(poses, root_idx)
+    poses = zero_the_root(poses, root_idx, inplace=inplace)
 
     # do not normalize if ss i.e using gans as normalization is done above by scaling 2d
     if normalize_pose and not is_ss:
@@ -135,19 +150,7 @@ def post_process(
         target = denormalize(target)
 
     if procrustes:
-        # Speed up procrustes alignment with CPU!
-        t, r = target.cpu().numpy(), recon.cpu().numpy()
-
-        aligned = []
-        for t_, r_ in zip(t, r):
-            # recon should be the second matrix
-            _, mtx, _ = proc(t_, r_)
-            mean = np.mean(t_, 0)
-            std = np.linalg.norm(t_ - mean)
-            r_ = (mtx * std) + mean
-            aligned.append(r_)
-
-        recon = torch.from_numpy(np.array(aligned)).float().to(recon.device)
+        recon = batch_procrustes(target, recon)
 
     # since the MPJPE is computed for 17 joints with roots aligned i.e zeroed
     zeros = torch.tensor((0, 0, 0), device=recon.device, dtype=torch.float32).repeat(
@@ -160,6 +163,69 @@ def post_process(
     return recon, target
 
 
+def batch_procrustes(target: torch.Tensor, recon: torch.Tensor) -> torch.Tensor:
+    """Batched procrustes alignment of recon to target, the torch equivalent of
+    scipy.spatial.procrustes applied pose by pose. Runs on the device of the inputs.
+
+    Both poses are centered and scaled to unit frobenius norm, recon is rotated
+    (reflections allowed as in scipy) and scaled onto target and the result is
+    mapped back to the position and scale of the target.
+
+    Args:
+        target (torch.Tensor): ground truth poses [n, j, 3]
+        recon (torch.Tensor): poses to be aligned [n, j, 3]
+
+    Returns:
+        torch.Tensor: aligned recon [n, j, 3]
+    """
+    assert recon.shape == target.shape
+
+    mean_t = target.mean(dim=1, keepdim=True)
+    mean_r = recon.mean(dim=1, keepdim=True)
+    t = target - mean_t
+    r = recon - mean_r
+
+    # frobenius norm of each pose, clamped to avoid nan for degenerate poses
+    norm_t = t.flatten(1).norm(dim=1).clamp(min=1e-12).view(-1, 1, 1)
+    norm_r = r.flatten(1).norm(dim=1).clamp(min=1e-12).view(-1, 1, 1)
+    t = t / norm_t
+    r = r / norm_r
+
+    # orthogonal procrustes - R = UV', scale = sum of singular values of t'r
+    u, s, vh = torch.linalg.svd(torch.matmul(t.transpose(1, 2), r))
+    rotation = torch.matmul(u, vh)
+    scale = s.sum(dim=-1).view(-1, 1, 1)
+
+    aligned = torch.matmul(r, rotation.transpose(1, 2)) * scale
+
+    return aligned * norm_t + mean_t
+
+
+def scipy_procrustes(target: torch.Tensor, recon: torch.Tensor) -> torch.Tensor:
+    """Reference procrustes alignment on CPU, one pose at a time with scipy.
+    Kept to verify and benchmark batch_procrustes.
+
+    Args:
+        target (torch.Tensor): ground truth poses [n, j, 3]
+        recon (torch.Tensor): poses to be aligned [n, j, 3]
+
+    Returns:
+        torch.Tensor: aligned recon [n, j, 3]
+    """
+    t, r = target.cpu().numpy(), recon.cpu().numpy()
+
+    aligned = []
+    for t_, r_ in zip(t, r):
+        # recon should be the second matrix
+        _, mtx, _ = proc(t_, r_)
+        mean = np.mean(t_, 0)
+        std = np.linalg.norm(t_ - mean)
+        r_ = (mtx * std) + mean
+        aligned.append(r_)
+
+    return torch.from_numpy(np.array(aligned)).float().to(recon.device)
+
+
 def create_rotation_matrices_3d(azimuths, elevations, rolls):
     """
     https://github.com/google-research/google-research/tree/68c738421186ce85339bfee16bf3ca2ea3ec16e4/poem
@@ -229,14 +295,72 @@ def random_rotate(
 
 
 def translate_and_project(pose3d, project_dist):
-    T = torch.tensor((0, 0, project_dist)).to(pose3d).type_as(pose3d)
-    pose3d = pose3d + T
-    pose3d_z = torch.clamp(pose3d[Ellipsis, -1:], min=1e-12)
+    # only z is translated, no translation tensor is needed
+    pose3d_z = torch.clamp(pose3d[Ellipsis, -1:] + project_dist, min=1e-12)
     pose2d_reprojection = pose3d[Ellipsis, :-1] / pose3d_z
 
     return pose2d_reprojection
 
 
+def sample_rotations(
+    n,
+    device=None,
+    roll_range=(0, 0),
+    azimuth_range=(0, 0),
+    elevation_range=(-math.pi, math.pi),
+):
+    """n transposed rotation matrices [n, 3, 3] with angles uniformly sampled on the device,
+    ranges and convention as in random_rotate"""
+    # one draw for all the angles, scaled with python floats so nothing is copied to the device
+    azimuths, elevations, rolls = [
+        u * (high - low) + low
+        for u, (low, high) in zip(torch.rand(3, n, device=device), (azimuth_range, elevation_range, roll_range))
+    ]
+
+    # R' so that row vector poses are rotated with pose @ R', no transposes of the poses
+    return create_rotation_matrices_3d(azimuths, elevations, rolls).transpose(1, 2).contiguous()
+
+
+@lru_cache(maxsize=8)
+def _rotation_bank(bank_size, device, dtype, roll_range, azimuth_range, elevation_range):
+    """bank_size transposed rotation matrices, built once per device and ranges"""
+    return sample_rotations(bank_size, device, roll_range, azimuth_range, elevation_range).to(dtype)
+
+
+def rotate_and_project(
+    pose_3d,
+    project_dist=10,
+    roll_range=(0, 0),
+    azimuth_range=(0, 0),
+    elevation_range=(-math.pi, math.pi),
+    bank_size=0,
+):
+    """Random rotation, translation to project_dist and perspective projection of 3D poses in one pass,
+    same as translate_and_project(random_rotate(pose_3d), project_dist).
+
+    Args:
+        pose_3d (torch.Tensor): root centered 3D poses [n, j, 3]
+        project_dist (float, optional): distance of the poses from the camera. Defaults to 10.
+        roll_range, azimuth_range, elevation_range (Tuple[float, float], optional): ranges of the angles, as in random_rotate
+        bank_size (int, optional): sample the rotations from a bank of bank_size matrices precomputed on the device,
+            0 samples new angles every call. Defaults to 0.
+
+    Returns:
+        torch.Tensor: 2D poses of the novel views [n, j, 2]
+    """
+    n = pose_3d.shape[0]
+    if bank_size:
+        bank = _rotation_bank(
+            bank_size, pose_3d.device, pose_3d.dtype, tuple(roll_range), tuple(azimuth_range), tuple(elevation_range)
+        )
+        rotations = bank[torch.randint(bank_size, (n,), device=pose_3d.device)]
+    else:
+        rotations = sample_rotations(n, pose_3d.device, roll_range, azimuth_range, elevation_range).to(pose_3d.dtype)
+
+    pose_3d_rotated = torch.bmm(pose_3d, rotations)
+    return translate_and_project(pose_3d_rotated, project_dist)
+
+
 ################################################################################
 # TODO not used - for supervised and images
 
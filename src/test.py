@@ -1,5 +1,4 @@
 import atexit
-import gc
 import math
 import os
 import sys
@@ -7,16 +6,21 @@ from argparse import ArgumentParser
 from torchsummary import summary
 import numpy as np
 import torch
-import wandb
 
+from src import loggers
 from src import train_utils
 from src import viz
 from src.dataloader import train_dataloader, val_dataloader
-from src.models import PJPE, kaiming_init, Critic
-from src.trainer import validation_epoch, _validation_step
+from src.models import Discriminator
+from src.trainer import validation_epoch, _validation_step, miss_joints
 from src.callbacks import CallbackList, ModelCheckpoint, Logging, WeightScheduler, Analyze, MaxNorm
+from src.datasets.h36m_utils import ACTION_NAMES
+from src.datasets.skeleton import Skeleton
+from src.distributed import unwrap
+from src.metrics import ErrorBreakdown, StreamingMetrics
 from collections import OrderedDict, defaultdict
 from src.processing import post_process, random_rotate, translate_and_project
+from src.utils import PJPE, kaiming_init
 
 
 def main():
@@ -30,11 +34,11 @@ def main():
 
     models = train_utils.get_models(variant, config)  # model instances
     if config.self_supervised:
-        critic = Critic()
+        critic = Discriminator()
         models['Critic'] = critic
     optimizers = train_utils.get_optims(
         variant, models, config)  # optimer for each pair
-    schedulers = train_utils.get_schedulers(optimizers)
+    schedulers = train_utils.get_schedulers(optimizers, config)
 
     # For multiple GPUs
     if torch.cuda.device_count() > 1:
@@ -79,7 +83,7 @@ def main():
     ####################################################################
 
     bh = False
-    epochs = 20
+    n_hypotheses = 20
     missing_joints = 0
     save = True
 
@@ -91,17 +95,20 @@ def main():
     cb.on_validation_start()
 
     normalize_pose = True
-    n_pjpes = []
-    n_zs = []
-    n_inps = []
 
-    if zv:
-        epochs = 1
+    # multi-hypothesis evaluates all the hypotheses in a single pass below
+    epochs = 1 if zv else 0
 
-    n_recons = []
     for epoch in range(epochs):
-        t_data = defaultdict(list)
         loss_dic = defaultdict(int)
+        # per sample errors are kept for the best hypothesis, poses only in a bounded reservoir
+        metrics = StreamingMetrics(keep_pjpe=True)
+        # protocol 1 - MPJPE, protocol 2 - PA-MPJPE, action x subject x camera x joint
+        joints = Skeleton().joints
+        breakdowns = {
+            protocol: ErrorBreakdown(len(joints), joint_names=joints, action_names=ACTION_NAMES)
+            for protocol in ('p1', 'p2')
+        }
 
         with torch.no_grad():
             for batch_idx, batch in enumerate(val_loader):
@@ -109,19 +116,7 @@ def main():
                     batch[key] = batch[key].to(config.device)
 
                 if missing_joints:
-                    pose = batch['pose2d']
-
-                    p_limbs = [1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
-                    p_limbs = torch.Tensor(p_limbs).to(pose.device)
-                    p_limbs = p_limbs.repeat(pose.shape[0], 1)
-
-                    miss_idx = torch.multinomial(
-                        p_limbs, missing_joints, replacement=False)
-                    for i in range(missing_joints):
-                        pose[torch.arange(pose.shape[0]),
-                             miss_idx[:, i], :] = 0
-
-                    batch['pose2d'] = pose  # not needed
+                    remove_joints(batch['pose2d'], missing_joints)
 
                 output = _validation_step(
                     batch, batch_idx, model, epoch, config, eval=zv)
@@ -137,50 +132,45 @@ def main():
                     loss_dic['D_G_z1'] += output['log']['D_G_z1']
                     loss_dic['D_G_z2'] += output['log']['D_G_z2']
 
-                for key in output['data'].keys():
-                    t_data[key].append(output['data'][key])
-
-                for key in ['subject', 'subaction', 'camera']:
-                    t_data[key].append(batch[key])
-         
-                del output
-                gc.collect()
+                # performance
+                data = output['data']
+                samples = {key: batch[key] for key in ['subject', 'subaction', 'camera', 'action']}
+                samples['z'] = data['z']
+                samples['recon_3d_org'] = data['recon_3d']
+                recon_3d, target_3d = data['recon_3d'], data['target_3d']
+                ids = (data['action'], batch['subject'], batch['camera'])
+                breakdowns['p1'].update(
+                    PJPE(*post_process(recon_3d, target_3d, procrustes=False)), *ids)
+                if normalize_pose and not config.self_supervised:
+                    recon_3d, target_3d = post_process(recon_3d, target_3d)
+                elif config.self_supervised:
+                    recon_3d, target_3d = post_process(
+                        recon_3d, target_3d, is_ss=True, procrustes=True)
+                samples['recon_3d'], samples['target_3d'] = recon_3d, target_3d
+
+                pjpe_ = PJPE(recon_3d, target_3d)
+                metrics.update(pjpe_, data['action'], samples)
+                breakdowns['p2'].update(pjpe_, *ids)
 
         avg_loss = loss_dic['loss']/len(val_loader)  # return for scheduler
 
-        for key in t_data.keys():
-            t_data[key] = torch.cat(t_data[key], 0)
+        for protocol, breakdown in breakdowns.items():
+            path = f"{config.report_dir}/{config.resume_run}_epoch_{epoch}_{protocol}"
+            breakdown.save(path)
+            print(f"{protocol} MPJPE: {breakdown.summary()['mpjpe']} saved tables at {path}")
+
+        result = metrics.compute()
+        t_data = result['reservoir']
+        t_data['reservoir_pjpe'] = result['reservoir_pjpe']
+        # position of the saved samples in the validation set
+        t_data['index'] = result['reservoir_index']
 
-        # performance
-        t_data['recon_3d_org'] = t_data['recon_3d'].detach()
         if '3D' in model[1].name:
-            if normalize_pose and not config.self_supervised:
-                t_data['recon_3d'], t_data['target_3d'] = post_process(
-                    t_data['recon_3d'], t_data['target_3d'])
-
-            elif config.self_supervised:
-                t_data['recon_3d'], t_data['target_3d'] = post_process(
-                    t_data['recon_3d'].to('cpu'), t_data['target_3d'].to('cpu'),
-                    self_supervised=True, procrustes_enabled=True)
-
-            # Speed up procrustes alignment with CPU!
-            t_data['recon_3d'] = t_data['recon_3d'].to(config.device)
-            t_data['target_3d'] = t_data['target_3d'].to(config.device)
-            n_recons.append(t_data['recon_3d_org'])
-
-            pjpe_ = PJPE(t_data['recon_3d'], t_data['target_3d'])
-            avg_pjpe = torch.mean((pjpe_), dim=0)
-            avg_mpjpe = torch.mean(avg_pjpe).item()
-            pjpe = torch.mean(pjpe_, dim=1)
-
-            actions = t_data['action']
-            mpjpe_pa = {}  # per action
-            for i in torch.unique(actions):
-                res = torch.mean(pjpe[actions == i])
-                mpjpe_pa[i.item()] = res.item()
-
-            n_pjpes.append(pjpe)
-            n_zs.append(t_data['z'])
+            avg_pjpe = result['per_joint']
+            avg_mpjpe = result['mpjpe']
+            pjpe = result['pjpe']
+            mpjpe_pa = result['per_action']  # per action
+
             config.logger.log({"pjpe": pjpe.cpu()})
 
             # average epochs output
@@ -208,22 +198,17 @@ def main():
 
     if bh:
         # multi-hypothesis
-        mh_pjpes = torch.stack(n_pjpes)
-        mh_z = torch.stack(n_zs)
-        # mpjpe for random z
-        mpjpe_z = torch.mean(mh_pjpes, dim=1)
-        print("mpjpe for random z \n", mpjpe_z)
-
-        pjpe_bh = torch.min(mh_pjpes, dim=0).values
-        t_data['bh'] = pjpe_bh
-        mpjpe_bh = pjpe_bh.mean()
-        print("mpjpe best hypothesis: ", mpjpe_bh)
-        print(f"{pjpe_bh.shape}")
-        t_data['n_recons'] = n_recons
-        t_data['n_zs'] = n_zs
+        results = multi_hypothesis_epoch(config, model, val_loader, n_hypotheses, missing_joints)
+        # reservoir of the best hypotheses and the errors of each reduction for the same samples
+        t_data = results['best']['reservoir']
+        t_data['index'] = results['best']['reservoir_index']
+        for name, result in results.items():
+            t_data[name] = result['pjpe'][t_data['index']]
+            config.logger.log({f"mpjpe_{name}": result['mpjpe']})
+        t_data['bh'] = t_data['best']
 
     if zv:
-        t_data['zv'] = pjpe
+        t_data['zv'] = pjpe[t_data['index']]
         print(f"\n ZV MPJPE: {avg_mpjpe} \n {avg_pjpe} \n")
     # _5frame
     if save:
@@ -250,6 +235,92 @@ def main():
     #                           grid=3)
 
 
+def remove_joints(pose, missing_joints):
+    """zero missing_joints random limb joints of every 2D pose in place"""
+    p_limbs = [1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
+    p_limbs = torch.Tensor(p_limbs).to(pose.device)
+    p_limbs = p_limbs.repeat(pose.shape[0], 1)
+
+    miss_idx = torch.multinomial(
+        p_limbs, missing_joints, replacement=False)
+    for i in range(missing_joints):
+        pose[torch.arange(pose.shape[0]),
+             miss_idx[:, i], :] = 0
+
+
+def multi_hypothesis_step(batch, model, config, n_hypotheses):
+    """Encode once and decode n_hypotheses latents of every pose in one batched call
+
+    Returns:
+        Tuple: errors of every hypothesis [b, k, j], post processed hypotheses [b, k, j, 3] and targets [b, j, 3]
+    """
+    encoder = model[0].eval()
+    decoder = model[1].eval()
+
+    inp, target_3d, _ = train_utils.get_inp_target_criterion(unwrap(encoder), unwrap(decoder), batch)
+    if config.p_miss:
+        # same missed detections as _validation_step
+        miss_joints(inp, config.p_miss)
+
+    mean, logvar = encoder(inp)
+    # clip logvar to prevent inf when exp is calculated
+    logvar = torch.clamp(logvar, max=30)
+    std = torch.exp(0.5 * logvar)
+
+    # [b, k, latent] -> [b*k, latent]
+    eps = torch.randn(len(mean), n_hypotheses, mean.shape[-1], device=mean.device)
+    z = mean.unsqueeze(1) + eps * std.unsqueeze(1)
+    recon_3d = decoder(z.view(-1, mean.shape[-1]))
+    recon_3d = recon_3d.view(-1, unwrap(model[0]).n_joints, 3)
+    if config.self_supervised:
+        # enforce unit recon, as in _validation_step
+        recon_3d = recon_3d * 1.3
+
+    recon_3d, target_3d = post_process(
+        recon_3d, target_3d.repeat_interleave(n_hypotheses, dim=0), is_ss=True, procrustes=True)
+
+    pjpe = PJPE(recon_3d, target_3d).view(len(mean), n_hypotheses, -1)
+    recon_3d = recon_3d.view(len(mean), n_hypotheses, *recon_3d.shape[1:])
+    return pjpe, recon_3d, target_3d[::n_hypotheses]
+
+
+def multi_hypothesis_epoch(config, model, val_loader, n_hypotheses, missing_joints=0):
+    """MPJPE of n_hypotheses per pose, reduced on the fly
+        best - the hypothesis with the lowest error per pose
+        mean - average error of the hypotheses
+        oracle - lowest error per joint over the hypotheses
+    """
+    metrics = {
+        'best': StreamingMetrics(n_worst=0, keep_pjpe=True),
+        'mean': StreamingMetrics(n_samples=0, n_worst=0, keep_pjpe=True),
+        'oracle': StreamingMetrics(n_samples=0, n_worst=0, keep_pjpe=True),
+    }
+
+    with torch.no_grad():
+        for batch in val_loader:
+            for key in batch.keys():
+                batch[key] = batch[key].to(config.device)
+
+            if missing_joints:
+                remove_joints(batch['pose2d'], missing_joints)
+
+            pjpe, recon_3d, target_3d = multi_hypothesis_step(batch, model, config, n_hypotheses)
+
+            best = pjpe.mean(dim=-1).argmin(dim=1)
+            rows = torch.arange(len(pjpe), device=pjpe.device)
+            samples = {key: batch[key] for key in ['subject', 'subaction', 'camera', 'action']}
+            samples['recon_3d'], samples['target_3d'] = recon_3d[rows, best], target_3d
+
+            metrics['best'].update(pjpe[rows, best], batch['action'], samples)
+            metrics['mean'].update(pjpe.mean(dim=1), batch['action'])
+            metrics['oracle'].update(pjpe.min(dim=1).values, batch['action'])
+
+    results = {name: metric.compute() for name, metric in metrics.items()}
+    for name, result in results.items():
+        print(f"{name} of {n_hypotheses} hypotheses MPJPE: {result['mpjpe']} \n per action \n {result['per_action']}")
+    return results
+
+
 def do_setup():
     # Experiment Configuration, Config, is distributed to all the other modules
     parser = training_specific_args()
@@ -263,24 +334,10 @@ def do_setup():
     config.device = device  # Adding device to config, not already in argparse
     config.num_workers = 4 if use_cuda else 4  # for dataloader
 
-    # wandb for experiment monitoring
-    os.environ['WANDB_TAGS'] = 'inference'
+    # local files or wandb for experiment monitoring
     os.environ['WANDB_NOTES'] = 'inference'
-
-    if not config.wandb:
-        os.environ['WANDB_MODE'] = 'dryrun'
-
-    # ignore when debugging on cpu
-    if not use_cuda:
-        # os.environ['WANDB_MODE'] = 'dryrun'  # Doesnt auto sync to project
-        os.environ['WANDB_TAGS'] = 'CPU'
-        wandb.init(anonymous='allow', project="hpe3d",
-                   config=config)  # to_delete
-    else:
-        wandb.init(anonymous='allow', project="hpe3d", config=config)
-
-    config.logger = wandb
-    config.logger.run.save()
+    # wandb runs are only synced with --wandb
+    config.logger = loggers.get_logger(config, tags='inference' if use_cuda else 'CPU', dryrun=not config.wandb)
     config.run_name = config.logger.run.name  # handle name change in wandb
 
     return config
@@ -300,7 +357,7 @@ def training_specific_args():
     parser.add_argument('--fast_dev_run', default=False, type=lambda x: (str(x).lower() == 'true'),
                         help='run all methods once to check integrity, not implemented!')
     parser.add_argument('--resume_run', default="absurd-music-3244", type=str,
-                        help='wandb run name to resume training using the saved checkpoint')
+                        help='run name to resume training using the saved checkpoint')
     parser.add_argument('--test', default=False, type=lambda x: (str(x).lower() == 'true'),
                         help='run validatoin epoch only')
     # model specific
@@ -318,6 +375,8 @@ def training_specific_args():
                         help='KLD weight annealing time')
     parser.add_argument('--noise_level', default=0.0, type=float,  # 0.01
                         help='percentage of noise to inject for critic training')
+    parser.add_argument('--rotation_bank', default=0, type=int,
+                        help='sample novel views from a bank of n rotations precomputed on the device, 0 for new angles every step')
     parser.add_argument('--beta_max', default=0.01, type=float,  # 0.01
                         help='maximum value of beta during annealing or cycling')
     parser.add_argument('--lr_gen', default=2e-4, type=float,
@@ -339,12 +398,18 @@ def training_specific_args():
     # output
     parser.add_argument('--save_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/checkpoints', type=str,
                         help='path to save checkpoints')
+    parser.add_argument('--report_dir', default='src/results', type=str,
+                        help='dir to write the per action, subject, camera and joint error tables')
     parser.add_argument('--exp_name', default=f'run_1', type=str,
                         help='name of the current run, used to id checkpoint and other logs')
     parser.add_argument('--log_interval', type=int, default=1,
                         help='# of batches to wait before logging training status')
     parser.add_argument('--wandb', type=bool, default=False,
-                        help='wandb')
+                        help='sync the wandb run, with --tracker wandb')
+    parser.add_argument('--tracker', default='local', type=str, choices=['local', 'wandb'],
+                        help='experiment tracker, local files in runs_dir or wandb')
+    parser.add_argument('--runs_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/runs', type=str,
+                        help='dir of the local runs - metrics, images and config of each run')
     # device
     parser.add_argument('--cuda', default=True, type=lambda x: (str(x).lower() == 'true'),
                         help='enable cuda if available')
@@ -7,25 +7,48 @@ from argparse import ArgumentParser
 
 import numpy as np
 import torch
-import wandb
 
-sys.path.append("../src")  # noqa
+# modules are imported as src.*, the models and the dataset import their siblings bare
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [path for path in (ROOT, f"{ROOT}/src") if path not in sys.path]  # noqa
 
+from src import distributed
+from src import loggers
 from src import train_utils
 from src import viz
 from src.dataloader import train_dataloader, val_dataloader
-from src.models import PJPE, kaiming_init, Critic
+from src.models import Discriminator
 from src.trainer import training_epoch, validation_epoch
-from src.callbacks import CallbackList, ModelCheckpoint, Logging, WeightScheduler, Analyze, MaxNorm
+from src.utils import kaiming_init
+from src.callbacks import CallbackList, ModelCheckpoint, Logging, WeightScheduler, Analyze, MaxNorm, TrainingState, Profiler
 
 
 def main():
+    parser = get_argparser()
+    config = parser.parse_args()
+
+    if config.world_size > 1:
+        # one process per device, each runs the full training loop on its shard of the data
+        torch.multiprocessing.spawn(run, args=(config,), nprocs=config.world_size)
+    else:
+        run(0, config)
 
-    config = do_setup()
+
+def run(rank, config):
+    if config.world_size > 1:
+        distributed.setup(rank, config.world_size, config.backend, config.port)
+
+    config = do_setup(rank, config)
 
     # Data loading
     train_loader = train_dataloader(config)
     val_loader = val_dataloader(config)
+    if distributed.is_distributed():
+        # same datasets, sharded across the processes. validation runs on rank 0 only
+        train_loader = distributed.data_loader(
+            train_loader.dataset, config.batch_size, shuffle=True,
+            num_workers=config.num_workers, pin_memory=config.pin_memory,
+        )
 
     # TODO REMOVE
     # combinations of Encoder, Decoder to train in each epoch
@@ -42,18 +65,12 @@ def main():
 
     models = train_utils.get_models(variant, config)  # model instances
     if config.self_supervised:
-        critic = Critic()
+        critic = Discriminator()
         models['Critic'] = critic
     optimizers = train_utils.get_optims(
         variant, models, config)  # optimer for each pair
     schedulers = train_utils.get_schedulers(optimizers, config)
 
-    # data parallel
-    if torch.cuda.device_count() > 1:
-        print(f'[INFO]: Using {torch.cuda.device_count()} GPUs')
-        for key in models.keys():
-            models[key] = torch.nn.DataParallel(models[key])
-
     # To CPU or GPU or TODO TPU
     for key in models.keys():
         models[key] = models[key].to(config.device)
@@ -61,22 +78,49 @@ def main():
         models[key].apply(kaiming_init)
 
     # initiate all required callbacks, keep the order in mind!!!
-    cb = CallbackList([ModelCheckpoint(),
-                       Logging(),
-                       WeightScheduler(config, strategy="beta_cycling"),
-                       #    WeightScheduler(config, strategy="noise_annealing"),
-                       #    WeightScheduler(config, strategy="critic_cycling"),
-                       #    MaxNorm()
-                       ])
-
-    cb.setup(config=config, models=models, optimizers=optimizers,
-             train_loader=train_loader, val_loader=val_loader, variant=variant)
+    # checkpoints and logs are written by rank 0 only
+    if distributed.is_main_process():
+        cb = CallbackList([ModelCheckpoint(keep_last=config.keep_last),
+                           Logging(config.log_every_n_steps, config.log_every_n_seconds, config.log_dir, config.tensorboard),
+                           WeightScheduler(config, strategy="beta_cycling"),
+                           #    WeightScheduler(config, strategy="noise_annealing"),
+                           #    WeightScheduler(config, strategy="critic_cycling"),
+                           #    MaxNorm()
+                           TrainingState(config.state_every_n_steps),
+                           ])
+    else:
+        cb = CallbackList([WeightScheduler(config, strategy="beta_cycling"),
+                           TrainingState(config.state_every_n_steps)])
+    if config.profile:
+        # last, so the time of the other callbacks is in its callbacks phase
+        cb.callbacks.append(Profiler(config.profile_dir, config.profile_steps))
 
     config.mpjpe_min = float('inf')
+    if config.report_dir:
+        os.makedirs(config.report_dir, exist_ok=True)
+
+    # may restore the training state, before the models are wrapped
+    cb.setup(config=config, models=models, optimizers=optimizers, schedulers=schedulers,
+             train_loader=train_loader, val_loader=val_loader, variant=variant)
+
+    # data parallel
+    if distributed.is_distributed():
+        print(f'[INFO]: Rank {distributed.get_rank()} of {distributed.get_world_size()} on {config.device}')
+        # weights of rank 0, which may have been resumed, are broadcast when wrapping
+        for key in models.keys():
+            models[key] = distributed.wrap(models[key], config.device, config.sync_bn)
+        distributed.broadcast_optimizers(optimizers)
+    elif torch.cuda.device_count() > 1:
+        print(f'[INFO]: Using {torch.cuda.device_count()} GPUs')
+        for key in models.keys():
+            models[key] = torch.nn.DataParallel(models[key])
 
     # Training
-    for epoch in range(1, config.epochs+1):
+    for epoch in range(config.start_epoch, config.epochs+1):
+        distributed.set_epoch(train_loader, epoch)
         for n_pair, pair in enumerate(variant):
+            if epoch == config.start_epoch and n_pair < config.start_pair:
+                continue  # resumed after this pair
 
             # VAE specific players
             vae_type = "_2_".join(pair)
@@ -97,12 +141,16 @@ def main():
 
             # TODO init criterion once with .to(cuda)
             training_epoch(config, cb, model, train_loader,
-                           optimizer, epoch, vae_type)
+                           optimizer, epoch, vae_type, n_pair)
 
             val_loss = 0
             if epoch % config.validation_interval == 0:
-                val_loss = validation_epoch(
-                    config, cb, model, val_loader, epoch, vae_type)
+                if distributed.is_main_process():
+                    # unwrapped, DDP forward would wait for the other processes
+                    val_loss = validation_epoch(
+                        config, cb, [distributed.unwrap(m) for m in model], val_loader, epoch, vae_type)
+                # every process stops on NAN
+                val_loss = distributed.broadcast(val_loss)
 
                 if val_loss != val_loss:
                     print("[WARNING]: NAN loss")
@@ -132,48 +180,46 @@ def main():
             break
             
 
-    # sync config with wandb for easy experiment comparision
-    config.logger = None  # wandb cant have objects in its config
-    wandb.config.update(config)
+    # wait for the checkpoints still being written
+    cb.teardown(config=config)
+    distributed.cleanup()
+    if not distributed.is_main_process():
+        return
 
+    # sync config with the logger for easy experiment comparision
+    config.logger.update_config(config)
 
-def do_setup():
-    parser = get_argparser()
-    config = parser.parse_args()
-    torch.manual_seed(config.seed)
-    np.random.seed(config.seed)
+
+def do_setup(rank, config):
+    # different augmentations per process, the initial weights are broadcast from rank 0
+    torch.manual_seed(config.seed + rank)
+    np.random.seed(config.seed + rank)
 
     # GPU setup
-    use_cuda = config.cuda and torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
+    device = distributed.get_device(rank, config.cuda) if config.world_size > 1 else torch.device(
+        "cuda" if config.cuda and torch.cuda.is_available() else "cpu")
     config.device = device  # Adding device to config, not already in argparse
 
-    # wandb for experiment monitoring
-    os.environ['WANDB_TAGS'] = 'New_Scaling'
-    # os.environ['WANDB_NOTES'] = 'None'
+    if rank != 0:
+        config.logger = distributed.NullLogger
+        config.run_name = None
+        return config
 
-    # ignore when debugging on cpu
-    if config.device.type == 'cpu':
-        os.environ['WANDB_MODE'] = 'dryrun'  # Doesnt auto sync to project
-        os.environ['WANDB_TAGS'] = 'CPU'
-        wandb.init(anonymous='allow', project="hpe3d",
-                   config=config)  # to_delete
-    else:
-        # os.environ['WANDB_MODE'] = 'dryrun'
-        wandb.init(anonymous='allow', project="hpe3d", config=config)
-
-    config.logger = wandb
-    config.logger.run.save()
+    # local files or wandb for experiment monitoring
+    # os.environ['WANDB_NOTES'] = 'None'
+    # wandb runs are not synced when debugging on cpu
+    is_cpu = config.device.type == 'cpu'
+    config.logger = loggers.get_logger(config, tags='CPU' if is_cpu else 'New_Scaling', dryrun=is_cpu)
     config.run_name = config.logger.run.name  # handle name change in wandb
-    atexit.register(sync_before_exit, config, wandb)
+    atexit.register(sync_before_exit, config)
 
     return config
 
 
-def sync_before_exit(config, wandb):
-    print("[INFO]: Sync wandb before terminating")
-    config.logger = None  # wandb cant have objects in its config
-    wandb.config.update(config)
+def sync_before_exit(config):
+    print("[INFO]: Sync the logger before terminating")
+    config.logger.update_config(config)
+    config.logger.finish()
 
 
 def get_argparser():
@@ -188,10 +234,10 @@ def get_argparser():
     parser.add_argument('--fast_dev_run', default=True, type=lambda x: (str(x).lower() == 'true'),
                         help='run all methods once to check integrity')
     parser.add_argument('--resume_run', default="None", type=str,
-                        help='wandb run name to resume training using the saved checkpoint')
+                        help='run name to resume training using the saved checkpoint')
     parser.add_argument('--test', default=False, type=lambda x: (str(x).lower() == 'true'),
                         help='run validatoin epoch only')
-    parser.add_argument('--is_ss', default=True, type=bool,
+    parser.add_argument('--self_supervised', default=True, type=lambda x: (str(x).lower() == 'true'),
                         help='training strategy - self supervised')
     parser.add_argument('--top_k', default=True, type=bool,
                         help='top k realistic samples to train generator')
@@ -222,6 +268,10 @@ def get_argparser():
                         help='percentage of noise to inject for critic training')
     parser.add_argument('--flip_labels_n_e', default=0, type=int,  
                         help='flip real fake labels for critic every n epochs')
+    parser.add_argument('--rotation_bank', default=0, type=int,
+                        help='sample novel views from a bank of n rotations precomputed on the device, 0 for new angles every step')
+    parser.add_argument('--n_views', default=1, type=int,
+                        help='novel views per generated 3D pose, all fed to the discriminator as one batch')
     
     parser.add_argument('--lr_gen', default=2e-4, type=float,
                         help='learning rate for all optimizers')
@@ -229,18 +279,46 @@ def get_argparser():
                         help='learning rate for all optimizers')
     parser.add_argument('--lr_decay', default=0.95, type=float,
                         help='learning rate for all optimizers')
-    parser.add_argument('--p_miss_joints', default=0.0, type=float,
-                        help='emulate joint occlusion')
+    parser.add_argument('--p_miss', default=0.0, type=float,
+                        help='emulate joint occlusion, ratio of the 2D poses missing 1 or 2 joints')
     # data files
     parser.add_argument('--train_file', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/h36m_train_sh.h5', type=str,
                         help='abs path to training data file')
     parser.add_argument('--test_file', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/h36m_test_sh.h5', type=str,
                         help='abs path to validation data file')
     # output
-    # parser.add_argument('--save_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/checkpoints', type=str,
-    #                     help='path to save checkpoints')
+    parser.add_argument('--save_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/checkpoints', type=str,
+                        help='path to save checkpoints')
     parser.add_argument('--exp_name', default=f'run_1', type=str,
                         help='name of the current run, used to id checkpoint and other logs')
+    parser.add_argument('--state_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/checkpoints', type=str,
+                        help='dir to save the full training state to resume from')
+    parser.add_argument('--state_every_n_steps', default=500, type=int,
+                        help='save the training state every n steps besides the end of each epoch, 0 to only save at the end')
+    parser.add_argument('--resume_state', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='continue from the saved training state of exp_name')
+    parser.add_argument('--profile', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='time each phase of the training step and write a chrome trace to profile_dir')
+    parser.add_argument('--profile_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/profiles', type=str,
+                        help='directory of the profiler traces')
+    parser.add_argument('--profile_steps', default=[], type=int, nargs='*',
+                        help='global steps also traced with torch.profiler')
+    parser.add_argument('--tracker', default='local', type=str, choices=['local', 'wandb'],
+                        help='experiment tracker, local files in runs_dir or wandb')
+    parser.add_argument('--runs_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/runs', type=str,
+                        help='dir of the local runs - metrics, images and config of each run')
+    parser.add_argument('--log_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/logs', type=str,
+                        help='dir of the local jsonl metrics and tensorboard logs, "" to disable')
+    parser.add_argument('--log_every_n_steps', default=50, type=int,
+                        help='print and log the mean training metrics every n steps')
+    parser.add_argument('--log_every_n_seconds', default=30, type=float,
+                        help='or at least every n seconds')
+    parser.add_argument('--tensorboard', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='also log the metrics to tensorboard in log_dir')
+    parser.add_argument('--report_dir', default='', type=str,
+                        help='dir to write the per action, subject, camera and joint error tables of every validation, "" to disable')
+    parser.add_argument('--keep_last', type=int, default=2,
+                        help='number of recent validation checkpoints to keep besides the best one')
     parser.add_argument('--log_image_interval', type=int, default=1,
                         help='log images during eval epoch falling in this interval')
     parser.add_argument('--validation_interval', type=int, default=5,
@@ -255,6 +333,14 @@ def get_argparser():
                         help='workers for data loader')
     parser.add_argument('--seed', default=400, type=int,
                         help='random seed')
+    parser.add_argument('--world_size', default=1, type=int,
+                        help='number of processes for distributed data parallel, one per device')
+    parser.add_argument('--backend', default='gloo', type=str,
+                        help='torch.distributed backend, gloo for cpu or nccl for gpus')
+    parser.add_argument('--port', default=29500, type=int,
+                        help='port of the rank 0 process')
+    parser.add_argument('--sync_bn', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='synchronize batch norm statistics across processes, cuda only')
 
     return parser
 
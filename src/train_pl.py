@@ -6,7 +6,7 @@ import torch
 from pytorch_lightning.loggers import WandbLogger
 from torch.cuda import device_count
 
-from dataset import H36M
+from dataset import H36M, fast_loader
 from trainer_pl import VAEGAN
 
 
@@ -15,20 +15,39 @@ def main():
     opt = parser.parse_args()
     pl.seed_everything(opt.seed)
 
-    train_loader = torch.utils.data.DataLoader(
-        H36M(opt.train_file, opt.is_ss, is_train=True, debug=opt.fast_dev_run),
-        batch_size=opt.batch_size,
-        num_workers=opt.num_workers,
-        pin_memory=opt.pin_memory,
-        shuffle=True,
+    train_dataset = H36M(
+        opt.train_file, opt.is_ss, is_train=True, debug=opt.fast_dev_run,
+        cache_dir=opt.cache_dir, batch_transforms=opt.batch_transforms,
     )
-    val_loader = torch.utils.data.DataLoader(
-        H36M(opt.test_file, opt.is_ss, is_train=False, debug=opt.fast_dev_run),
-        batch_size=opt.batch_size,
-        num_workers=opt.num_workers,
-        pin_memory=opt.pin_memory,
-        shuffle=False,
+    val_dataset = H36M(
+        opt.test_file, opt.is_ss, is_train=False, debug=opt.fast_dev_run,
+        cache_dir=opt.cache_dir, batch_transforms=opt.batch_transforms,
     )
+    if opt.fast_loader:
+        # batches are gathered from the in memory tensors in the main process
+        train_loader = fast_loader(
+            train_dataset, opt.batch_size, shuffle=True, pin_memory=opt.pin_memory
+        )
+        val_loader = fast_loader(
+            val_dataset, opt.batch_size, shuffle=False, pin_memory=opt.pin_memory
+        )
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=opt.batch_size,
+            num_workers=opt.num_workers,
+            pin_memory=opt.pin_memory,
+            shuffle=True,
+            collate_fn=train_dataset.collate if opt.batch_transforms else None,
+        )
+        val_loader = torch.utils.data.DataLoader(
+            val_dataset,
+            batch_size=opt.batch_size,
+            num_workers=opt.num_workers,
+            pin_memory=opt.pin_memory,
+            shuffle=False,
+            collate_fn=val_dataset.collate if opt.batch_transforms else None,
+        )
 
     logger = WandbLogger(project="gan", reinit=True)
     logger.log_hyperparams(opt)
@@ -40,12 +59,24 @@ def main():
         verbose=True,
     )
     checkpoint_callback.FILE_EXTENSION = ".pt"
+    callbacks = [checkpoint_callback]
+    if opt.ckpt_every_n_steps:
+        # periodic state for preempted jobs, in addition to the best mpjpe
+        state_callback = pl.callbacks.ModelCheckpoint(
+            dirpath="./ckpts/",
+            filename=f"{logger.experiment.name}_state",
+            every_n_train_steps=opt.ckpt_every_n_steps,
+            save_top_k=1,
+        )
+        state_callback.FILE_EXTENSION = ".pt"
+        callbacks.append(state_callback)
     trainer = pl.Trainer(
         gpus=device_count() * int(opt.gpu),
         fast_dev_run=opt.fast_dev_run,
         max_epochs=opt.epochs,
-        callbacks=[checkpoint_callback],
+        callbacks=callbacks,
         logger=logger,
+        resume_from_checkpoint=opt.resume_from_checkpoint,
     )
     model = VAEGAN(opt)
     trainer.fit(model, train_loader, val_loader)
@@ -67,9 +98,15 @@ def get_argparser():
                         help='run all methods once to check integrity')
     parser.add_argument('--is_ss', default=True, type=bool,
                         help='training strategy - self supervised')
+    parser.add_argument('--compile', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='torch.compile the training step, metrics are logged once per epoch')
+    parser.add_argument('--bf16', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='bf16 autocast for the forward passes of the training step')
     # model specific
     parser.add_argument('--latent_dim', default=51, type=int,
                         help='dimensions of the cross model latent space')
+    parser.add_argument('--fused_blocks', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='use FusedLBAD blocks, same weights with fewer kernels')
     parser.add_argument('--lambda_g', default=1, type=float,
                         help='ss- weight for gen loss/adversarial loss based on disc')
     parser.add_argument('--lambda_recon', default=1e-3, type=float,
@@ -102,14 +139,28 @@ def get_argparser():
                         help='KLD weight annealing time')
     parser.add_argument('--noise_level', default=0.0, type=float, 
                         help='percentage of noise to inject for critic training')
+    parser.add_argument('--rotation_bank', default=0, type=int,
+                        help='sample novel views from a bank of n rotations precomputed on the device, 0 for new angles every step')
+    parser.add_argument('--n_views', default=1, type=int,
+                        help='novel views per generated 3D pose, all fed to the discriminator as one batch')
     # data files
     parser.add_argument('--train_file', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/h36m_train_sh.h5', type=str,
                         help='abs path to training data file')
     parser.add_argument('--test_file', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/h36m_test_sh.h5', type=str,
                         help='abs path to validation data file')
+    parser.add_argument('--batch_transforms', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='augment whole batches at collate time instead of every sample')
+    parser.add_argument('--fast_loader', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='gather whole batches from the in memory data, uses the batch transforms')
+    parser.add_argument('--cache_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/data/cache', type=str,
+                        help='dir to cache preprocessed data as memory mapped .npy files, "" to disable')
     # output
     # parser.add_argument('--save_dir', default=f'{os.path.dirname(os.path.abspath(__file__))}/../checkpoints', type=str,
     #                     help='path to save checkpoints')
+    parser.add_argument('--ckpt_every_n_steps', type=int, default=0,
+                        help='save the training state every n steps to resume preempted jobs, 0 to disable')
+    parser.add_argument('--resume_from_checkpoint', type=str, default=None,
+                        help='path of the checkpoint to resume training from')
     parser.add_argument('--log_image_interval', type=int, default=1,
                         help='log images during eval epoch falling in this interval')
     parser.add_argument('--validation_interval', type=int, default=5,
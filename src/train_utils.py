@@ -1,9 +1,31 @@
-import sys
-
 import torch
 
-from src.models import (PJPE, Decoder3D, Encoder2D)
+from src.models import Generator
+
+
+def get_models(variant, config):
+    '''
+    get the encoders and decoders of all the pairs in the variant
+
+    Arguments:
+        variant (list(list)) -- all the combination of models
+        config (namespace) -- contain all params for the pipeline
+
+    Returns:
+        models (dict) -- model instances by name, eg. Encoder2D, Decoder3D
+    '''
+    # same encoder and decoder as the Generator of train_pl.py
+    generator = Generator(config.latent_dim)
+    available = {"Encoder2D": generator.encoder, "Decoder3D": generator.decoder}
+
+    models = {}
+    for pair in variant:
+        for name in (f"Encoder{pair[0].upper()}", f"Decoder{pair[1].upper()}"):
+            if name not in available:
+                raise NotImplementedError(f"[ERROR]: {name} is not implemented, only the 2d to 3d pair")
+            models[name] = available[name]
 
+    return models
 
 
 def get_optims(variant, models, config):
@@ -94,7 +116,8 @@ def get_inp_target_criterion(encoder, decoder, batch):
         target = batch['pose2d'].float()
         criterion = torch.nn.L1Loss()
     elif '3D' in decoder.__class__.__name__:
-        target = batch['pose3d'].float()
+        # not loaded for self supervised training, the 2D input is the target there
+        target = batch['pose3d'].float() if 'pose3d' in batch else None
         # different if self-supervised
         criterion = torch.nn.L1Loss()
         # criterion = torch.nn.MSELoss()
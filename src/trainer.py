@@ -1,64 +1,75 @@
-import gc
 from collections import OrderedDict, defaultdict
 import math
 
 import torch
 from torch import nn
-from src.models import KLD, PJPE, reparameterize
-from src.processing import post_process, random_rotate, translate_and_project
+from src.models import Generator
+from src.callbacks.profiler import mark_phase, reset_data_timer
+from src.processing import post_process, rotate_and_project, translate_and_project
+from src.distributed import unwrap
+from src.datasets.h36m_utils import ACTION_NAMES
+from src.datasets.skeleton import Skeleton
+from src.metrics import ErrorBreakdown, StreamingMetrics
 from src.train_utils import get_inp_target_criterion
+from src.utils import KLD, PJPE, set_rng_state
 
 # torch.autograd.set_detect_anomaly(True)
 
 
-def _training_step(batch, batch_idx, model, config, optimizer, epoch):
-    encoder = model[0].train()
-    decoder = model[1].train()
+def miss_joints(pose, p_miss):
+    """zero 1 or 2 random limb joints of p_miss of the 2D poses in place, emulates missed detections
 
-    # len(optimizer) is 1 or 2 with critic optim
-    vae_optimizer = optimizer[0]
+    Returns:
+        Tuple: ids of the incomplete poses and their missing joints, both [n, 2]
+    """
+    # index of poses to be incomplete
+    incomplete_poses_ids = torch.multinomial(
+        torch.ones(pose.shape[0]),
+        int(pose.shape[0] * p_miss),
+        replacement=False,
+    )
 
-    inp, target_3d, criterion = get_inp_target_criterion(encoder, decoder, batch)
+    # probablity to choose a joint to miss
+    p_limbs = [1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
+    p_limbs = torch.Tensor(p_limbs).to(pose.device)
+    p_limbs = p_limbs.repeat(len(incomplete_poses_ids), 1)
 
-    if config.p_miss:
+    # 2 random joints to exclude for each missing pose
+    # make 0.5 of them to miss 1 joint only by duplicting the joint id
+    rand_joints = torch.multinomial(p_limbs, 2, replacement=False)
+    rand_joints[: rand_joints.shape[0] // 2][:, 1] = rand_joints[
+        : rand_joints.shape[0] // 2
+    ][:, 0]
 
-        pose = inp
-        pose2d_org = inp.clone()
+    # repeat incomplete pose ids for vectorization
+    incomplete_poses_ids = incomplete_poses_ids.view(-1, 1).repeat(1, 2)
 
-        # index of poses to be incomplete
-        incomplete_poses_ids = torch.multinomial(
-            torch.ones(pose.shape[0]),
-            int(pose.shape[0] * config.p_miss),
-            replacement=False,
-        )
+    # zero the random joints of the 'tobe' incomplete poses
+    pose[incomplete_poses_ids, rand_joints, :] = 0
 
-        # probablity to choose a joint to miss
-        p_limbs = [1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
-        p_limbs = torch.Tensor(p_limbs).to(pose.device)
-        p_limbs = p_limbs.repeat(len(incomplete_poses_ids), 1)
+    return incomplete_poses_ids, rand_joints
 
-        # 2 random joints to exclude for each missing pose
-        # make 0.5 of them to miss 1 joint only by duplicting the joint id
-        rand_joints = torch.multinomial(p_limbs, 2, replacement=False)
-        rand_joints[: rand_joints.shape[0] // 2][:, 1] = rand_joints[
-            : rand_joints.shape[0] // 2
-        ][:, 0]
 
-        # repeat incomplete pose ids for vectorization
-        incomplete_poses_ids = incomplete_poses_ids.view(-1, 1).repeat(1, 2)
+def _training_step(batch, batch_idx, model, config, optimizer, epoch):
+    encoder = model[0].train()
+    decoder = model[1].train()
 
-        # zero the random joints of the 'tobe' incomplete poses
-        pose[incomplete_poses_ids, rand_joints, :] = 0
+    # len(optimizer) is 1 or 2 with critic optim
+    vae_optimizer = optimizer[0]
 
-        inp = pose  # not needed
+    mark_phase(config, "generator")
+    inp, target_3d, criterion = get_inp_target_criterion(unwrap(encoder), unwrap(decoder), batch)
+
+    if config.p_miss:
+        incomplete_poses_ids, rand_joints = miss_joints(inp, config.p_miss)
 
     mean, logvar = encoder(inp)
 
     # clip logvar to prevent inf when exp is calculated
     logvar = torch.clamp(logvar, max=30)
-    z = reparameterize(mean, logvar)
+    z = Generator.reparameterize(mean, logvar)
     recon_3d = decoder(z)
-    recon_3d = recon_3d.view(-1, model[0].n_joints, 3)
+    recon_3d = recon_3d.view(-1, unwrap(model[0]).n_joints, 3)
 
     if config.self_supervised:
 
@@ -70,15 +81,10 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         # tanh gives 0 to 1-  lower is 1 then upper is 0.8 we need upper 1
         recon_3d = recon_3d * 1.3
 
-        T = torch.tensor((0, 0, 10), device=recon_3d.device, dtype=recon_3d.dtype)
-
-        recon_2d = translate_and_project(recon_3d + T)
-
-        novel_3d_detach = random_rotate(recon_3d.detach())
-        novel_3d = random_rotate(recon_3d)
-
-        novel_2d = translate_and_project(novel_3d + T)
-        novel_2d_detach = translate_and_project(novel_3d_detach + T)
+        recon_2d = translate_and_project(recon_3d, 10)
+        # n_views novel views of each pose [b*n_views, j, 2], views of a pose are consecutive
+        novel_3d = recon_3d.repeat_interleave(config.n_views, dim=0) if config.n_views > 1 else recon_3d
+        novel_2d = rotate_and_project(novel_3d, 10, bank_size=config.rotation_bank)
 
         # Use the same fake for training critic and the generator
         novel_2d_detach = novel_2d.detach()
@@ -86,11 +92,13 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         ################################################
         # Critic - maximize log(D(x)) + log(1 - D(G(z)))
         ################################################
+        mark_phase(config, "critic")
         critic = model[2].train()
         real_label = 1
         fake_label = 0
-        binary_loss = nn.BCELoss()
-        binary_loss_no_red = nn.BCELoss(reduction="none")
+        # the critic outputs logits
+        binary_loss = nn.BCEWithLogitsLoss()
+        binary_loss_no_red = nn.BCEWithLogitsLoss(reduction="none")
         critic_optimizer = optimizer[-1]
         critic_optimizer.zero_grad(set_to_none=True)
 
@@ -112,10 +120,13 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         output = critic(noised_real)
         critic_loss_real = binary_loss(output, labels)
         critic_loss_real.backward()
-        D_x = output.mean().item()
+        # detached tensors, read by the Logging callback when it flushes
+        D_x = torch.sigmoid(output).mean().detach()
 
-        # train with fake samples
-        labels.fill_(fake_label)
+        # train with fake samples, all the views
+        labels = torch.full(
+            (len(novel_2d_detach), 1), fake_label, device=config.device, dtype=target_2d.dtype
+        )
         # label smoothing for real labels alone *** not TODO
         # label_noise = (torch.rand_like(labels, device=labels.device)*(0.0-0.3)) + 0.3
         # labels = labels * label_noise
@@ -124,7 +135,7 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         output = critic(novel_2d_detach)
         critic_loss_fake = binary_loss(output, labels)
         critic_loss_fake.backward()
-        D_G_z1 = output.mean().item()
+        D_G_z1 = torch.sigmoid(output).mean().detach()
 
         critic_loss = critic_loss_real + critic_loss_fake
 
@@ -137,6 +148,7 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         ################################################
         # Generator - maximize log(D(G(z)))
         ################################################
+        mark_phase(config, "generator_loss")
         # real labels so as to train the vae such that a-
         # -trained discriminator predicts all fake as real
 
@@ -158,7 +170,7 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         gen_loss = binary_loss_no_red(output, labels)
 
         if config.top_k:
-            # top k generations
+            # top k generations, across the views of all poses
             k = math.ceil(
                 max(config.top_k_min, config.top_k_gamma ** epoch) * len(gen_loss)
             )
@@ -178,7 +190,7 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         else:
             recon_loss = criterion(recon_2d, target_2d)
 
-        kld_loss = KLD(mean, logvar, decoder.name)
+        kld_loss = KLD(mean, logvar)
 
         # lambda_kld is used to compute the beta coeff
         loss = (
@@ -187,10 +199,12 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
             + config.lambda_disc * gen_loss
         )
         loss *= 10
+        mark_phase(config, "backward")
         loss.backward()  # Would include VAE and critic but critic not updated
 
-        D_G_z2 = output.mean().item()
+        D_G_z2 = torch.sigmoid(output).mean().detach()
 
+        mark_phase(config, "optimizer")
         if True:
             # Clip grad norm to 1 *****************************************
             nn.utils.clip_grad_norm_(encoder.parameters(), 2)
@@ -212,7 +226,8 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
             "critic_loss": critic_loss,
             "recon_2d": recon_2d,
             "recon_3d": recon_3d,
-            "novel_2d": novel_2d,
+            # first view of each pose, aligned with the targets for plots
+            "novel_2d": novel_2d[:: config.n_views],
             "target_2d": target_2d,
             "target_3d": target_3d,
             "D_x": D_x,
@@ -224,9 +239,11 @@ def _training_step(batch, batch_idx, model, config, optimizer, epoch):
         vae_optimizer.zero_grad(set_to_none=True)
         recon_loss = criterion(recon_3d, target_3d)
         # TODO clip kld loss to prevent explosion
-        kld_loss = KLD(mean, logvar, decoder.name)
+        kld_loss = KLD(mean, logvar)
         loss = recon_loss + config.beta * kld_loss
+        mark_phase(config, "backward")
         loss.backward()
+        mark_phase(config, "optimizer")
         vae_optimizer.step()
 
         logs = {"kld_loss": kld_loss, "recon_loss": recon_loss}
@@ -238,46 +255,17 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
     encoder = model[0].eval()
     decoder = model[1].eval()
 
-    inp, target_3d, criterion = get_inp_target_criterion(encoder, decoder, batch)
+    inp, target_3d, criterion = get_inp_target_criterion(unwrap(encoder), unwrap(decoder), batch)
 
     if config.p_miss:
-
-        pose = inp
-        pose2d_org = inp.clone()
-
-        # index of poses to be incomplete
-        incomplete_poses_ids = torch.multinomial(
-            torch.ones(pose.shape[0]),
-            int(pose.shape[0] * config.p_miss),
-            replacement=False,
-        )
-
-        # probablity to choose a joint to miss
-        p_limbs = [1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
-        p_limbs = torch.Tensor(p_limbs).to(pose.device)
-        p_limbs = p_limbs.repeat(len(incomplete_poses_ids), 1)
-
-        # 2 random joints to exclude for each missing pose
-        # make 0.5 of them to miss 1 joint only by duplicting the joint id
-        rand_joints = torch.multinomial(p_limbs, 2, replacement=False)
-        rand_joints[: rand_joints.shape[0] // 2][:, 1] = rand_joints[
-            : rand_joints.shape[0] // 2
-        ][:, 0]
-
-        # repeat incomplete pose ids for vectorization
-        incomplete_poses_ids = incomplete_poses_ids.view(-1, 1).repeat(1, 2)
-
-        # zero the random joints of the 'tobe' incomplete poses
-        pose[incomplete_poses_ids, rand_joints, :] = 0
-
-        inp = pose  # not needed
+        incomplete_poses_ids, rand_joints = miss_joints(inp, config.p_miss)
 
     mean, logvar = encoder(inp)
     # clip logvar to prevent inf when exp is calculated
     logvar = torch.clamp(logvar, max=30)
-    z = reparameterize(mean, logvar, eval)
+    z = Generator.reparameterize(mean, logvar, eval)
     recon_3d = decoder(z)
-    recon_3d = recon_3d.view(-1, model[0].n_joints, 3)
+    recon_3d = recon_3d.view(-1, unwrap(model[0]).n_joints, 3)
 
     if config.self_supervised:
         # criterion = nn.MSELoss()
@@ -288,15 +276,8 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
         # enforce unit recon if above root is scaled to 1
         recon_3d = recon_3d * 1.3
 
-        T = torch.tensor((0, 0, 10), device=recon_3d.device, dtype=recon_3d.dtype)
-
-        recon_2d = translate_and_project(recon_3d + T)
-
-        novel_3d_detach = random_rotate(recon_3d.detach())
-        novel_3d = random_rotate(recon_3d)
-
-        novel_2d = translate_and_project(novel_3d + T)
-        novel_2d_detach = translate_and_project(novel_3d_detach + T)
+        recon_2d = translate_and_project(recon_3d, 10)
+        novel_2d = rotate_and_project(recon_3d, 10, bank_size=config.rotation_bank)
 
         # Use the same fake for training critic and the generator
         novel_2d_detach = novel_2d.detach()
@@ -307,7 +288,7 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
         critic = model[2].eval()
         real_label = 1
         fake_label = 0
-        binary_loss = nn.BCELoss()
+        binary_loss = nn.BCEWithLogitsLoss()
 
         # validate on real samples
         labels = torch.full(
@@ -323,7 +304,7 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
 
         output = critic(noised_real)
         critic_loss_real = binary_loss(output, labels)
-        D_x = output.mean().item()
+        D_x = torch.sigmoid(output).mean().item()
 
         # validate on fake samples
         labels.fill_(fake_label)
@@ -334,7 +315,7 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
         # detach to avoid gradient prop to VAE
         output = critic(novel_2d_detach)
         critic_loss_fake = binary_loss(output, labels)
-        D_G_z1 = output.mean().item()
+        D_G_z1 = torch.sigmoid(output).mean().item()
 
         critic_loss = critic_loss_real + critic_loss_fake
         ################################################
@@ -366,7 +347,7 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
         else:
             recon_loss = criterion(recon_2d, target_2d)
 
-        kld_loss = KLD(mean, logvar, decoder.name)
+        kld_loss = KLD(mean, logvar)
 
         # lambda_kld is used to compute the beta coeff
         loss = (
@@ -376,7 +357,7 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
         )
         loss *= 10
 
-        D_G_z2 = output.mean().item()
+        D_G_z2 = torch.sigmoid(output).mean().item()
 
         logs = {
             "kld_loss": kld_loss,
@@ -401,7 +382,7 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
     else:
         recon_loss = criterion(recon_3d, target_3d)
         # TODO clip kld loss to prevent explosion
-        kld_loss = KLD(mean, logvar, decoder.name)
+        kld_loss = KLD(mean, logvar)
         loss = recon_loss + config.beta * kld_loss
 
         logs = {"kld_loss": kld_loss, "recon_loss": recon_loss}
@@ -416,18 +397,31 @@ def _validation_step(batch, batch_idx, model, epoch, config, eval=True):
     return OrderedDict({"loss": loss, "log": logs, "data": data, "epoch": epoch})
 
 
-def training_epoch(config, cb, model, train_loader, optimizer, epoch, vae_type):
+def training_epoch(config, cb, model, train_loader, optimizer, epoch, vae_type, n_pair=0):
     # note -- model.train() in training step
+    cb.on_epoch_start(config=config, epoch=epoch, n_pair=n_pair)
     for batch_idx, batch in enumerate(train_loader):
+        if batch_idx < config.skip_batches:
+            # resumed mid epoch, these batches were already trained on
+            if batch_idx == config.skip_batches - 1:
+                set_rng_state(config.resume_rng)
+                config.skip_batches = 0
+                # the skipped batches are not a data loader stall of the next step
+                reset_data_timer(config)
+            continue
+
+        cb.on_train_batch_start(config=config, epoch=epoch, n_pair=n_pair, batch_idx=batch_idx)
         for key in batch.keys():
             batch[key] = batch[key].to(config.device).float()
 
         output = _training_step(batch, batch_idx, model, config, optimizer, epoch)
 
+        mark_phase(config, "callbacks")
         cb.on_train_batch_end(
             config=config,
             vae_type=vae_type,
             epoch=epoch,
+            n_pair=n_pair,
             batch_idx=batch_idx,
             batch=batch,
             dataloader=train_loader,
@@ -443,8 +437,16 @@ def validation_epoch(
     # note -- model.eval() in validation step
     cb.on_validation_start()
 
-    t_data = defaultdict(list)
     loss_dic = defaultdict(int)
+    # errors accumulated batch by batch
+    metrics = StreamingMetrics()
+    # protocol 1 - MPJPE, protocol 2 - PA-MPJPE, action x subject x camera x joint
+    joints = Skeleton().joints
+    breakdowns = {
+        protocol: ErrorBreakdown(len(joints), joint_names=joints, action_names=ACTION_NAMES)
+        for protocol in ("p1", "p2")
+    }
+    is_3d = "3D" in unwrap(model[1]).name
 
     with torch.no_grad():
         for batch_idx, batch in enumerate(val_loader):
@@ -464,53 +466,50 @@ def validation_epoch(
                 loss_dic["D_G_z1"] += output["log"]["D_G_z1"]
                 loss_dic["D_G_z2"] += output["log"]["D_G_z2"]
 
-            for key in output["data"].keys():
-                t_data[key].append(output["data"][key])
-
-            del output
-            gc.collect()
+            if is_3d:
+                data = output["data"]
+                recon_3d, target_3d = data["recon_3d"], data["target_3d"]
+                samples = {key: data[key] for key in ("recon_2d", "novel_2d", "target_2d") if key in data}
+                samples["recon_3d_org"] = recon_3d
+                recon_p1, target_p1 = None, None
+                if normalize_pose or config.self_supervised:
+                    # PA-MPJPE is the main metric
+                    recon_p1, target_p1 = post_process(recon_3d, target_3d, procrustes=False)
+                    recon_3d, target_3d = post_process(recon_3d, target_3d, procrustes=True)
+                samples["recon_3d"], samples["target_3d"] = recon_3d, target_3d
+
+                # per sample per joint [n,j]
+                pjpe_ = PJPE(recon_3d, target_3d)
+                metrics.update(pjpe_, data["action"], samples)
+
+                if recon_p1 is not None:
+                    ids = (data["action"], batch["subject"], batch["camera"])
+                    breakdowns["p1"].update(PJPE(recon_p1, target_p1), *ids)
+                    breakdowns["p2"].update(pjpe_, *ids)
 
     avg_loss = loss_dic["loss"] / len(val_loader)  # return for scheduler
 
-    for key in t_data.keys():
-        t_data[key] = torch.cat(t_data[key], 0)
-
     # performance
-    t_data["recon_3d_org"] = t_data["recon_3d"].detach()
-    if "3D" in model[1].name:
-        if normalize_pose and not config.self_supervised:
-            t_data["recon_3d"], t_data["target_3d"] = post_process(
-                t_data["recon_3d"], t_data["target_3d"]
-            )
-
-        elif config.self_supervised:
-            t_data["recon_3d"], t_data["target_3d"] = post_process(
-                t_data["recon_3d"].to("cpu"),
-                t_data["target_3d"].to("cpu"),
-                # scale=t_data['scale_3d'].to('cpu'),
-                self_supervised=True,
-                procrustes_enabled=True,
-            )
-
-        # Speed up procrustes alignment with CPU!
-        t_data["recon_3d"].to(config.device)
-        t_data["target_3d"].to(config.device)
-
-        # per sample per joint [n,j]
-        pjpe_ = PJPE(t_data["recon_3d"], t_data["target_3d"])
-        # across all samples per joint [j]
-        avg_pjpe = torch.mean((pjpe_), dim=0)
+    mpjpe_pa, avg_mpjpe, avg_pjpe, pjpe, t_data = {}, None, None, None, {}
+    if is_3d:
+        result = metrics.compute()
         # across all samples all joint [1]
-        avg_mpjpe = torch.mean(avg_pjpe).item()
-        pjpe = torch.mean(pjpe_, dim=1)  # per sample all joints [n]
+        avg_mpjpe = result["mpjpe"]
+        # across all samples per joint [j]
+        avg_pjpe = result["per_joint"]
+        mpjpe_pa = result["per_action"]
+        # the worst samples are plotted
+        pjpe, t_data = result["worst_pjpe"], result["worst"]
+        t_data["reservoir"] = result["reservoir"]
 
-        actions = t_data["action"]
-        mpjpe_pa = {}  # per action
-        for i in torch.unique(actions):
-            res = torch.mean(pjpe[actions == i])
-            mpjpe_pa[i.item()] = res.item()
+        config.logger.log({"pjpe": result["reservoir_pjpe"].cpu()})
 
-        config.logger.log({"pjpe": pjpe.cpu()})
+        for protocol, breakdown in breakdowns.items():
+            if breakdown.counts is None:
+                continue
+            config.logger.log({f"{vae_type}_mpjpe_{protocol}": breakdown.summary()["mpjpe"]})
+            if config.report_dir:
+                breakdown.save(f"{config.report_dir}/{config.run_name}_{vae_type}_epoch_{epoch}_{protocol}")
 
     cb.on_validation_end(
         config=config,
@@ -525,7 +524,6 @@ def validation_epoch(
         t_data=t_data,
     )
 
-    del loss_dic, t_data
     return avg_loss
 
 
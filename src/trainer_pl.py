@@ -1,13 +1,13 @@
 import math
 
 from torch.nn.utils.clip_grad import clip_grad_value_
-from utils import PJPE, auto_init_args
-from typing import Any, Dict, List, Tuple, Type
+from utils import PJPE, auto_init_args, get_rng_state, set_rng_state
+from typing import Any, Dict, List, Optional, Tuple, Type
 import pytorch_lightning as pl
 import torch.nn.functional as F
-from models import Discriminator, Generator
+from models import LBAD, Discriminator, FusedLBAD, Generator
 import torch
-from processing import post_process, translate_and_project, random_rotate, scale_3d
+from processing import post_process, translate_and_project, rotate_and_project, scale_3d
 from torch.nn.utils import clip_grad_norm_
 
 
@@ -20,42 +20,48 @@ class VAEGAN(pl.LightningModule):
         super().__init__()
         auto_init_args(self)
         self.opt = opt
-        self.generator = Generator(opt.latent_dim)
-        self.discriminator = Discriminator()
+        block = FusedLBAD if opt.fused_blocks else LBAD
+        self.generator = Generator(opt.latent_dim, block=block)
+        self.discriminator = Discriminator(block=block)
         self.automatic_optimization = False
         self.project_dist = 10
         self.w_recon = opt.lambda_recon
         self.w_g = opt.lambda_g
         self.betas = BetaCycling(4, 0.5, opt.epochs, 0, opt.lambda_kld)
         self.w_kld = self.betas.next()
+        # detached per step metrics summed on device, read once at the end of the epoch
+        self.epoch_metrics: Dict[str, torch.Tensor] = {}
+        self.n_steps = 0
+        self.generator_step = self.generator_pass
+        self.discriminator_step = self.discriminator_pass
+        self.adversarial_step = self.adversarial_pass
+        if opt.compile:
+            if hasattr(torch, "compile"):
+                # dynamic shapes for the last batch and the top k that shrinks every epoch
+                self.generator_step = torch.compile(self.generator_pass, dynamic=True)
+                self.discriminator_step = torch.compile(self.discriminator_pass, dynamic=True)
+                self.adversarial_step = torch.compile(self.adversarial_pass, dynamic=True)
+            else:
+                print("[WARNING]: torch.compile not available, training step runs eagerly")
 
     def forward(self, x):
         return self.generator(x)
 
     def training_step(self, batch, batch_idx):
         """TODO add noise for disc. training"""
-        inp, target = batch["pose2d"].detach(), batch["pose2d"].detach()
-        recon_3d, mean, logvar = self.generator(inp)
-        recon_2d = translate_and_project(recon_3d, self.project_dist)
-        loss_recon = self.recon_loss(recon_2d, target, batch["mask"])
-        loss_kld = self.kld_loss(mean, logvar)
-        # fakes to train G and D
-        novel_2d = translate_and_project(random_rotate(recon_3d), self.project_dist)
-        reals, fakes = self.get_label(inp)
+        inp = batch["pose2d"].detach()
+        with self.autocast():
+            novel_2d, loss_recon, loss_kld = self.generator_step(inp, batch["mask"])
+        # fakes to train G and D, labels of the fakes for every view
+        reals, _ = self.get_label(inp)
+        novel_reals, fakes = self.get_label(novel_2d)
         opt_g, opt_d = self.optimizers()
 
         """Train D"""
         opt_d.zero_grad(set_to_none=True)
-        # with real
-        out = self.discriminator(inp)
-        loss_d_real = self.adversarial_loss(out, reals)
-        self.manual_backward(loss_d_real)
-        D_x = out.mean().item()
-        # with fake
-        out = self.discriminator(novel_2d.detach())
-        loss_d_fake = self.adversarial_loss(out, fakes)
-        self.manual_backward(loss_d_fake)
-        D_G_z1 = out.mean().item()
+        with self.autocast():
+            loss_d_real, loss_d_fake, D_x, D_G_z1 = self.discriminator_step(inp, novel_2d.detach(), reals, fakes)
+        self.manual_backward(loss_d_real + loss_d_fake)
         loss_d = (loss_d_real + loss_d_fake) / 2
         clip_grad_norm_(self.discriminator.parameters(), 1)
         opt_d.step()
@@ -63,34 +69,70 @@ class VAEGAN(pl.LightningModule):
         """Train G"""
         opt_g.zero_grad(set_to_none=True)
         # with same fake/ novel_2d sample
-        out = self.discriminator(novel_2d)
-        loss_g = self.adversarial_loss(out, reals, top_k=True)  # includes Enc.
+        with self.autocast():
+            # top k across the views of all poses
+            loss_g, D_G_z2 = self.adversarial_step(novel_2d, novel_reals, self.top_k(len(novel_2d)))  # includes Enc.
         loss_vae = self.w_g * loss_g + self.w_recon * loss_recon + self.w_kld * loss_kld
         # G -> realistic + proj recon acc. | Would be diff. if only decoder is G.
         self.manual_backward(loss_vae)
-        D_G_z2 = out.mean().item()
         clip_grad_norm_(self.generator.parameters(), 1)
         clip_grad_value_(self.generator.parameters(), 1000)
         if batch_idx % self.opt.disc_freq == 0:
             opt_g.step()
 
-        self.log_dict(
-            {
-                "loss_recon": loss_recon,
-                "loss_kld": loss_kld,
-                "loss_g": loss_g,
-                "loss_d": loss_d,
-                "D_x": D_x,
-                "D_G_z1": D_G_z1,
-                "D_G_z2": D_G_z2,
-            },
-            on_step=True,
-            on_epoch=False,
-            prog_bar=True,
-            logger=True,
-        )
+        metrics = {
+            "loss_recon": loss_recon,
+            "loss_kld": loss_kld,
+            "loss_g": loss_g,
+            "loss_d": loss_d,
+            "D_x": D_x,
+            "D_G_z1": D_G_z1,
+            "D_G_z2": D_G_z2,
+        }
+        self.accumulate(metrics)
+        if not self.opt.compile:
+            self.log_dict(metrics, on_step=True, on_epoch=False, prog_bar=True, logger=True)
         return loss_vae
 
+    def autocast(self):
+        """bf16 autocast for the forward passes. Weights, grads, clipping and optimizer steps stay in fp32,
+        so no loss scaling is needed"""
+        return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.opt.bf16)
+
+    def generator_pass(self, inp: torch.Tensor, mask: torch.Tensor):
+        """reconstruction losses and the novel 2D views of the generated 3D poses"""
+        recon_3d, mean, logvar = self.generator(inp)
+        # projection and losses in fp32 under autocast
+        recon_3d, mean, logvar = recon_3d.float(), mean.float(), logvar.float()
+        recon_2d = translate_and_project(recon_3d, self.project_dist)
+        loss_recon = self.recon_loss(recon_2d, inp, mask)
+        loss_kld = self.kld_loss(mean, logvar)
+        # n_views novel views of each pose [b*n_views, j, 2] from one rotate and project
+        novel_3d = recon_3d.repeat_interleave(self.opt.n_views, dim=0) if self.opt.n_views > 1 else recon_3d
+        novel_2d = rotate_and_project(novel_3d, self.project_dist, bank_size=self.opt.rotation_bank)
+        return novel_2d, loss_recon, loss_kld
+
+    def discriminator_pass(self, inp: torch.Tensor, novel_2d: torch.Tensor, reals: torch.Tensor, fakes: torch.Tensor):
+        """discriminator losses on reals and fakes, and its mean outputs D(x), D(G(z))"""
+        out_real = self.discriminator(inp).float()
+        out_fake = self.discriminator(novel_2d).float()
+        loss_d_real = self.adversarial_loss(out_real, reals)
+        loss_d_fake = self.adversarial_loss(out_fake, fakes)
+        D_x, D_G_z = torch.sigmoid(out_real).mean(), torch.sigmoid(out_fake).mean()
+        return loss_d_real, loss_d_fake, D_x.detach(), D_G_z.detach()
+
+    def adversarial_pass(self, novel_2d: torch.Tensor, reals: torch.Tensor, k: int):
+        """generator loss to fool the discriminator, over the k most realistic fakes"""
+        out = self.discriminator(novel_2d).float()
+        loss_g = self.adversarial_loss(out, reals, top_k=True, k=k)
+        return loss_g, torch.sigmoid(out).mean().detach()
+
+    def accumulate(self, metrics: Dict[str, torch.Tensor]) -> None:
+        for key, val in metrics.items():
+            val = val.detach()
+            self.epoch_metrics[key] = self.epoch_metrics[key] + val if key in self.epoch_metrics else val
+        self.n_steps += 1
+
     def validation_step(self, batch, batch_idx):
         inp, target = batch["pose2d"].detach(), batch["pose2d"].detach()
         recon_3d, mean, logvar = self.generator(inp)
@@ -113,7 +155,27 @@ class VAEGAN(pl.LightningModule):
     #     # TODO log at the end of epoch - few gens
     #     return None
 
+    def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        # lightning saves the weights, optimizers and epoch, the beta cycle and RNG are ours
+        checkpoint["betas"] = self.betas.state_dict()
+        checkpoint["w_kld"] = self.w_kld
+        checkpoint["rng"] = get_rng_state()
+
+    def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        if "betas" in checkpoint:
+            self.betas.load_state_dict(checkpoint["betas"])
+            self.w_kld = checkpoint["w_kld"]
+            set_rng_state(checkpoint["rng"])
+
     def training_epoch_end(self, training_step_outputs) -> None:
+        if self.opt.compile and self.n_steps:
+            # single device sync for the epoch
+            self.log_dict(
+                {key: val / self.n_steps for key, val in self.epoch_metrics.items()},
+                on_step=False, on_epoch=True, prog_bar=True, logger=True,
+            )
+        self.epoch_metrics = {}
+        self.n_steps = 0
         self.w_kld = self.betas.next()
         print("[INFO]: Cyling beta to ", self.w_kld)
 
@@ -133,11 +195,14 @@ class VAEGAN(pl.LightningModule):
 
         return [opt_g, opt_d], []  # TODO scheduler
 
-    def top_k_grad(self, loss):
-        k = math.ceil(
-            max(self.opt.top_k_min, self.opt.top_k_gamma ** self.current_epoch)
-            * len(loss)
+    def top_k(self, n: int) -> int:
+        return math.ceil(
+            max(self.opt.top_k_min, self.opt.top_k_gamma ** self.current_epoch) * n
         )
+
+    def top_k_grad(self, loss, k: Optional[int] = None):
+        if k is None:
+            k = self.top_k(len(loss))
         loss, top_k_indices = loss.topk(k=k, largest=False, dim=0)
         return loss
 
@@ -163,21 +228,23 @@ class VAEGAN(pl.LightningModule):
             reals = reals * noise.to(reals.device).type_as(reals)
         return reals, fakes
 
-    def adversarial_loss(self, y_hat, y, reduction: str = "mean", top_k: bool = False):
+    def adversarial_loss(self, y_hat, y, reduction: str = "mean", top_k: bool = False, k: Optional[int] = None):
+        """binary cross entropy on the discriminator logits"""
         if top_k:
-            loss = F.binary_cross_entropy(y_hat, y, reduction="none")
-            loss = torch.mean(self.top_k_grad(loss))
+            loss = F.binary_cross_entropy_with_logits(y_hat, y, reduction="none")
+            loss = torch.mean(self.top_k_grad(loss, k))
             if reduction == "mean":
                 return torch.mean(loss)
             if reduction == "sum":
                 return torch.sum(loss)
 
-        return F.binary_cross_entropy(y_hat, y, reduction=reduction)
+        return F.binary_cross_entropy_with_logits(y_hat, y, reduction=reduction)
 
     @staticmethod
     def recon_loss(y_hat, y, occlusion_mask=None):
-        if (occlusion_mask != None) and (0 in occlusion_mask):
-            y_hat *= occlusion_mask  # 0 if occluded, occlusion is 0 in y
+        if occlusion_mask is not None:
+            # 0 if occluded, occlusion is 0 in y. unconditional to avoid a device sync
+            y_hat = y_hat * occlusion_mask
         return F.l1_loss(y_hat, y)
 
     @staticmethod
@@ -223,3 +290,10 @@ class BetaCycling:
         value = self.values[self.curr_idx]
         self.curr_idx += 1
         return value
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"values": self.values, "curr_idx": self.curr_idx}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self.values = state["values"]
+        self.curr_idx = state["curr_idx"]
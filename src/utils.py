@@ -1,3 +1,6 @@
+import random
+
+import numpy as np
 import torch
 import torch.nn.functional as F
 
@@ -51,6 +54,26 @@ def KLD(mean, logvar):
     # loss /= mean.shape[0] * 16 * 3
 
 
+def get_rng_state() -> dict:
+    """states of all the random generators used in training"""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
 def auto_init_args(obj, tgt=None, can_overwrite=False):
     """Source - https://github.com/facebookresearch/c3dpo_nrsfm/blob/aa558fd0cc10a704706a6c9704b221f7a42f5f80/tools/utils.py#L44"""
     import inspect
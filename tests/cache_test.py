@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src.datasets import cache as cache_module
+from src.datasets.cache import NpyCache
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        self.source = os.path.join(self.tmp.name, "h36m_train.h5")
+        with open(self.source, "wb") as f:
+            f.write(b"poses")
+        self.params = {"is_ss": True, "debug": False}
+        self.n_builds = 0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def build(self):
+        self.n_builds += 1
+        return {"pose2d": np.arange(6, dtype=np.float64).reshape(3, 2)}
+
+    def test_hit_miss_and_params(self):
+        cache = NpyCache(self.cache_dir, self.source, self.params)
+        data = cache.get(["pose2d"], self.build)
+        self.assertEqual(self.n_builds, 1)
+        self.assertEqual(data["pose2d"].dtype, np.float32)
+        self.assertTrue(np.array_equal(data["pose2d"], self.build()["pose2d"]))
+
+        # hit, the content hash is not computed again for an unchanged file
+        self.n_builds = 0
+        with mock.patch.object(cache_module, "file_hash") as file_hash:
+            NpyCache(self.cache_dir, self.source, self.params).get(["pose2d"], self.build)
+            file_hash.assert_not_called()
+        self.assertEqual(self.n_builds, 0)
+
+        # another param set is a miss and leaves the first entry alone
+        debug = NpyCache(self.cache_dir, self.source, {**self.params, "debug": True})
+        self.assertNotEqual(debug.path, cache.path)
+        debug.get(["pose2d"], self.build)
+        debug.evict_stale()
+        self.assertEqual(self.n_builds, 1)
+        self.assertTrue(cache.exists(["pose2d"]))
+
+    def test_evict_stale_data(self):
+        old = NpyCache(self.cache_dir, self.source, self.params)
+        old.get(["pose2d"], self.build)
+        other = NpyCache(self.cache_dir, self.source, {**self.params, "is_ss": False})
+        other.get(["pose2d"], self.build)
+
+        with open(self.source, "wb") as f:
+            f.write(b"new poses")
+        new = NpyCache(self.cache_dir, self.source, self.params)
+        self.assertNotEqual(new.path, old.path)
+        new.get(["pose2d"], self.build)
+        new.evict_stale()
+
+        # only the entry of the same params with older data is removed
+        self.assertFalse(os.path.exists(old.path))
+        self.assertTrue(new.exists(["pose2d"]))
+        self.assertTrue(other.exists(["pose2d"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
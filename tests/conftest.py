@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the tests import src.*, the training code in src imports its modules bare (from processing import ...)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "src")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
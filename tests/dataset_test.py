@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from src.dataset import METADATA_KEYS, H36M
+
+
+class DatasetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "h36m_test.h5")
+        rng = np.random.RandomState(0)
+        n = 8
+        self.data = {
+            "pose2d": rng.rand(n, 16, 2).astype(np.float32),
+            "pose3d": rng.rand(n, 16, 3).astype(np.float32),
+            "idx": np.arange(n),
+            "subject": np.full(n, 9),
+            "camera": rng.randint(1, 5, n),
+            "subaction": np.zeros(n, dtype=np.int64),
+            "action": rng.randint(2, 17, n),
+        }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, keys):
+        with h5py.File(self.path, "w") as h5:
+            for key in keys:
+                h5.create_dataset(key, data=self.data[key])
+
+    def test_eval_metadata(self):
+        self.write(self.data.keys())
+        batch = H36M(self.path, is_train=False)[[0, 1, 2]]
+        for key in METADATA_KEYS:
+            self.assertTrue(np.array_equal(batch[key].numpy(), self.data[key][:3]))
+
+        # training on 2D poses only needs the poses
+        train = H36M(self.path, is_train=True)
+        self.assertEqual(train.keys, ["pose2d", "idx"])
+
+    def test_missing_metadata(self):
+        self.write(["pose2d", "pose3d", "idx"])
+        with self.assertRaises(KeyError):
+            H36M(self.path, is_train=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
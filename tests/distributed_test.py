@@ -0,0 +1,58 @@
+import glob
+import socket
+import tempfile
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from src import distributed, train
+from src.models import Generator
+from helpers import training_config
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class DistributedTestCase(unittest.TestCase):
+
+    def test_single_process_fallback(self):
+        model = Generator(latent_dim=8, neurons=32)
+        self.assertFalse(distributed.is_distributed())
+        self.assertTrue(distributed.is_main_process())
+        self.assertIs(distributed.wrap(model, torch.device("cpu")), model)
+        self.assertIs(distributed.unwrap(torch.nn.DataParallel(model)), model)
+
+    @unittest.skipUnless(dist.is_available() and dist.is_gloo_available(), "torch built without gloo")
+    def test_ddp_gloo(self):
+        with tempfile.TemporaryDirectory() as root:
+            world_size = 2
+            config = training_config(
+                root, "--world_size", str(world_size), "--port", str(free_port()), "--epochs", "2",
+                "--validation_interval", "1", "--report_dir", f"{root}/reports", "--exp_name", "ddp",
+            )
+            # the training loop of train.py in each process, on a shard of the data
+            # the workers are spawned, they get this process's sys.path with src from tests/conftest.py
+            mp.spawn(train.run, args=(config,), nprocs=world_size)
+
+            # the training state of each process after the last epoch
+            states = [torch.load(f"{root}/state/ddp_state{rank}.pt", weights_only=False) for rank in ("", "_rank1")]
+            # validation on rank 0 filled the per subject and camera tables
+            reports = glob.glob(f"{root}/reports/*_p2.csv")
+
+        # gradients are averaged, so all processes stay in sync. batch norm statistics are per process
+        self.assertEqual(states[0]["epoch"], 2)
+        for key, state in states[0]["models"].items():
+            for name, val in state.items():
+                if "running" in name or "num_batches" in name:
+                    continue
+                self.assertTrue(torch.allclose(val, states[1]["models"][key][name]), f"{key}.{name} diverged")
+        self.assertEqual(len(reports), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
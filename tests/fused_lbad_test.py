@@ -0,0 +1,66 @@
+import unittest
+
+import torch
+
+from src import inference
+from src.models import LBAD, FusedLBAD, Generator
+from src.utils import Mish
+
+
+class FusedLBADTestCase(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.block = LBAD(32, Mish, 0.2, use_bn=True)
+        self.fused = FusedLBAD(32, Mish, 0.2, use_bn=True)
+        # non trivial running stats
+        self.block.train()
+        self.block(torch.randn(64, 32))
+        self.fused.load_state_dict(self.block.state_dict())
+        self.block.eval()
+        self.fused.eval()
+        self.x = torch.randn(8, 32)
+
+    def assertMatches(self):
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(self.fused(self.x), self.block(self.x), atol=1e-5))
+
+    def test_in_place_updates_in_eval(self):
+        self.assertMatches()
+        # updates that keep the module in eval and without grad, eg. EMA or a broadcast
+        with torch.no_grad():
+            for block in (self.block, self.fused):
+                block.w1.weight.mul_(0.5)
+                block.bn1.running_var.copy_(torch.rand(32) + 0.5)
+                block.bn1.bias.add_(1)
+        self.assertMatches()
+
+    def test_generator(self):
+        generator = Generator(latent_dim=8, neurons=32).eval()
+        fused = Generator(latent_dim=8, neurons=32, block=FusedLBAD).eval()
+        fused.load_state_dict(generator.state_dict())
+        x = torch.randn(4, 15, 2)
+        with torch.no_grad():
+            fused(x)
+            for p, q in zip(generator.parameters(), fused.parameters()):
+                p.add_(0.01)
+                q.add_(0.01)
+            self.assertTrue(torch.allclose(fused(x)[0], generator(x)[0], atol=1e-4))
+
+    def test_quantized_lifter(self):
+        # the classes of the models module imported by inference, fuse_for_inference checks for its LBAD
+        generator = inference.Generator(latent_dim=8, neurons=32, block=inference.FusedLBAD)
+        lifter = inference.Lifter(generator)
+        quantized = inference.quantize(lifter)
+        # the fused blocks run the int8 Linear
+        block = quantized.encoder.features.BB_1
+        self.assertTrue(block.fused)
+        self.assertNotIsInstance(block.w1, torch.nn.Linear)
+        x = torch.randn(4, 15, 2)
+        recon = quantized.predict(x)
+        self.assertEqual(recon.shape, (4, 15, 3))
+        self.assertTrue(torch.allclose(recon, lifter.predict(x), atol=0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import h5py
+import numpy as np
+import torch
+
+from src import train, train_utils
+from src.distributed import NullLogger
+from src.models import Discriminator
+
+
+def write_h36m(path, n, seed=0):
+    """h5 file with the keys of the H36M data files and n random poses"""
+    rng = np.random.RandomState(seed)
+    data = {
+        "pose2d": rng.rand(n, 16, 2).astype(np.float32),
+        "pose3d": rng.rand(n, 16, 3).astype(np.float32),
+        "idx": np.arange(n),
+        "subject": np.full(n, 9),
+        "camera": rng.randint(1, 5, n),
+        "subaction": np.zeros(n, dtype=np.int64),
+        "action": rng.randint(2, 17, n),
+    }
+    with h5py.File(path, "w") as h5:
+        for key, val in data.items():
+            h5.create_dataset(key, data=val)
+    return data
+
+
+def training_config(root, *args, n_train=24, n_test=8):
+    """train.py config on cpu with small random h5 files in root, args are extra command line args"""
+    write_h36m(f"{root}/train.h5", n_train, seed=0)
+    write_h36m(f"{root}/test.h5", n_test, seed=1)
+    return train.get_argparser().parse_args([
+        "--train_file", f"{root}/train.h5", "--test_file", f"{root}/test.h5",
+        "--fast_dev_run", "false", "--epochs", "1", "--batch_size", "4",
+        "--cuda", "false", "--num_workers", "0", "--pin_memory", "false",
+        "--state_dir", f"{root}/state", "--save_dir", f"{root}/checkpoints",
+        "--runs_dir", f"{root}/runs", "--log_dir", f"{root}/logs",
+        "--profile_dir", f"{root}/profiles", "--log_image_interval", "0",
+        *args,
+    ])
+
+
+def training_setup(config, seed=0):
+    """the models and optimizers of train.run for the 2d to 3d pair, for a single process training_epoch
+
+    Returns:
+        Tuple: models dict, optimizers, schedulers and the model and optimizer lists of training_epoch
+    """
+    torch.manual_seed(seed)
+    config.device = torch.device("cpu")
+    config.logger = NullLogger
+    config.beta = 0
+    config.skip_batches = 0
+
+    models = train_utils.get_models([['2d', '3d']], config)
+    models['Critic'] = Discriminator()
+    optimizers = train_utils.get_optims([['2d', '3d']], models, config)
+    schedulers = train_utils.get_schedulers(optimizers, config)
+    model = [models['Encoder2D'], models['Decoder3D'], models['Critic']]
+    optimizer = [optimizers[0], optimizers[-1]]
+    return models, optimizers, schedulers, model, optimizer
@@ -0,0 +1,29 @@
+import unittest
+
+import numpy as np
+import torch
+
+from src.inference import Lifter
+from src.models import Generator
+
+
+class InferenceTestCase(unittest.TestCase):
+
+    def test_lift_independent_of_batch(self):
+        torch.manual_seed(0)
+        lifter = Lifter(Generator(latent_dim=8, neurons=32))
+        poses = np.random.RandomState(0).randn(6, 16, 2).astype(np.float32)
+        poses[3] *= 5  # a pose of another size changes the mean scale of the batch
+
+        batch = lifter.lift(poses)
+        alone = lifter.lift(poses[2:3])
+        self.assertEqual(batch.shape, (6, 16, 3))
+        self.assertTrue(np.allclose(batch[2], alone[0], atol=1e-5))
+
+        # the scale of a pose does not matter either
+        scaled = lifter.lift(poses[2:3] * 3)
+        self.assertTrue(np.allclose(scaled[0], alone[0], atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import json
+import tempfile
+import unittest
+from argparse import Namespace
+
+import torch
+
+from src.loggers import LocalLogger, MetricBuffer
+
+
+class LoggersTestCase(unittest.TestCase):
+
+    def test_metric_buffer(self):
+        buffer = MetricBuffer()
+        for i in range(4):
+            buffer.add({"loss": torch.tensor(float(i)), "lr": 0.1})
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.means(), {"lr": 0.1, "loss": 1.5})
+        self.assertEqual(len(buffer), 0)
+
+    def test_local_logger(self):
+        with tempfile.TemporaryDirectory() as root:
+            config = Namespace(epochs=2, device=torch.device("cpu"), logger=None)
+            logger = LocalLogger(root, config, name="run")
+            logger.log({"run": {"train": {"loss": torch.tensor(0.5)}}}, commit=False)
+            logger.log({"epoch": 1})
+            logger.finish()
+
+            with open(f"{root}/run/metrics.jsonl") as f:
+                lines = [json.loads(line) for line in f]
+            with open(f"{root}/run/config.json") as f:
+                snapshot = json.load(f)
+
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]["run/train/loss"], 0.5)
+        self.assertEqual(lines[0]["epoch"], 1)
+        self.assertEqual(snapshot, {"epochs": 2, "device": "cpu"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+import torch
+
+from src.metrics import ErrorBreakdown, StreamingMetrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.pjpe = torch.rand(1000, 16) * 100
+        self.action = torch.randint(2, 17, (1000,))
+        self.subject = torch.tensor([9, 11]).repeat(500)
+        self.camera = torch.randint(1, 5, (1000,))
+
+    def test_streaming_metrics(self):
+        metrics = StreamingMetrics(n_samples=64, n_worst=2, keep_pjpe=True)
+        for pjpe, action in zip(self.pjpe.split(96), self.action.split(96)):
+            metrics.update(pjpe, action, {"pjpe": pjpe})
+        result = metrics.compute()
+
+        per_sample = self.pjpe.mean(dim=1)
+        self.assertAlmostEqual(result["mpjpe"], self.pjpe.mean().item(), places=3)
+        self.assertTrue(torch.allclose(result["per_joint"], self.pjpe.mean(dim=0), atol=1e-3))
+        for action, val in result["per_action"].items():
+            self.assertAlmostEqual(val, per_sample[self.action == action].mean().item(), places=3)
+        self.assertTrue(torch.equal(result["pjpe"], per_sample))
+        self.assertEqual(len(result["reservoir_pjpe"]), 64)
+        self.assertTrue(torch.equal(result["worst_pjpe"], per_sample.topk(2).values))
+        # reservoir samples are kept with their errors
+        self.assertTrue(torch.allclose(result["reservoir"]["pjpe"].mean(dim=1), result["reservoir_pjpe"]))
+        # and their positions in pjpe
+        self.assertTrue(torch.equal(result["pjpe"][result["reservoir_index"]], result["reservoir_pjpe"]))
+        self.assertTrue(torch.equal(result["worst_index"], per_sample.topk(2).indices))
+
+    def test_error_breakdown(self):
+        breakdown = ErrorBreakdown(16)
+        for pjpe, action, subject, camera in zip(
+            self.pjpe.split(96), self.action.split(96), self.subject.split(96), self.camera.split(96)
+        ):
+            breakdown.update(pjpe, action, subject, camera)
+        summary = breakdown.summary()
+
+        per_sample = self.pjpe.mean(dim=1)
+        self.assertEqual(summary["count"], 1000)
+        self.assertAlmostEqual(summary["mpjpe"], self.pjpe.mean().item(), places=3)
+        for subject, val in summary["per_subject"].items():
+            self.assertAlmostEqual(val, per_sample[self.subject == subject].mean().item(), places=3)
+        for camera, val in summary["per_camera"].items():
+            self.assertAlmostEqual(val, per_sample[self.camera == camera].mean().item(), places=3)
+
+        rows = breakdown.rows()
+        self.assertEqual(sum(row["count"] for row in rows), 1000)
+        row = rows[0]
+        mask = (self.action == row["action"]) & (self.subject == row["subject"]) & (self.camera == row["camera"])
+        self.assertAlmostEqual(row["mpjpe"], per_sample[mask].mean().item(), places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
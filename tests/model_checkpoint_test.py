@@ -0,0 +1,46 @@
+import json
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+
+import torch
+
+from src.callbacks.model_checkpoint import ModelCheckpoint
+from src.loggers import LocalLogger
+
+
+class ModelCheckpointTestCase(unittest.TestCase):
+
+    def test_best_checkpoint_with_local_logger(self):
+        with tempfile.TemporaryDirectory() as root:
+            # checkpoints are skipped on cpu, the models themselves stay on cpu
+            config = Namespace(device=torch.device("cuda"), save_dir=root, mpjpe=40.0, mpjpe_min=50.0)
+            config.logger = LocalLogger(f"{root}/runs", config, name="run")
+            model = torch.nn.Linear(2, 2)
+            model.name = "Encoder2D"
+            optimizer = torch.optim.Adam(model.parameters())
+
+            checkpoint = ModelCheckpoint(keep_last=1)
+            checkpoint.on_epoch_end(config=config, val_loss=1.0, model=[model],
+                                    optimizers=[optimizer], epoch=1, n_pair=0)
+            checkpoint.teardown()
+            config.logger.finish()
+
+            with open(f"{root}/runs/run/config.json") as f:
+                snapshot = json.load(f)
+            with open(f"{root}/runs/run/files.txt") as f:
+                files = f.read().split()
+            best = os.path.abspath(f"{root}/run_Encoder2D.pt")
+            state = torch.load(best)
+
+            self.assertEqual(config.mpjpe_min, 40.0)
+            self.assertEqual(snapshot["mpjpe_min"], 40.0)
+            self.assertIn(best, files)
+            self.assertTrue(os.path.exists(f"{root}/run_Encoder2D_epoch_1.pt"))
+            self.assertTrue(os.path.exists(f"{root}/run_optimizer_0.pt"))
+            self.assertEqual(state["epoch"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+import torch
+
+from src.datasets.skeleton import Skeleton
+from src.processing import (batch_procrustes, preprocess, random_rotate, rotate_and_project, scipy_procrustes,
+                            translate_and_project, zero_the_root)
+
+
+class ProcessingTestCase(unittest.TestCase):
+
+    def test_batch_procrustes(self):
+        torch.manual_seed(0)
+        target = torch.randn(64, 15, 3)
+        recon = torch.randn(64, 15, 3)
+
+        aligned = batch_procrustes(target, recon)
+        expected = scipy_procrustes(target, recon)
+
+        self.assertEqual(aligned.shape, target.shape)
+        self.assertTrue(torch.allclose(aligned, expected, atol=1e-4))
+
+    def test_batch_procrustes_recovers_rigid_transform(self):
+        torch.manual_seed(0)
+        target = torch.randn(8, 15, 3)
+        q, _ = torch.linalg.qr(torch.randn(8, 3, 3))
+        recon = 2.5 * torch.matmul(target, q) + torch.randn(8, 1, 3)
+
+        aligned = batch_procrustes(target, recon)
+
+        self.assertTrue(torch.allclose(aligned, target, atol=1e-4))
+
+    def test_zero_the_root(self):
+        poses = np.random.rand(10, 16, 3)
+        zeroed = zero_the_root(poses.copy(), root_idx=3)
+
+        expected = np.delete(poses - poses[:, 3:4], 3, 1)
+        self.assertTrue(np.allclose(zeroed, expected))
+        self.assertTrue(np.allclose(zero_the_root(poses.copy(), 3, inplace=True), expected))
+
+    def test_preprocess_numpy_torch(self):
+        skel = Skeleton()
+        poses = np.random.rand(32, 16, 2).astype(np.float32)
+
+        out_np = preprocess(poses.copy(), skel.joints, skel.root_idx)
+        out_torch = preprocess(torch.from_numpy(poses), skel.joints, skel.root_idx)
+
+        self.assertEqual(out_np.shape, (32, 15, 2))
+        self.assertTrue(np.allclose(out_np, out_torch.numpy(), atol=1e-6))
+
+    def test_rotate_and_project(self):
+        poses = torch.randn(16, 15, 3)
+        # fixed angles, the fused pass and the bank should match rotating then projecting
+        angles = dict(roll_range=(0.3, 0.3), azimuth_range=(-0.2, -0.2), elevation_range=(1.1, 1.1))
+
+        expected = translate_and_project(random_rotate(poses, **angles), 10)
+        self.assertTrue(torch.allclose(rotate_and_project(poses, 10, **angles), expected, atol=1e-5))
+        self.assertTrue(torch.allclose(rotate_and_project(poses, 10, bank_size=4, **angles), expected, atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
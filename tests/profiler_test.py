@@ -0,0 +1,74 @@
+import json
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+
+from helpers import training_config, training_setup
+from src.callbacks import CallbackList
+from src.callbacks.profiler import Profiler, mark_phase, reset_data_timer
+from src.dataloader import train_dataloader
+from src.trainer import training_epoch
+from src.utils import get_rng_state
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def test_chrome_trace(self):
+        with tempfile.TemporaryDirectory() as trace_dir:
+            config = Namespace(device="cpu", exp_name="run")
+            profiler = Profiler(trace_dir)
+            profiler.setup(config=config)
+            profiler.on_epoch_start(config=config)
+
+            # the batches skipped on resume are not a stall
+            time.sleep(0.05)
+            reset_data_timer(config)
+
+            n_steps = 3
+            for batch_idx in range(n_steps):
+                profiler.on_train_batch_start(config=config, batch_idx=batch_idx)
+                mark_phase(config, "generator")
+                mark_phase(config, "critic")
+                time.sleep(0.001)
+                mark_phase(config, "callbacks")
+                profiler.on_train_batch_end(config=config, batch_idx=batch_idx)
+            profiler.on_train_end(config=config, epoch=1)
+            profiler.teardown(config=config)
+
+            with open(f"{trace_dir}/run_profile.json") as f:
+                trace = json.load(f)
+
+        self.assertIsNone(config.profiler)
+        events = trace["traceEvents"]
+        totals = trace["otherData"]
+        for phase in ("data", "to_device", "generator", "critic", "callbacks"):
+            self.assertEqual(totals[phase]["count"], n_steps)
+            self.assertEqual(sum(event["name"] == phase for event in events), n_steps)
+        self.assertTrue(all(event["ph"] == "X" and event["dur"] >= 0 for event in events))
+        self.assertGreaterEqual(totals["critic"]["wall"], n_steps * 0.001)
+        self.assertLess(totals["data"]["wall"], 0.05)
+
+    def test_training_epoch(self):
+        with tempfile.TemporaryDirectory() as root:
+            config = training_config(root, "--exp_name", "run")
+            models, optimizers, schedulers, model, optimizer = training_setup(config)
+            cb = CallbackList([Profiler(config.profile_dir)])
+            cb.setup(config=config)
+
+            # resumed after 2 of the 6 steps
+            config.skip_batches = 2
+            config.resume_rng = get_rng_state()
+            training_epoch(config, cb, model, train_dataloader(config), optimizer, 1, "2d_2_3d")
+            cb.teardown(config=config)
+
+            with open(f"{root}/profiles/run_profile.json") as f:
+                totals = json.load(f)["otherData"]
+
+        # phases marked in the steps of the train.py loop
+        for phase in ("data", "to_device", "generator", "critic", "generator_loss", "backward", "optimizer", "callbacks"):
+            self.assertEqual(totals[phase]["count"], 4, phase)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,194 @@
-import os
-import h5py
-from src.processing import post_process
+import time
+from argparse import ArgumentParser
+
+import numpy as np
 import torch
 
-def speed():
-    device = 'cuda'
-    recon = torch.rand((100000,16,3), device=device, dtype=torch.float32)
-    target = torch.rand((100000,16,3), device=device, dtype=torch.float32)
-    scale = torch.rand((100000,1), device=device, dtype=torch.float32)
+from src.datasets.skeleton import Skeleton
+from src.models import LBAD, FusedLBAD, Generator
+from src.processing import batch_procrustes, preprocess, scipy_procrustes
+
+
+def timeit(fn, *args, repeat=3, device="cpu"):
+    """best wall time of fn(*args) in seconds"""
+    times = []
+    for _ in range(repeat):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn(*args)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def procrustes_speed(n_poses, device):
+    target = torch.rand((n_poses, 15, 3), device=device, dtype=torch.float32)
+    recon = torch.rand((n_poses, 15, 3), device=device, dtype=torch.float32)
+
+    # warm up kernels before timing
+    batch_procrustes(target[:10], recon[:10])
+
+    t_batch = timeit(batch_procrustes, target, recon, device=device)
+    t_scipy = timeit(scipy_procrustes, target, recon, repeat=1, device=device)
+
+    err = (batch_procrustes(target, recon) - scipy_procrustes(target, recon)).abs().max()
+
+    print(f"procrustes {n_poses} poses on {device}")
+    print(f"\tscipy: {t_scipy:.4f}s \tbatched: {t_batch:.4f}s \tspeedup: {t_scipy / t_batch:.1f}x")
+    print(f"\tmax abs diff: {err.item():.2e}")
+
+
+def zero_the_root_loop(poses, root_idx):
+    """previous per pose implementation, reference for the benchmark"""
+    for i in range(poses.shape[0]):
+        poses[i, :, :] = poses[i, :, :] - poses[i, root_idx, :]
+    return np.delete(poses, root_idx, 1)
+
+
+def preprocess_loop(poses, joint_names, root_idx, project_dist=10):
+    """previous preprocess of 2D poses, reference for the benchmark"""
+    dist = 0
+    for start, end in (("Head", "Neck"), ("Neck", "Torso"), ("Torso", "Pelvis")):
+        dist = dist + np.linalg.norm(
+            poses[:, joint_names.index(start), :] - poses[:, joint_names.index(end), :],
+            axis=1,
+            keepdims=True,
+        )
+    scale_2d = project_dist * np.mean(dist)
+    poses = np.divide(poses.T, scale_2d.T).T
+    return zero_the_root_loop(poses, root_idx)
+
+
+def preprocess_speed(n_poses, device):
+    skel = Skeleton()
+    poses = np.random.rand(n_poses, 16, 2).astype(np.float32) * 1000
+
+    t_loop = timeit(lambda: preprocess_loop(poses.copy(), skel.joints, skel.root_idx), repeat=1)
+    t_numpy = timeit(lambda: preprocess(poses.copy(), skel.joints, skel.root_idx, inplace=True))
+
+    poses_t = torch.from_numpy(poses).to(device)
+    t_torch = timeit(
+        lambda: preprocess(poses_t.clone(), skel.joints, skel.root_idx, inplace=True), device=device
+    )
+
+    err = np.abs(
+        preprocess(poses.copy(), skel.joints, skel.root_idx)
+        - preprocess_loop(poses.copy(), skel.joints, skel.root_idx)
+    ).max()
+
+    print(f"preprocess {n_poses} 2D poses")
+    print(f"\tloop: {t_loop:.4f}s \tnumpy: {t_numpy:.4f}s \ttorch ({device}): {t_torch:.4f}s"
+          f" \tspeedup: {t_loop / t_numpy:.1f}x")
+    print(f"\tmax abs diff: {err:.2e}")
+
+
+def block_speed(batch_sizes, latent_dim=51, compile=False):
+    """train step and eval forward of the Generator with LBAD and FusedLBAD blocks on cpu"""
+    torch.manual_seed(0)
+    models = {"LBAD": Generator(latent_dim, block=LBAD)}
+    models["FusedLBAD"] = Generator(latent_dim, block=FusedLBAD)
+    models["FusedLBAD"].load_state_dict(models["LBAD"].state_dict())
+    if compile and hasattr(torch, "compile"):
+        models["FusedLBAD+compile"] = torch.compile(models["FusedLBAD"])
+
+    def train_step(model, optimizer, x):
+        optimizer.zero_grad(set_to_none=True)
+        recon, mean, logvar = model(x)
+        loss = recon.square().mean() + mean.square().mean()
+        loss.backward()
+        optimizer.step()
+
+    def eval_forward(model, x):
+        with torch.no_grad():
+            model(x)
+
+    print("Generator blocks, train step / eval forward on cpu")
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 15, 2)
+        results = []
+        for name, model in models.items():
+            optimizer = torch.optim.SGD(model.parameters(), lr=0)
+            model.train()
+            train_step(model, optimizer, x)  # warm up
+            t_train = timeit(train_step, model, optimizer, x)
+            model.eval()
+            eval_forward(model, x)
+            t_eval = timeit(eval_forward, model, x)
+            results.append(f"{name}: {t_train * 1000:.1f}/{t_eval * 1000:.1f}ms")
+
+        # running stats drift apart with the timed steps
+        models["FusedLBAD"].load_state_dict(models["LBAD"].state_dict())
+        with torch.no_grad():
+            err = (models["LBAD"](x)[0] - models["FusedLBAD"](x)[0]).abs().max()
+        print(f"\tbatch {batch_size} \t" + " \t".join(results) + f" \tmax abs diff: {err.item():.2e}")
+
+
+def train_step_speed(batch_size, n_steps, warmup, device):
+    """VAEGAN training steps/s, eager vs torch.compile with metrics read once per epoch"""
+    import pytorch_lightning as pl
+
+    from src.train_pl import get_argparser
+    from src.trainer_pl import VAEGAN
+
+    class StepTimer(pl.Callback):
+        def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx):
+            if batch_idx == warmup:
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                self.start = time.perf_counter()
+
+        def on_train_end(self, trainer, pl_module):
+            if device == "cuda":
+                torch.cuda.synchronize()
+            self.elapsed = time.perf_counter() - self.start
+
+    n_poses = batch_size * (n_steps + warmup)
+    data = [
+        {"pose2d": pose2d, "mask": torch.ones_like(pose2d)}
+        for pose2d in torch.rand(n_poses, 15, 2).split(batch_size)
+    ]
+
+    print(f"VAEGAN training step, batch {batch_size} on {device}")
+    for compile in (False, True):
+        opt = get_argparser().parse_args(["--compile", str(compile), "--fast_dev_run", "False"])
+        model = VAEGAN(opt)
+        timer = StepTimer()
+        trainer = pl.Trainer(
+            gpus=int(device == "cuda"),
+            max_epochs=1,
+            callbacks=[timer],
+            logger=False,
+            checkpoint_callback=False,
+            weights_summary=None,
+            progress_bar_refresh_rate=0,
+        )
+        trainer.fit(model, torch.utils.data.DataLoader(data, batch_size=None))
+        print(f"\t{'compiled' if compile else 'eager'}: {n_steps / timer.elapsed:.1f} steps/s")
 
-    recon, target = post_process(
-        recon.to('cpu'), target.to('cpu'), scale.to('cpu'), self_supervised=True,procrustes_enabled=True)
-    
 
-if __name__ == '__main__':
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--n_poses", default=100000, type=int,
+                        help="number of poses to benchmark")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str,
+                        help="device to run the batched implementations on")
+    parser.add_argument("--n_preprocess", default=1000000, type=int,
+                        help="number of poses to benchmark preprocessing")
+    parser.add_argument("--block_batch_sizes", default=[256, 1024, 4096, 8192], type=int, nargs="+",
+                        help="batch sizes to benchmark the LBAD blocks")
+    parser.add_argument("--compile", default=False, action="store_true",
+                        help="also benchmark FusedLBAD with torch.compile")
+    parser.add_argument("--train_steps", default=0, type=int,
+                        help="timed VAEGAN training steps, 0 to skip")
+    parser.add_argument("--train_batch_size", default=2048, type=int,
+                        help="batch size of the VAEGAN training steps")
+    args = parser.parse_args()
 
-    with torch.autograd.profiler.profile(use_cuda=True) as prof:
-        speed()
-    print(prof)
-    
\ No newline at end of file
+    procrustes_speed(args.n_poses, args.device)
+    preprocess_speed(args.n_preprocess, args.device)
+    block_speed(args.block_batch_sizes, compile=args.compile)
+    if args.train_steps:
+        # compilation happens in the first steps
+        train_step_speed(args.train_batch_size, args.train_steps, warmup=10, device=args.device)
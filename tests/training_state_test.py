@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+
+import torch
+
+from helpers import training_config, training_setup
+from src.callbacks import Callback, CallbackList, TrainingState
+from src.dataloader import train_dataloader
+from src.trainer import training_epoch
+
+
+class Interrupted(Exception):
+    pass
+
+
+class Recorder(Callback):
+    """samples and torch RNG state of every trained step, interrupts the epoch before step crash_at"""
+
+    def __init__(self, crash_at=None):
+        self.crash_at = crash_at
+        self.batches = []
+        self.rng = []
+
+    def on_train_batch_start(self, batch_idx, **kwargs):
+        if batch_idx == self.crash_at:
+            raise Interrupted()
+
+    def on_train_batch_end(self, batch, **kwargs):
+        self.batches.append(batch["idx"].long().tolist())
+        self.rng.append(torch.get_rng_state())
+
+
+class TrainingStateTestCase(unittest.TestCase):
+
+    def run_epoch(self, config, callbacks, seed=0):
+        models, optimizers, schedulers, model, optimizer = training_setup(config, seed)
+        cb = CallbackList(callbacks)
+        cb.setup(config=config, models=models, optimizers=optimizers, schedulers=schedulers)
+        try:
+            training_epoch(config, cb, model, train_dataloader(config), optimizer, 1, "2d_2_3d")
+        finally:
+            # the state saved before an interruption is written
+            cb.teardown(config=config)
+        return models
+
+    def test_resume_mid_epoch(self):
+        with tempfile.TemporaryDirectory() as root:
+            # 6 steps without interruption
+            full = Recorder()
+            models = self.run_epoch(training_config(root, "--exp_name", "full"), [full])
+
+            # interrupted before step 3, the state is saved every 2 steps
+            config = training_config(root, "--exp_name", "resumed", "--state_every_n_steps", "2")
+            with self.assertRaises(Interrupted):
+                self.run_epoch(config, [TrainingState(2), Recorder(crash_at=3)])
+
+            # other initial weights, all restored from the state after step 1
+            config = training_config(root, "--exp_name", "resumed", "--resume_state", "true")
+            resumed = Recorder()
+            resumed_models = self.run_epoch(config, [TrainingState(2), resumed], seed=1)
+
+        self.assertEqual(len(full.batches), 6)
+        # same batches in the same order and same random numbers from step 2 on
+        self.assertEqual(resumed.batches, full.batches[2:])
+        for rng, resumed_rng in zip(full.rng[2:], resumed.rng):
+            self.assertTrue(torch.equal(rng, resumed_rng))
+        for key, model in models.items():
+            for (name, val), resumed_val in zip(model.state_dict().items(), resumed_models[key].state_dict().values()):
+                self.assertTrue(torch.allclose(val, resumed_val, atol=1e-6), f"{key}.{name}")
+
+
+if __name__ == '__main__':
+    unittest.main()